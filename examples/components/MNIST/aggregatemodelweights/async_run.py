@@ -0,0 +1,374 @@
+"""Asynchronous buffered aggregation (FedBuff) over a FolderStore.
+
+Instead of waiting for every silo at each round, the aggregator folds silo
+updates as they arrive into a buffer. Every update is down-weighted by its
+staleness, the number of global versions published since the silo pulled the
+version it trained from. Once the buffer holds buffer_size updates, their
+weighted sum is applied to the global model with the server optimizer and a
+new global version is published in the store, for the silos to pick up.
+
+See Nguyen et al., Federated Learning with Buffered Asynchronous Aggregation, 2022.
+"""
+import argparse
+import logging
+import sys
+import time
+
+import torch
+
+from async_store import FolderStore
+from model_io import CHECKPOINT_FORMATS, find_checkpoint, load_checkpoint
+from run import (
+    WEIGHTING_METADATA_KEYS,
+    get_silo_skip_reason,
+    get_silo_weight,
+    load_silo_update,
+    load_state_dict,
+)
+from server_optimizer import SERVER_OPTIMIZERS, ServerOptimizer
+
+STALENESS_WEIGHTINGS = ["constant", "polynomial", "hinge"]
+
+
+def get_arg_parser(parser=None):
+    """Parse the command line arguments for merge using argparse.
+
+    Args:
+        parser (argparse.ArgumentParser or CompliantArgumentParser):
+        an argument parser instance
+
+    Returns:
+        ArgumentParser: the argument parser instance
+
+    Notes:
+        if parser is None, creates a new parser instance
+    """
+    # add arguments that are specific to the component
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--store",
+        type=str,
+        required=True,
+        help="Root folder of the store shared with the silos (local directory or mounted datastore)",
+    )
+    parser.add_argument(
+        "--initial_checkpoint",
+        type=str,
+        required=False,
+        help="Model folder published as version 0 if the store has no version yet",
+    )
+    parser.add_argument(
+        "--buffer_size",
+        type=int,
+        required=False,
+        default=3,
+        help="Number of silo updates folded before publishing a new global version",
+    )
+    parser.add_argument(
+        "--num_versions",
+        type=int,
+        required=False,
+        default=10,
+        help="Stop after publishing this number of new global versions",
+    )
+    parser.add_argument(
+        "--staleness_weighting",
+        type=str,
+        required=False,
+        choices=STALENESS_WEIGHTINGS,
+        default="polynomial",
+        help="constant: 1, polynomial: (1 + staleness)^-a, hinge: 1 up to staleness b, then 1 / (a * (staleness - b) + 1)",
+    )
+    parser.add_argument(
+        "--staleness_exponent",
+        type=float,
+        required=False,
+        default=0.5,
+        help="a in the staleness weighting",
+    )
+    parser.add_argument(
+        "--staleness_cutoff",
+        type=int,
+        required=False,
+        default=4,
+        help="b in the hinge staleness weighting",
+    )
+    parser.add_argument(
+        "--max_staleness",
+        type=int,
+        required=False,
+        default=None,
+        help="Reject the updates staler than this number of versions",
+    )
+    parser.add_argument(
+        "--weighting",
+        type=str,
+        required=False,
+        choices=["uniform"] + list(WEIGHTING_METADATA_KEYS.keys()),
+        default="uniform",
+        help="How to weight each silo update, based on the metadata.json written by the training",
+    )
+    parser.add_argument(
+        "--server_optimizer",
+        type=str,
+        required=False,
+        choices=SERVER_OPTIMIZERS,
+        default="fedavg",
+        help="Server optimizer applying the buffered update to the global model",
+    )
+    parser.add_argument("--server_lr", type=float, required=False, default=1.0)
+    parser.add_argument("--server_beta1", type=float, required=False, default=0.9)
+    parser.add_argument("--server_beta2", type=float, required=False, default=0.99)
+    parser.add_argument("--server_epsilon", type=float, required=False, default=1e-3)
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        required=False,
+        choices=CHECKPOINT_FORMATS,
+        default="torch",
+        help="Format of the global model versions",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        required=False,
+        default=1.0,
+        help="Seconds between two checks of the store inbox",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        required=False,
+        default=None,
+        help="Stop if no update arrives for this number of seconds",
+    )
+    return parser
+
+
+def staleness_weight(staleness, method="polynomial", exponent=0.5, cutoff=4):
+    """Weight of an update given its staleness.
+
+    Args:
+        staleness (int): number of global versions published since the silo pulled its base version
+        method (str): constant, polynomial or hinge
+        exponent (float): a, decay of the polynomial and hinge weightings
+        cutoff (int): b, staleness up to which the hinge weighting is 1
+
+    Returns:
+        float: the weight, in ]0, 1]
+    """
+    if method == "constant":
+        return 1.0
+    if method == "polynomial":
+        return (1.0 + staleness) ** -exponent
+    if staleness <= cutoff:
+        return 1.0
+    return 1.0 / (exponent * (staleness - cutoff) + 1.0)
+
+
+class UpdateBuffer:
+    def __init__(self):
+        """Buffer accumulating the staleness weighted sum of silo updates."""
+        self.reset()
+
+    def reset(self):
+        """Empty the buffer."""
+        self.accumulator = None
+        self.total_weight = 0.0
+        self.size = 0
+
+    def fold(self, update, weight, staleness_factor):
+        """Add a silo update to the buffer.
+
+        Args:
+            update (dict): the decoded silo update (dense or sparse tensors)
+            weight (float): weight of the silo (see --weighting)
+            staleness_factor (float): staleness weight of the update
+        """
+        if self.accumulator is None:
+            self.accumulator = {
+                k: torch.zeros(v.shape, dtype=torch.float32) for k, v in update.items()
+            }
+        for k, accumulator in self.accumulator.items():
+            # sparse (top-k) updates are added without being densified
+            accumulator.add_(update[k].float(), alpha=weight * staleness_factor)
+        self.total_weight += weight
+        self.size += 1
+
+    def flush(self, reference):
+        """Get the buffered update and empty the buffer.
+
+        Stale updates keep their reduced contribution: the weighted sum is
+        divided by the sum of the silo weights, not of the staleness weights.
+
+        Args:
+            reference (dict): state_dict giving the dtype of every key
+
+        Returns:
+            dict: the buffered update, in the dtypes of reference
+        """
+        update = {
+            k: (v / self.total_weight).to(reference[k].dtype)
+            for k, v in self.accumulator.items()
+        }
+        self.reset()
+        return update
+
+
+def run(args):
+    """Run script with arguments (the core of the component).
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+    """
+    store = FolderStore(args.store)
+    version = store.latest_version()
+    if version is None:
+        if not args.initial_checkpoint:
+            raise ValueError(
+                f"The store {args.store} has no global version yet, --initial_checkpoint is required."
+            )
+        version = 0
+        store.publish_version(
+            version,
+            {"model": load_state_dict(args.initial_checkpoint)},
+            args.checkpoint_format,
+        )
+        logger.info(f"Published {args.initial_checkpoint} as version 0")
+    global_state_dict = load_state_dict(store.version_path(version))
+    logger.info(f"Starting from version {version}")
+
+    server_optimizer = ServerOptimizer(
+        args.server_optimizer,
+        lr=args.server_lr,
+        beta1=args.server_beta1,
+        beta2=args.server_beta2,
+        epsilon=args.server_epsilon,
+    )
+    # resume the server optimizer from the latest version, if any
+    server_optimizer_state = None
+    if find_checkpoint(store.version_path(version), name="server_optimizer")[0]:
+        server_optimizer_state = load_checkpoint(
+            store.version_path(version), name="server_optimizer"
+        )
+    buffer = UpdateBuffer()
+    buffered_silos = []
+    published = 0
+    last_arrival = time.time()
+
+    while published < args.num_versions:
+        submissions = store.list_submissions()
+        if not submissions:
+            if args.timeout and time.time() - last_arrival > args.timeout:
+                logger.warning(f"No update received for {args.timeout}s, stopping")
+                break
+            time.sleep(args.poll_interval)
+            continue
+        last_arrival = time.time()
+
+        for submission_id in submissions:
+            submission = store.read_submission(submission_id)
+            submission_path = store.submission_path(submission_id)
+            staleness = version - submission["base_version"]
+            if args.max_staleness is not None and staleness > args.max_staleness:
+                logger.warning(
+                    f"Rejecting {submission_id} from {submission['silo']}: staleness {staleness} > {args.max_staleness}"
+                )
+                store.mark_processed(submission_id)
+                continue
+
+            # a failed training (failure_mode=skip) or an unreadable submission is skipped
+            skip_reason = get_silo_skip_reason(submission_path, args.weighting)
+            if skip_reason is not None:
+                logger.warning(
+                    f"Skipping {submission_id} from {submission['silo']}: {skip_reason}"
+                )
+                store.mark_processed(submission_id)
+                continue
+
+            # updates are relative to the version the silo pulled
+            if submission["base_version"] == version:
+                base_state_dict = global_state_dict
+            else:
+                base_state_dict = load_state_dict(
+                    store.version_path(submission["base_version"])
+                )
+            try:
+                update = load_silo_update(submission_path, base_state_dict)
+            except Exception as e:
+                logger.warning(
+                    f"Skipping {submission_id} from {submission['silo']}, invalid checkpoint: {e}"
+                )
+                store.mark_processed(submission_id)
+                continue
+            factor = staleness_weight(
+                staleness,
+                args.staleness_weighting,
+                args.staleness_exponent,
+                args.staleness_cutoff,
+            )
+            buffer.fold(
+                update, get_silo_weight(submission_path, args.weighting), factor
+            )
+            buffered_silos.append(submission["silo"])
+            store.mark_processed(submission_id)
+            logger.info(
+                f"Folded {submission_id} from {submission['silo']} (staleness {staleness}, weight factor {factor:.3f}), buffer {buffer.size}/{args.buffer_size}"
+            )
+            del update, base_state_dict
+
+            if buffer.size >= args.buffer_size:
+                global_state_dict, server_optimizer_state = server_optimizer.step(
+                    global_state_dict,
+                    buffer.flush(global_state_dict),
+                    server_optimizer_state,
+                )
+                version += 1
+                checkpoints = {"model": global_state_dict}
+                if server_optimizer_state:
+                    checkpoints["server_optimizer"] = server_optimizer_state
+                store.publish_version(
+                    version,
+                    checkpoints,
+                    args.checkpoint_format,
+                    metadata={"silos": buffered_silos},
+                )
+                logger.info(f"Published version {version} from silos {buffered_silos}")
+                buffered_silos = []
+                published += 1
+                if published >= args.num_versions:
+                    break
+
+
+def main(cli_args=None):
+    """Component main function.
+
+    It parses arguments and executes run() with the right arguments.
+
+    Args:
+        cli_args (List[str], optional): list of args to feed script, useful for debugging. Defaults to None.
+    """
+    # build an arg parser
+    parser = get_arg_parser()
+
+    # run the parser on cli args
+    args = parser.parse_args(cli_args)
+
+    print(f"Running script with arguments: {args}")
+    run(args)
+
+
+if __name__ == "__main__":
+
+    # Set logging to sys.out
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    log_format = logging.Formatter("[%(asctime)s] [%(levelname)s] - %(message)s")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(log_format)
+    logger.addHandler(handler)
+
+    main()
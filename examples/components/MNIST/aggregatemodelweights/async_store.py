@@ -0,0 +1,125 @@
+"""A folder-based store to exchange global model versions and silo updates asynchronously.
+
+Layout of the store:
+- versions/<version>/: the global model versions (model.pt or model.tensors, metadata.json),
+- LATEST: the number of the latest global version,
+- inbox/<submission>/: the silo updates (or models) waiting to be aggregated,
+  with a submission.json recording the silo and the version it started from,
+- processed/<submission>/: the submissions already aggregated (or rejected).
+
+Every write goes to a temporary file or folder renamed in place, so readers
+never see partial content. The store works on a local directory (a stand-in
+for the datastore, to run everything on one machine) or on a datastore
+mounted read-write on every participant.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+
+from model_io import save_checkpoint
+
+
+class FolderStore:
+    def __init__(self, root):
+        """A store of global model versions and silo submissions in a folder.
+
+        Args:
+            root (str): root folder of the store (created if needed)
+        """
+        self.root = root
+        for folder in ["versions", "inbox", "processed"]:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def version_path(self, version):
+        """Folder of a global model version."""
+        return os.path.join(self.root, "versions", f"{version:06d}")
+
+    def latest_version(self):
+        """Number of the latest global version, or None if none was published."""
+        latest_path = os.path.join(self.root, "LATEST")
+        if not os.path.isfile(latest_path):
+            return None
+        with open(latest_path, "r") as latest_file:
+            return int(latest_file.read().strip())
+
+    def publish_version(self, version, checkpoints, checkpoint_format, metadata=None):
+        """Publish a new global version, then point LATEST to it.
+
+        Args:
+            version (int): number of the version
+            checkpoints (dict): checkpoint name -> state_dict, e.g. {"model": ...}
+            checkpoint_format (str): torch, mmap or chunked
+            metadata (dict): json-serializable metadata of the version
+
+        Returns:
+            str: folder of the published version
+        """
+        path = self.version_path(version)
+        temp_path = os.path.join(self.root, "versions", f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(temp_path)
+        for name, state_dict in checkpoints.items():
+            save_checkpoint(state_dict, temp_path, checkpoint_format, name=name)
+        with open(os.path.join(temp_path, "metadata.json"), "w") as metadata_file:
+            json.dump(dict(metadata or {}, version=version), metadata_file)
+        os.rename(temp_path, path)
+
+        temp_latest_path = os.path.join(self.root, f".LATEST-{uuid.uuid4().hex}")
+        with open(temp_latest_path, "w") as latest_file:
+            latest_file.write(str(version))
+        os.replace(temp_latest_path, os.path.join(self.root, "LATEST"))
+        return path
+
+    def submit(self, silo_name, model_path, base_version):
+        """Submit the output of a silo training (update or model) for aggregation.
+
+        Args:
+            silo_name (str): name of the silo
+            model_path (str): folder written by the training
+            base_version (int): global version the training started from
+
+        Returns:
+            str: id of the submission
+        """
+        # ids sort in order of submission
+        submission_id = f"{time.time_ns():020d}-{silo_name}-{uuid.uuid4().hex[:8]}"
+        temp_path = os.path.join(self.root, "inbox", f".tmp-{submission_id}")
+        shutil.copytree(model_path, temp_path)
+        with open(os.path.join(temp_path, "submission.json"), "w") as submission_file:
+            json.dump(
+                {
+                    "silo": silo_name,
+                    "base_version": base_version,
+                    "submitted": time.time(),
+                },
+                submission_file,
+            )
+        os.rename(temp_path, self.submission_path(submission_id))
+        return submission_id
+
+    def list_submissions(self):
+        """Ids of the submissions waiting to be aggregated, in order of submission."""
+        return sorted(
+            entry
+            for entry in os.listdir(os.path.join(self.root, "inbox"))
+            if not entry.startswith(".")
+        )
+
+    def submission_path(self, submission_id):
+        """Folder of a submission waiting to be aggregated."""
+        return os.path.join(self.root, "inbox", submission_id)
+
+    def read_submission(self, submission_id):
+        """Read the submission.json of a submission (silo, base_version, submitted)."""
+        with open(
+            os.path.join(self.submission_path(submission_id), "submission.json"), "r"
+        ) as submission_file:
+            return json.load(submission_file)
+
+    def mark_processed(self, submission_id):
+        """Move a submission out of the inbox once aggregated (or rejected)."""
+        os.rename(
+            self.submission_path(submission_id),
+            os.path.join(self.root, "processed", submission_id),
+        )
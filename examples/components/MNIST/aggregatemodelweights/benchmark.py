@@ -0,0 +1,302 @@
+"""Benchmark the aggregation methods relative to the plain mean.
+
+Runs on synthetic silo state_dicts and prints the median wall time of each
+method, e.g. the cost of the robust methods:
+
+    python benchmark.py --num_silos 10 --num_parameters 11000000
+
+or the speedup of the process pool aggregation (aggregation_mode=parallel)
+on a 1 GB state_dict (float32) with 1, 2, 4 and 8 workers:
+
+    python benchmark.py --benchmark parallel --num_silos 4 --num_parameters 268435456 --num_workers 1 2 4 8
+
+or the overhead of secure aggregation (masking in every silo, unmasking with
+and without a dropped silo in the aggregation):
+
+    python benchmark.py --benchmark secure --num_silos 10 --num_parameters 11000000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from parallel_aggregation import parallel_aggregate_model_weights
+from run import aggregate_model_weights
+from secure_aggregation import (
+    get_default_threshold,
+    mask_state_dict,
+    split_secret,
+    unmask_sum,
+)
+from robust_aggregation import (
+    ROBUST_AGGREGATION_METHODS,
+    robust_aggregate_model_weights,
+)
+
+
+def get_arg_parser(parser=None):
+    """Parse the command line arguments for the benchmark using argparse.
+
+    Args:
+        parser (argparse.ArgumentParser or CompliantArgumentParser):
+        an argument parser instance
+
+    Returns:
+        ArgumentParser: the argument parser instance
+
+    Notes:
+        if parser is None, creates a new parser instance
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--benchmark",
+        type=str,
+        required=False,
+        choices=["robust", "parallel", "secure"],
+        default="robust",
+        help="robust: the robust aggregation methods, parallel: the process pool aggregation, secure: the secure aggregation masks",
+    )
+    parser.add_argument("--num_silos", type=int, required=False, default=10)
+    parser.add_argument(
+        "--num_parameters",
+        type=int,
+        required=False,
+        default=11_000_000,
+        help="Total number of parameters of the synthetic model (default: about a ResNet18)",
+    )
+    parser.add_argument(
+        "--layer_size",
+        type=int,
+        required=False,
+        default=2**20,
+        help="Number of parameters of each synthetic layer",
+    )
+    parser.add_argument("--chunk_size", type=int, required=False, default=2**20)
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        nargs="+",
+        required=False,
+        default=[1, 2, 4],
+        help="Numbers of worker processes of the parallel benchmark",
+    )
+    parser.add_argument("--repeats", type=int, required=False, default=3)
+    parser.add_argument("--seed", type=int, required=False, default=0)
+    return parser
+
+
+def make_state_dicts(num_silos, num_parameters, layer_size, seed=0):
+    """Create synthetic silo state_dicts sharing the same schema.
+
+    Args:
+        num_silos (int): number of silos
+        num_parameters (int): total number of parameters of each state_dict
+        layer_size (int): number of parameters of each layer
+        seed (int): random seed
+
+    Returns:
+        List[dict]: the silo state_dicts
+    """
+    generator = torch.Generator().manual_seed(seed)
+    layer_sizes = [layer_size] * (num_parameters // layer_size)
+    if num_parameters % layer_size:
+        layer_sizes.append(num_parameters % layer_size)
+    return [
+        {
+            f"layer{index}.weight": torch.randn(size, generator=generator)
+            for index, size in enumerate(layer_sizes)
+        }
+        for _ in range(num_silos)
+    ]
+
+
+def time_method(aggregate_fn, repeats):
+    """Median wall time of a function over a number of repeats, in seconds."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        aggregate_fn()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def sum_masked(masked_state_dicts, survivors):
+    """Sum the masked tensors of the surviving silos in Z_2^32, as the aggregation does."""
+    masked_sum = {}
+    for index in survivors:
+        for k, v in masked_state_dicts[index].items():
+            masked = v.numpy().reshape(-1).view(np.uint32)
+            if k in masked_sum:
+                masked_sum[k] += masked
+            else:
+                masked_sum[k] = masked.copy()
+    return masked_sum
+
+
+def run_secure(args, state_dicts, mean_time):
+    """Time the masking of a silo and the unmasking of the sum, relative to the mean.
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+        state_dicts (List[dict]): synthetic silo state_dicts
+        mean_time (float): time of the plain mean
+    """
+    num_silos = len(state_dicts)
+    generator = random.Random(args.seed)
+    seeds = dict(
+        ((i, j), generator.getrandbits(128))
+        for i in range(num_silos)
+        for j in range(i + 1, num_silos)
+    )
+
+    def pair_seeds(index):
+        return dict(
+            (peer, seeds[(min(index, peer), max(index, peer))])
+            for peer in range(num_silos)
+            if peer != index
+        )
+
+    threshold = get_default_threshold(num_silos)
+    self_mask_seeds = [generator.getrandbits(126) for _ in range(num_silos)]
+    shares = [split_secret(seed, num_silos, threshold) for seed in self_mask_seeds]
+
+    def reveals(survivors):
+        # what the surviving silos would reveal, see secure_aggregation.reveal()
+        dropped = [index for index in range(num_silos) if index not in survivors]
+        return [
+            {
+                "silo_index": index,
+                "received": list(survivors),
+                "seeds": dict(
+                    (f"{index}-{peer}", format(pair_seeds(index)[peer], "x"))
+                    for peer in dropped
+                ),
+                "self_mask_shares": dict(
+                    (f"{index}-{silo}", format(shares[silo][index], "x"))
+                    for silo in survivors
+                ),
+            }
+            for index in survivors
+        ]
+
+    # the last silo drops out
+    survivors = list(range(num_silos - 1))
+    masked = [
+        mask_state_dict(
+            state_dict, index, pair_seeds(index), self_mask_seeds[index], num_silos
+        )
+        for index, state_dict in enumerate(state_dicts)
+    ]
+    spec = dict(masked[0][2], threshold=threshold)
+    masked_state_dicts = [entry[0] for entry in masked]
+    expected = aggregate_model_weights(state_dicts)
+    aggregated = unmask_sum(
+        sum_masked(masked_state_dicts, range(num_silos)),
+        spec,
+        range(num_silos),
+        reveals(range(num_silos)),
+    )
+    error = max(
+        (aggregated[k] / num_silos - expected[k].double()).abs().max().item()
+        for k in expected
+    )
+    print(f"(max error of the secure mean: {error:.2e})")
+
+    timings = {
+        "mask (1 silo)": time_method(
+            lambda: mask_state_dict(
+                state_dicts[0], 0, pair_seeds(0), self_mask_seeds[0], num_silos
+            ),
+            args.repeats,
+        ),
+        "unmask": time_method(
+            lambda: unmask_sum(
+                sum_masked(masked_state_dicts, range(num_silos)),
+                spec,
+                range(num_silos),
+                reveals(range(num_silos)),
+            ),
+            args.repeats,
+        ),
+        "unmask 1 drop": time_method(
+            lambda: unmask_sum(
+                sum_masked(masked_state_dicts, survivors),
+                spec,
+                survivors,
+                reveals(survivors),
+            ),
+            args.repeats,
+        ),
+    }
+    for name, method_time in timings.items():
+        print(f"{name:<14}{method_time:>10.3f}{method_time / mean_time:>10.2f}")
+
+
+def run(args):
+    """Run the benchmark with arguments.
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+    """
+    state_dicts = make_state_dicts(
+        args.num_silos, args.num_parameters, args.layer_size, args.seed
+    )
+    print(
+        f"{args.num_silos} silos, {args.num_parameters} parameters, chunk_size={args.chunk_size}, torch threads={torch.get_num_threads()}"
+    )
+
+    mean_time = time_method(lambda: aggregate_model_weights(state_dicts), args.repeats)
+    print(f"{'method':<14}{'time (s)':>10}{'vs mean':>10}")
+    print(f"{'mean':<14}{mean_time:>10.3f}{1.0:>10.2f}")
+    if args.benchmark == "secure":
+        run_secure(args, state_dicts, mean_time)
+        return
+
+    if args.benchmark == "parallel":
+        expected = aggregate_model_weights(state_dicts)
+        for num_workers in args.num_workers:
+            aggregated = parallel_aggregate_model_weights(
+                state_dicts, num_workers=num_workers
+            )
+            assert all(
+                torch.equal(aggregated[k], expected[k]) for k in expected
+            ), f"parallel aggregation with {num_workers} workers differs from the mean"
+            # includes the start of the workers and the move to shared memory
+            parallel_time = time_method(
+                lambda: parallel_aggregate_model_weights(
+                    state_dicts, num_workers=num_workers
+                ),
+                args.repeats,
+            )
+            print(
+                f"{f'parallel x{num_workers}':<14}{parallel_time:>10.3f}{parallel_time / mean_time:>10.2f}"
+            )
+        return
+
+    for method in ROBUST_AGGREGATION_METHODS:
+        method_time = time_method(
+            lambda: robust_aggregate_model_weights(
+                state_dicts, method, chunk_size=args.chunk_size
+            ),
+            args.repeats,
+        )
+        print(f"{method:<14}{method_time:>10.3f}{method_time / mean_time:>10.2f}")
+
+
+def main(cli_args=None):
+    """Benchmark main function.
+
+    Args:
+        cli_args (List[str], optional): list of args to feed script, useful for debugging. Defaults to None.
+    """
+    parser = get_arg_parser()
+    args = parser.parse_args(cli_args)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
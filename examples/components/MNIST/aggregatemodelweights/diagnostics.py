@@ -0,0 +1,211 @@
+"""Per-silo diagnostics of the updates, computed during the aggregation pass.
+
+For every silo and every floating point layer of its update (the silo model
+minus the base checkpoint, or the update it sent), the diagnostics record:
+- the L2 norm of the update,
+- its max absolute change,
+- its cosine similarity to the weighted mean update of the round.
+
+Norms and max absolute changes are exact. The aggregation may fold one silo at
+a time (streaming mode), so the cosine similarities are computed on a linear
+sketch of every update kept in memory: layers with at most sketch_size entries
+are kept as is (exact cosine), larger layers are reduced to sketch_size entries
+with a count sketch (Charikar et al., 2002), which preserves inner products in
+expectation. The sketch of the mean update is the weighted mean of the silo
+sketches, and all the inner products of a layer come from one gram matrix.
+"""
+import csv
+import json
+import os
+import zlib
+
+import torch
+
+from update_codec import to_dense
+
+DIAGNOSTICS_METRICS = ["l2_norm", "cosine_to_mean", "max_abs_change"]
+
+# multiplier of the index hash of the count sketch (golden ratio, 32 bits)
+HASH_MULTIPLIER = 0x9E3779B1
+HASH_MODULUS = 2**31 - 1
+SKETCH_CHUNK_SIZE = 2**22
+
+
+def count_sketch(flat, sketch_size, seed):
+    """Reduce a flat tensor to sketch_size entries with a count sketch.
+
+    Entry i is added, with a random sign, to bucket h(i) mod sketch_size, where
+    h is a hash of i (and of the seed). The hash is recomputed chunk by chunk
+    instead of being stored, so the memory overhead is independent of the tensor size.
+
+    Args:
+        flat (torch.Tensor): float32 1D tensor
+        sketch_size (int): number of buckets
+        seed (int): seed of the hash, the same for a layer of every silo
+
+    Returns:
+        torch.Tensor: the float64 sketch, of shape [sketch_size]
+    """
+    sketch = torch.zeros(sketch_size, dtype=torch.float64)
+    for start in range(0, flat.numel(), SKETCH_CHUNK_SIZE):
+        end = min(start + SKETCH_CHUNK_SIZE, flat.numel())
+        index = torch.arange(start, end, dtype=torch.int64)
+        hashed = (index * HASH_MULTIPLIER + seed) % HASH_MODULUS
+        signs = 1.0 - 2.0 * ((hashed // sketch_size) % 2).double()
+        sketch.index_add_(0, hashed % sketch_size, flat[start:end].double() * signs)
+    return sketch
+
+
+class UpdateDiagnostics:
+    def __init__(self, base_state_dict=None, sketch_size=2**16, silo_names=None):
+        """Collect the diagnostics of the silo updates, one silo at a time.
+
+        Args:
+            base_state_dict (dict): base checkpoint subtracted from the silo state_dicts,
+                None if the silos state_dicts are already updates
+            sketch_size (int): maximum number of entries kept per layer and silo to compute cosine similarities
+            silo_names (dict): name of every silo model folder in the diagnostics (default: the folder name)
+        """
+        self.base_state_dict = base_state_dict
+        self.sketch_size = sketch_size
+        self.silo_names = silo_names or {}
+        self.paths = []
+        self.silos = []
+        self.weights = []
+        self.layers = {}
+
+    def add(self, model_path, state_dict, weight=1.0):
+        """Compute the diagnostics of a silo, before its state_dict is folded into the mean.
+
+        Args:
+            model_path (str): silo model folder
+            state_dict (dict): the silo state_dict (or update), not modified
+            weight (float): weight of the silo in the aggregation
+        """
+        self.paths.append(model_path)
+        self.silos.append(self.silo_names.get(model_path, os.path.basename(model_path)))
+        self.weights.append(weight)
+        for key, tensor in state_dict.items():
+            if not tensor.is_floating_point():
+                continue
+            update = to_dense(tensor).float().reshape(-1)
+            if self.base_state_dict is not None:
+                update = update - self.base_state_dict[key].float().reshape(-1)
+
+            layer = self.layers.setdefault(
+                key, {"l2_norm": [], "max_abs_change": [], "sketches": []}
+            )
+            layer["l2_norm"].append(update.double().norm().item())
+            layer["max_abs_change"].append(
+                update.abs().max().item() if update.numel() else 0.0
+            )
+            if update.numel() <= self.sketch_size:
+                layer["sketches"].append(update.double())
+            else:
+                layer["sketches"].append(
+                    count_sketch(update, self.sketch_size, zlib.crc32(key.encode()))
+                )
+
+    def report(self):
+        """Get the diagnostics of every silo.
+
+        Returns:
+            dict: {"sketch_size": int, "silos": [{"name", "path", "weight", "l2_norm",
+                "cosine_to_mean", "max_abs_change", "layers": {key: {metric: value}}}]}
+        """
+        num_silos = len(self.silos)
+        weights = torch.tensor(self.weights, dtype=torch.float64)
+        weights = weights / weights.sum()
+
+        silos = [
+            {"name": name, "path": path, "weight": weight, "layers": {}}
+            for name, path, weight in zip(self.silos, self.paths, self.weights)
+        ]
+        # whole model inner products: <u_i, m>, |u_i|^2 and |m|^2 (sketched)
+        total_dot = torch.zeros(num_silos, dtype=torch.float64)
+        total_squared_norms = torch.zeros(num_silos, dtype=torch.float64)
+        total_mean_squared_norm = 0.0
+        for key, layer in self.layers.items():
+            stacked = torch.stack(layer["sketches"], 0)
+            gram = stacked @ stacked.T
+            # <u_i, m> with m = sum_j w_j u_j
+            dot = gram @ weights
+            squared_norms = gram.diagonal()
+            mean_squared_norm = (weights @ dot).item()
+            cosine = dot / (squared_norms * mean_squared_norm).sqrt().clamp(min=1e-30)
+
+            total_dot += dot
+            total_squared_norms += squared_norms
+            total_mean_squared_norm += mean_squared_norm
+            for index, silo in enumerate(silos):
+                silo["layers"][key] = {
+                    "l2_norm": layer["l2_norm"][index],
+                    "cosine_to_mean": cosine[index].item(),
+                    "max_abs_change": layer["max_abs_change"][index],
+                }
+
+        total_cosine = total_dot / (
+            (total_squared_norms * total_mean_squared_norm).sqrt().clamp(min=1e-30)
+        )
+        for index, silo in enumerate(silos):
+            silo["l2_norm"] = (
+                sum(layer["l2_norm"][index] ** 2 for layer in self.layers.values())
+                ** 0.5
+            )
+            silo["cosine_to_mean"] = total_cosine[index].item()
+            silo["max_abs_change"] = max(
+                [layer["max_abs_change"][index] for layer in self.layers.values()],
+                default=0.0,
+            )
+        return {"sketch_size": self.sketch_size, "silos": silos}
+
+
+def save_diagnostics(report, folder):
+    """Write the diagnostics as diagnostics.json and diagnostics.csv.
+
+    The csv has one row per silo and layer, plus one row per silo for the
+    whole model (layer "*").
+
+    Args:
+        report (dict): the diagnostics, see UpdateDiagnostics.report()
+        folder (str): output folder
+
+    Returns:
+        List[str]: paths of the written files
+    """
+    json_path = os.path.join(folder, "diagnostics.json")
+    with open(json_path, "w") as json_file:
+        json.dump(report, json_file)
+
+    csv_path = os.path.join(folder, "diagnostics.csv")
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["silo", "weight", "layer"] + DIAGNOSTICS_METRICS)
+        for silo in report["silos"]:
+            layers = [("*", silo)] + list(silo["layers"].items())
+            for layer_name, values in layers:
+                writer.writerow(
+                    [silo["name"], silo["weight"], layer_name]
+                    + [values[metric] for metric in DIAGNOSTICS_METRICS]
+                )
+    return [json_path, csv_path]
+
+
+def log_diagnostics(report, mlflow_logger, metrics_prefix, iteration_name):
+    """Log the diagnostics of every silo, for the whole model and for every layer.
+
+    Args:
+        report (dict): the diagnostics, see UpdateDiagnostics.report()
+        mlflow_logger (BatchedMlflowLogger): the logger of the aggregation run, sending the metrics in batches
+        metrics_prefix (str): prefix of the metrics keys
+        iteration_name (str): iteration of the metrics keys
+    """
+    for silo in report["silos"]:
+        prefix = f"{iteration_name}/{metrics_prefix}/{silo['name']}"
+        for metric in DIAGNOSTICS_METRICS:
+            mlflow_logger.log_metric(key=f"{prefix}/{metric}", value=silo[metric])
+        for layer_name, values in silo["layers"].items():
+            for metric in DIAGNOSTICS_METRICS:
+                mlflow_logger.log_metric(
+                    key=f"{prefix}/{layer_name}/{metric}", value=values[metric]
+                )
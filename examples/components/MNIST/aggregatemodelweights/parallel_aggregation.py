@@ -0,0 +1,131 @@
+"""Aggregation of silo state_dicts in a process pool, sharded by key.
+
+The per-key loop of the mean aggregation runs on one core. Here the keys are
+split into shards of balanced byte size, and every shard is averaged by a
+worker process. Tensors are not pickled: the silo tensors are moved to shared
+memory once, the aggregated tensors are allocated in shared memory by the
+parent process and filled in place by the workers, and only the handles of
+the shared memory segments are sent to the workers.
+
+Every key is averaged by a single worker, with the same operations and the
+same silo order as aggregate_model_weights(), and the results are merged in
+the key order of the silo state_dicts: the output does not depend on the
+number of workers, the sharding or the completion order of the shards.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.multiprocessing
+
+from update_codec import to_dense
+
+
+def shard_keys(state_dict, num_shards):
+    """Split the keys of a state_dict into shards of balanced byte size.
+
+    Keys are assigned from the largest to the smallest tensor, each to the
+    shard with the fewest bytes so far (ties broken by key name and shard
+    index, so the sharding is deterministic).
+
+    Args:
+        state_dict (dict): reference state_dict
+        num_shards (int): maximum number of shards
+
+    Returns:
+        List[List[str]]: the non-empty shards, each a list of keys
+    """
+    sizes = {
+        key: tensor.numel() * tensor.element_size()
+        for key, tensor in state_dict.items()
+    }
+    shards = [[] for _ in range(max(1, min(num_shards, len(sizes))))]
+    shard_bytes = [0] * len(shards)
+    for key in sorted(sizes, key=lambda key: (-sizes[key], key)):
+        index = min(range(len(shards)), key=lambda index: (shard_bytes[index], index))
+        shards[index].append(key)
+        shard_bytes[index] += sizes[key]
+    return [shard for shard in shards if shard]
+
+
+def _init_worker():
+    """Use a single thread per worker, the parallelism comes from the pool."""
+    torch.set_num_threads(1)
+
+
+def _aggregate_shard(shard_inputs, weights, shard_outputs):
+    """Average the keys of a shard into the shared output tensors (runs in a worker).
+
+    Args:
+        shard_inputs (List[dict]): for each silo, the tensors of the shard keys
+        weights (torch.Tensor): normalized silo weights
+        shard_outputs (dict): shared output tensor of every shard key
+    """
+    for key, output in shard_outputs.items():
+        stacked = torch.stack([inputs[key].float() for inputs in shard_inputs], 0)
+        output.copy_(torch.tensordot(weights, stacked, dims=1).to(output.dtype))
+
+
+def parallel_aggregate_model_weights(
+    client_state_dicts, weights=None, num_workers=None, mp_context=None
+):
+    """Weighted mean of silo state_dicts, computed by a process pool on shards of keys.
+
+    Gives the same result as aggregate_model_weights().
+
+    Args:
+        client_state_dicts (List[dict]): silo state_dicts with the same schema
+        weights (List[float]): silo weights (default: None for a uniform mean)
+        num_workers (int): number of worker processes (default: number of cores)
+        mp_context (str): multiprocessing start method of the workers (default: fork where
+            available, as spawned workers take seconds to import torch)
+
+    Returns:
+        dict: the averaged state_dict, in the silo checkpoints dtypes
+    """
+    reference = client_state_dicts[0]
+    if weights is None:
+        weights = [1.0] * len(client_state_dicts)
+    weights = torch.tensor(weights, dtype=torch.float32)
+    weights = weights / weights.sum()
+    num_workers = num_workers or os.cpu_count() or 1
+    if mp_context is None:
+        mp_context = (
+            "fork"
+            if "fork" in torch.multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+
+    # silo tensors are moved to shared memory once (sparse updates are densified first)
+    shared_state_dicts = [
+        {key: to_dense(tensor).share_memory_() for key, tensor in state_dict.items()}
+        for state_dict in client_state_dicts
+    ]
+    aggregated_state_dict = {
+        key: torch.empty(tensor.shape, dtype=tensor.dtype).share_memory_()
+        for key, tensor in reference.items()
+    }
+
+    shards = shard_keys(reference, num_workers)
+    with ProcessPoolExecutor(
+        max_workers=len(shards),
+        mp_context=torch.multiprocessing.get_context(mp_context),
+        initializer=_init_worker,
+    ) as executor:
+        futures = [
+            executor.submit(
+                _aggregate_shard,
+                [
+                    {key: state_dict[key] for key in shard}
+                    for state_dict in shared_state_dicts
+                ],
+                weights,
+                {key: aggregated_state_dict[key] for key in shard},
+            )
+            for shard in shards
+        ]
+        for future in futures:
+            # raises the exception of a failed shard, if any
+            future.result()
+
+    return aggregated_state_dict
@@ -0,0 +1,194 @@
+"""Byzantine-robust aggregation of silo state_dicts (or updates).
+
+Every method works on the silo checkpoints stacked along a silo axis, one
+parameter chunk at a time: for each key, at most chunk_size entries of every
+silo are stacked into a [num_silos, chunk_size] tensor, so peak memory is
+num_silos * chunk_size values on top of the loaded checkpoints (which are only
+paged in chunk by chunk when they are memory-mapped, see model_io).
+
+Methods:
+- median: coordinate-wise median (mean of the two middle values for an even
+  number of silos),
+- trimmed_mean: coordinate-wise mean after dropping the trim_ratio largest and
+  smallest values,
+- krum / multi_krum: select the silo(s) closest to their num_silos - f - 2
+  nearest neighbours (Blanchard et al., 2017) and average them, using a
+  pairwise distance matrix accumulated chunk by chunk.
+"""
+import torch
+
+from update_codec import to_dense
+
+ROBUST_AGGREGATION_METHODS = ["median", "trimmed_mean", "krum", "multi_krum"]
+
+
+def iter_stacked_chunks(state_dicts, key, chunk_size):
+    """Stack a key of every state_dict along a silo axis, one chunk at a time.
+
+    Args:
+        state_dicts (List[dict]): silo state_dicts with the same schema
+        key (str): key to stack
+        chunk_size (int): maximum number of entries per silo in a chunk
+
+    Yields:
+        (int, int, torch.Tensor): start and end of the chunk in the flattened
+            tensor, and the float32 chunk of shape [num_silos, end - start]
+    """
+    flat_tensors = [to_dense(state_dict[key]).reshape(-1) for state_dict in state_dicts]
+    numel = flat_tensors[0].numel()
+    for start in range(0, numel, chunk_size):
+        end = min(start + chunk_size, numel)
+        yield start, end, torch.stack(
+            [flat[start:end].float() for flat in flat_tensors], 0
+        )
+
+
+def coordinate_median(stacked):
+    """Coordinate-wise median over the silo axis (dim 0) of a chunk."""
+    num_silos = stacked.shape[0]
+    if num_silos % 2 == 1:
+        return stacked.median(dim=0).values
+    ordered = stacked.sort(dim=0).values
+    return (ordered[num_silos // 2 - 1] + ordered[num_silos // 2]) / 2.0
+
+
+def trimmed_mean(stacked, trim_ratio):
+    """Coordinate-wise mean over the silo axis (dim 0) of a chunk, without the extreme values.
+
+    Args:
+        stacked (torch.Tensor): chunk of shape [num_silos, chunk]
+        trim_ratio (float): fraction of silos dropped on each side, in [0, 0.5[
+
+    Returns:
+        torch.Tensor: the trimmed mean, of shape [chunk]
+    """
+    num_silos = stacked.shape[0]
+    num_trimmed = int(trim_ratio * num_silos)
+    if num_trimmed == 0:
+        return stacked.mean(dim=0)
+    ordered = stacked.sort(dim=0).values
+    return ordered[num_trimmed : num_silos - num_trimmed].mean(dim=0)
+
+
+def pairwise_squared_distances(state_dicts, chunk_size):
+    """Squared euclidean distances between all pairs of silos, over all floating point keys.
+
+    Args:
+        state_dicts (List[dict]): silo state_dicts with the same schema
+        chunk_size (int): maximum number of entries per silo in a chunk
+
+    Returns:
+        torch.Tensor: float64 matrix of shape [num_silos, num_silos]
+    """
+    num_silos = len(state_dicts)
+    distances = torch.zeros(num_silos, num_silos, dtype=torch.float64)
+    for key, tensor in state_dicts[0].items():
+        if not tensor.is_floating_point():
+            continue
+        for _, _, stacked in iter_stacked_chunks(state_dicts, key, chunk_size):
+            # ||x_i - x_j||^2 = ||x_i||^2 + ||x_j||^2 - 2 <x_i, x_j>, batched as a gram matrix
+            stacked = stacked.double()
+            gram = stacked @ stacked.T
+            squared_norms = gram.diagonal()
+            distances += squared_norms[:, None] + squared_norms[None, :] - 2.0 * gram
+    return distances.clamp_(min=0.0)
+
+
+def krum_select(distances, num_byzantine, num_selected=1):
+    """Select the silos with the lowest Krum score.
+
+    The score of a silo is the sum of its squared distances to its
+    num_silos - num_byzantine - 2 nearest neighbours.
+
+    Args:
+        distances (torch.Tensor): pairwise squared distances, see pairwise_squared_distances()
+        num_byzantine (int): number of byzantine silos to tolerate (f)
+        num_selected (int): number of silos to select (1 for krum, m for multi-krum)
+
+    Returns:
+        List[int]: indices of the selected silos, best first
+    """
+    num_silos = distances.shape[0]
+    num_neighbours = num_silos - num_byzantine - 2
+    if num_neighbours < 1:
+        raise ValueError(
+            f"Krum requires more than 2 * f + 2 silos, got {num_silos} silos for f={num_byzantine}"
+        )
+    if not 1 <= num_selected <= num_silos:
+        raise ValueError(
+            f"Multi-krum can select between 1 and {num_silos} silos, got {num_selected}"
+        )
+    # exclude the distance of every silo to itself
+    masked = distances + torch.diag(
+        torch.full((num_silos,), float("inf"), dtype=distances.dtype)
+    )
+    scores = masked.topk(num_neighbours, dim=1, largest=False).values.sum(dim=1)
+    return scores.argsort()[:num_selected].tolist()
+
+
+def robust_aggregate_model_weights(
+    client_state_dicts,
+    method,
+    weights=None,
+    trim_ratio=0.1,
+    num_byzantine=1,
+    num_selected=None,
+    chunk_size=2**20,
+):
+    """Aggregate silo state_dicts (or updates) with a Byzantine-robust method.
+
+    Args:
+        client_state_dicts (List[dict]): silo state_dicts with the same schema
+        method (str): median, trimmed_mean, krum or multi_krum
+        weights (List[float]): silo weights, only used to average the silos selected by krum/multi_krum
+        trim_ratio (float): fraction of silos dropped on each side (trimmed_mean)
+        num_byzantine (int): number of byzantine silos to tolerate (krum, multi_krum)
+        num_selected (int): number of silos averaged by multi_krum (default: num_silos - num_byzantine)
+        chunk_size (int): maximum number of entries per silo processed at once
+
+    Returns:
+        dict: the aggregated state_dict, in the silo checkpoints dtypes
+        List[int]: indices of the silos that were aggregated (all of them for median and trimmed_mean)
+    """
+    if method not in ROBUST_AGGREGATION_METHODS:
+        raise ValueError(
+            f"Unknown robust aggregation method {method}, use one of {ROBUST_AGGREGATION_METHODS}"
+        )
+    if not 0.0 <= trim_ratio < 0.5:
+        raise ValueError(f"trim_ratio should be in [0, 0.5[, got {trim_ratio}")
+
+    num_silos = len(client_state_dicts)
+    if weights is None:
+        weights = [1.0] * num_silos
+    selected = list(range(num_silos))
+
+    if method in ["krum", "multi_krum"]:
+        if method == "krum":
+            num_selected = 1
+        elif num_selected is None:
+            num_selected = num_silos - num_byzantine
+        distances = pairwise_squared_distances(client_state_dicts, chunk_size)
+        selected = krum_select(distances, num_byzantine, num_selected)
+        client_state_dicts = [client_state_dicts[index] for index in selected]
+        weights = [weights[index] for index in selected]
+
+    silo_weights = torch.tensor(weights, dtype=torch.float32)
+    silo_weights = silo_weights / silo_weights.sum()
+
+    aggregated_state_dict = {}
+    for key, reference in client_state_dicts[0].items():
+        aggregated = torch.empty(reference.numel(), dtype=torch.float32)
+        for start, end, stacked in iter_stacked_chunks(
+            client_state_dicts, key, chunk_size
+        ):
+            if method == "median":
+                aggregated[start:end] = coordinate_median(stacked)
+            elif method == "trimmed_mean":
+                aggregated[start:end] = trimmed_mean(stacked, trim_ratio)
+            else:
+                aggregated[start:end] = torch.tensordot(silo_weights, stacked, dims=1)
+        aggregated_state_dict[key] = aggregated.reshape(reference.shape).to(
+            reference.dtype
+        )
+
+    return aggregated_state_dict, selected
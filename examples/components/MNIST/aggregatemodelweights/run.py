@@ -2,10 +2,48 @@ import os
 import argparse
 import logging
 import sys
+import json
+import collections
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
+import mlflow
+import numpy as np
 import torch
-from torch import nn
-from torchvision import models
+
+from batched_logger import BatchedMlflowLogger
+from model_io import (
+    CHECKPOINT_FORMATS,
+    ChunkStore,
+    find_checkpoint,
+    get_chunk_store,
+    load_checkpoint,
+    save_checkpoint,
+    set_chunk_store,
+)
+from update_codec import compute_update, decode_update, encode_update, to_dense
+from server_optimizer import SERVER_OPTIMIZERS, ServerOptimizer
+from diagnostics import UpdateDiagnostics, log_diagnostics, save_diagnostics
+from parallel_aggregation import parallel_aggregate_model_weights
+from secure_aggregation import unmask_sum
+from robust_aggregation import (
+    ROBUST_AGGREGATION_METHODS,
+    robust_aggregate_model_weights,
+)
+
+# precision available for the streaming aggregation accumulator
+ACCUMULATOR_DTYPES = {"float32": torch.float32, "float64": torch.float64}
+
+# key of the silo metadata sidecar used for each weighting method
+WEIGHTING_METADATA_KEYS = {
+    "samples": "num_samples",
+    "steps": "num_steps",
+    "custom": "weight",
+}
+
+# metadata of the inputs summed up in the metadata of a partial aggregation
+PARTIAL_METADATA_KEYS = ["num_silos", "num_samples", "num_steps", "weight"]
 
 
 def get_arg_parser(parser=None):
@@ -25,98 +63,1198 @@ def get_arg_parser(parser=None):
     if parser is None:
         parser = argparse.ArgumentParser(description=__doc__)
 
-    parser.add_argument("--input_silo_1", type=str, required=True, help="")
-    parser.add_argument("--input_silo_2", type=str, required=False, help="")
-    parser.add_argument("--input_silo_3", type=str, required=False, help="")
+    parser.add_argument(
+        "--input_silo",
+        "--input_silo_1",
+        "--input_silo_2",
+        "--input_silo_3",
+        dest="input_silos",
+        type=str,
+        required=False,
+        action="append",
+        default=[],
+        help="Silo model folder, can be repeated for any number of silos",
+    )
+    parser.add_argument(
+        "--input_silos_folder",
+        type=str,
+        required=False,
+        help="Folder containing one subfolder per silo model",
+    )
+    parser.add_argument(
+        "--max_loader_threads",
+        type=int,
+        required=False,
+        default=8,
+        help="Maximum number of silo checkpoints loaded concurrently",
+    )
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        required=False,
+        choices=CHECKPOINT_FORMATS,
+        default="torch",
+        help="Format of the aggregated checkpoint: torch (model.pt), mmap (model.tensors, memory-mapped flat file) or chunked (model.manifest.json, chunks in --chunk_store)",
+    )
+    parser.add_argument(
+        "--chunk_store",
+        type=str,
+        required=False,
+        default=None,
+        help="Root folder of the content-addressed chunk store shared by all the steps, required to read or write chunked checkpoints",
+    )
+    parser.add_argument(
+        "--chunk_cache",
+        type=str,
+        required=False,
+        default=None,
+        help="Local folder keeping a copy of the chunks read from the chunk store, so that they are not read again",
+    )
+    parser.add_argument(
+        "--base_checkpoint",
+        type=str,
+        required=False,
+        help="Global model the silos started from, required when silos send updates instead of models",
+    )
     parser.add_argument("--aggregated_output", type=str, required=True, help="")
+    parser.add_argument(
+        "--min_silos",
+        type=int,
+        required=False,
+        default=None,
+        help="Quorum: skip the missing or invalid silo checkpoints as long as at least this number of silos are aggregated (default: all silos are required). With 0 and aggregation_output=partial, a group whose silos are all skipped writes an empty partial aggregation, skipped by the next aggregation",
+    )
+    parser.add_argument(
+        "--aggregation_output",
+        type=str,
+        required=False,
+        choices=["model", "partial"],
+        default="model",
+        help="model: the new global model, partial: the mean of the inputs and their summed weights, to be aggregated again (aggregation tree)",
+    )
+    parser.add_argument(
+        "--aggregation_mode",
+        type=str,
+        required=False,
+        choices=["stack", "streaming", "parallel"],
+        default="streaming",
+        help="stack: load all silo models and average them at once, streaming: fold one silo checkpoint at a time into a running mean, parallel: like stack, with the keys sharded across a process pool",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of worker processes of aggregation_mode=parallel (default: number of cores)",
+    )
+    parser.add_argument(
+        "--diagnostics",
+        type=str,
+        required=False,
+        choices=["off", "on"],
+        default="off",
+        help="on: compute per-silo update diagnostics (L2 norm, cosine to the mean update, max abs change) during the aggregation, saved in the output and logged to MLflow",
+    )
+    parser.add_argument(
+        "--diagnostics_sketch_size",
+        type=int,
+        required=False,
+        default=2**16,
+        help="Layers larger than this are sketched to this number of entries to compute the cosine similarities",
+    )
+    parser.add_argument(
+        "--metrics_prefix",
+        type=str,
+        required=False,
+        default="aggregation",
+        help="Metrics prefix of the diagnostics",
+    )
+    parser.add_argument(
+        "--iteration_name",
+        type=str,
+        required=False,
+        default="default-iteration",
+        help="Iteration name of the diagnostics metrics",
+    )
+    parser.add_argument(
+        "--secagg_recovery",
+        type=str,
+        required=False,
+        help="Secure aggregation: folder of the json files of the seeds and shares revealed by the surviving silos, required to remove the masks (see secure_aggregation.py reveal)",
+    )
+    parser.add_argument(
+        "--aggregation_method",
+        type=str,
+        required=False,
+        choices=["mean"] + ROBUST_AGGREGATION_METHODS,
+        default="mean",
+        help="mean, or a Byzantine-robust method (median, trimmed_mean, krum, multi_krum) which loads all silos at once",
+    )
+    parser.add_argument(
+        "--trim_ratio",
+        type=float,
+        required=False,
+        default=0.1,
+        help="Fraction of the silos dropped on each side of every coordinate (trimmed_mean)",
+    )
+    parser.add_argument(
+        "--num_byzantine",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of byzantine silos to tolerate (krum, multi_krum)",
+    )
+    parser.add_argument(
+        "--multi_krum_selected",
+        type=int,
+        required=False,
+        default=None,
+        help="Number of silos averaged by multi_krum (default: number of silos - num_byzantine)",
+    )
+    parser.add_argument(
+        "--robust_chunk_size",
+        type=int,
+        required=False,
+        default=2**20,
+        help="Number of parameters of every silo processed at once by the robust methods",
+    )
+    parser.add_argument(
+        "--accumulator_dtype",
+        type=str,
+        required=False,
+        choices=list(ACCUMULATOR_DTYPES.keys()),
+        default="float32",
+        help="Precision of the running mean accumulator in streaming mode",
+    )
+    parser.add_argument(
+        "--weighting",
+        type=str,
+        required=False,
+        choices=["uniform"] + list(WEIGHTING_METADATA_KEYS.keys()),
+        default="uniform",
+        help="How to weight each silo in the mean, based on the metadata.json written by the training",
+    )
+    parser.add_argument(
+        "--server_optimizer",
+        type=str,
+        required=False,
+        choices=SERVER_OPTIMIZERS,
+        default=None,
+        help="Apply the mean silo update to --base_checkpoint with a server optimizer (default: replace the global model with the mean)",
+    )
+    parser.add_argument(
+        "--server_lr",
+        type=float,
+        required=False,
+        default=1.0,
+        help="Server learning rate",
+    )
+    parser.add_argument(
+        "--server_beta1",
+        type=float,
+        required=False,
+        default=0.9,
+        help="Server momentum (fedavgm) or first moment decay (fedadam, fedyogi)",
+    )
+    parser.add_argument(
+        "--server_beta2",
+        type=float,
+        required=False,
+        default=0.99,
+        help="Server second moment decay (fedadam, fedyogi)",
+    )
+    parser.add_argument(
+        "--server_epsilon",
+        type=float,
+        required=False,
+        default=1e-3,
+        help="Server adaptivity degree (fedadam, fedyogi)",
+    )
     return parser
 
 
-def aggregate_model_weights(global_model, client_models):
+def load_state_dict(model_path):
+    """Load a silo checkpoint as a raw state_dict, without any model class.
+
+    Checkpoints in mmap format are memory-mapped, so each tensor is only read
+    from storage when the aggregation actually uses it.
+
+    Args:
+        model_path (str): model folder containing a model.pt or model.tensors
+
+    Returns:
+        dict: the state_dict (str -> torch.Tensor), on cpu
+    """
+    state_dict = load_checkpoint(model_path)
+    if not isinstance(state_dict, dict) or not all(
+        isinstance(v, torch.Tensor) for v in state_dict.values()
+    ):
+        raise ValueError(
+            f"Checkpoint in {model_path} is not a state_dict of tensors (type={type(state_dict)})"
+        )
+    return state_dict
+
+
+def load_valid_state_dict(model_path, load_fn=load_state_dict):
+    """Load a silo checkpoint, or return None if it can not be aggregated.
+
+    Used for quorum aggregation (see --min_silos): a silo whose checkpoint is
+    missing, unreadable, does not match the base checkpoint or contains
+    non-finite values is skipped instead of failing the aggregation.
+
+    Args:
+        model_path (str): silo model folder
+        load_fn (Callable): function loading a state_dict (or an update) from a silo model folder
+
+    Returns:
+        dict: the state_dict (str -> torch.Tensor), or None if the silo should be skipped
+    """
+    try:
+        state_dict = load_fn(model_path)
+    except Exception as e:
+        logger.warning(f"Skipping silo {model_path}, invalid checkpoint: {e}")
+        return None
+
+    non_finite_keys = [
+        k
+        for k, v in state_dict.items()
+        if v.is_floating_point()
+        and not torch.isfinite(v.coalesce().values() if v.is_sparse else v).all()
+    ]
+    if non_finite_keys:
+        logger.warning(
+            f"Skipping silo {model_path}, non-finite values in {non_finite_keys}"
+        )
+        return None
+    return state_dict
+
+
+def validate_state_dict_schema(reference, state_dict, name):
+    """Verify a state_dict has the same keys, shapes and dtypes as a reference.
+
+    Args:
+        reference (dict): reference state_dict (e.g. the first silo)
+        state_dict (dict): state_dict to validate
+        name (str): name of the checkpoint to validate, used in error messages
+
+    Raises:
+        ValueError: if the schemas differ
+    """
+    errors = []
+    missing_keys = [k for k in reference.keys() if k not in state_dict]
+    unexpected_keys = [k for k in state_dict.keys() if k not in reference]
+    if missing_keys:
+        errors.append(f"missing keys {missing_keys}")
+    if unexpected_keys:
+        errors.append(f"unexpected keys {unexpected_keys}")
+
+    for k in reference.keys():
+        if k not in state_dict:
+            continue
+        if state_dict[k].shape != reference[k].shape:
+            errors.append(
+                f"key {k} has shape {tuple(state_dict[k].shape)} instead of {tuple(reference[k].shape)}"
+            )
+        if state_dict[k].dtype != reference[k].dtype:
+            errors.append(
+                f"key {k} has dtype {state_dict[k].dtype} instead of {reference[k].dtype}"
+            )
+
+    if errors:
+        raise ValueError(
+            f"Checkpoint {name} does not match the reference schema: "
+            + "; ".join(errors)
+        )
+
+
+def aggregate_model_weights(client_state_dicts, weights=None):
     """
     This function has aggregation method 'mean'
 
     Args:
-    global_model: aggregated model that is saved for each iteration
-    client_models: list of client models
+    client_state_dicts: list of client state_dicts
+    weights: list of silo weights (default: None for a uniform mean)
+
+    Returns:
+    aggregated_state_dict: the averaged state_dict, in the silo checkpoints dtypes
     """
-    global_dict = global_model.state_dict()
+    reference = client_state_dicts[0]
+    if weights is None:
+        weights = [1.0] * len(client_state_dicts)
+    weights = torch.tensor(weights, dtype=torch.float32)
+    weights = weights / weights.sum()
 
-    for k in global_dict.keys():
-        global_dict[k] = torch.stack(
-            [
-                client_models[i].state_dict()[k].float()
-                for i in range(len(client_models))
-            ],
+    aggregated_state_dict = {}
+    for k in reference.keys():
+        stacked = torch.stack(
+            [to_dense(state_dict[k]).float() for state_dict in client_state_dicts],
             0,
-        ).mean(0)
-    global_model.load_state_dict(global_dict)
+        )
+        aggregated_state_dict[k] = torch.tensordot(weights, stacked, dims=1).to(
+            reference[k].dtype
+        )
+
+    return aggregated_state_dict
+
+
+def read_metadata(model_path):
+    """Read the metadata sidecar written by the training in a silo model folder.
+
+    Args:
+        model_path (str): silo model folder
+
+    Returns:
+        dict: the metadata, or an empty dict if there is no metadata.json
+    """
+    metadata_path = os.path.join(model_path, "metadata.json")
+    if not os.path.isfile(metadata_path):
+        return {}
+    with open(metadata_path, "r") as metadata_file:
+        return json.load(metadata_file)
+
+
+def is_update(model_path):
+    """Tell if a silo sent an update (difference with the base checkpoint) instead of a model."""
+    return find_checkpoint(model_path, name="update")[0] is not None
+
+
+def load_silo_update(model_path, base_state_dict):
+    """Load what a silo sent as an update relative to the base checkpoint.
+
+    Args:
+        model_path (str): silo model folder, containing either an encoded update or a model
+        base_state_dict (dict): the global model the silos started from
+
+    Returns:
+        dict: the decoded update (str -> torch.Tensor), in the base checkpoint dtypes
+    """
+    if is_update(model_path):
+        update_spec = read_metadata(model_path).get("update")
+        if update_spec is None:
+            raise ValueError(
+                f"Silo {model_path} sent an update without its encoding spec in metadata.json"
+            )
+        update = decode_update(
+            load_checkpoint(model_path, name="update"), update_spec["tensors"]
+        )
+    else:
+        update = compute_update(load_state_dict(model_path), base_state_dict)
+
+    validate_state_dict_schema(base_state_dict, update, model_path)
+    return update
+
+
+def apply_update(base_state_dict, update):
+    """Add an aggregated update to the base checkpoint.
+
+    Args:
+        base_state_dict (dict): the global model the silos started from
+        update (dict): the aggregated update
+
+    Returns:
+        dict: the new global state_dict, in the base checkpoint dtypes
+    """
+    return {
+        k: (base_state_dict[k] + update[k]).to(base_state_dict[k].dtype)
+        for k in base_state_dict.keys()
+    }
+
 
-    return global_model
+def load_server_optimizer_state(checkpoint_path):
+    """Load the server optimizer state saved next to a global model, if any.
 
+    Args:
+        checkpoint_path (str): global model folder written by a previous aggregation
+
+    Returns:
+        dict: the optimizer state (str -> torch.Tensor), or None if there is none
+    """
+    if find_checkpoint(checkpoint_path, name="server_optimizer")[0] is None:
+        logger.info(f"No server optimizer state found in {checkpoint_path}")
+        return None
+    return load_checkpoint(checkpoint_path, name="server_optimizer")
+
+
+def iter_state_dicts(model_paths, max_workers=1, load_fn=load_state_dict):
+    """Load checkpoints on a bounded thread pool and yield them in order.
+
+    At most max_workers checkpoints are being loaded (or waiting to be consumed)
+    at any time, so mount latency overlaps while memory stays bounded.
+
+    Args:
+        model_paths (List[str]): list of model folders
+        max_workers (int): number of checkpoints loaded concurrently
+        load_fn (Callable): function loading a state_dict from a model folder
+
+    Yields:
+        (str, dict): model folder and its state_dict, in the order of model_paths
+    """
+    paths = iter(model_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, executor.submit(load_fn, path)))
+            if len(pending) >= max_workers:
+                break
+
+        while pending:
+            path, future = pending.popleft()
+            state_dict = future.result()
+
+            # schedule the next load before handing over this checkpoint
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(load_fn, next_path)))
+
+            yield path, state_dict
 
-def get_model(model_path):
-    """Get the model having custom input dimensions.
 
-    model_path: Pretrained model weights file path
+def streaming_aggregate_model_weights(
+    model_paths,
+    accumulator_dtype=torch.float32,
+    weights=None,
+    max_workers=1,
+    load_fn=load_state_dict,
+    min_silos=None,
+    diagnostics=None,
+):
     """
-    model = models.resnet18(pretrained=True)
-    model.conv1 = nn.Conv2d(
-        1, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), bias=False
+    This function has aggregation method 'mean', computed as a running mean.
+
+    Silo checkpoints are folded one at a time into an accumulator, so peak memory
+    stays around (max_workers + 1) model copies whatever the number of silos.
+
+    Args:
+    model_paths: list of silo model folders (each containing a checkpoint)
+    accumulator_dtype: torch dtype of the running mean accumulator
+    weights: list of silo weights (default: None for a uniform mean)
+    max_workers: number of checkpoints loaded concurrently
+    load_fn: function loading a state_dict (or an update) from a silo model folder
+    min_silos: if set, skip the invalid silos (see load_valid_state_dict()) as long as at least min_silos are aggregated
+    diagnostics: if set, an UpdateDiagnostics collecting the diagnostics of every silo aggregated
+
+    Returns:
+    aggregated_state_dict: the averaged state_dict, in the silo checkpoints dtypes
+    aggregated_paths: the silo model folders aggregated
+    """
+    accumulator = None
+    reference = None
+    total_weight = 0.0
+    aggregated_paths = []
+    if weights is None:
+        weights = [1.0] * len(model_paths)
+    if min_silos is not None:
+        load_fn = functools.partial(load_valid_state_dict, load_fn=load_fn)
+
+    for count, ((model_path, state_dict), weight) in enumerate(
+        zip(iter_state_dicts(model_paths, max_workers, load_fn), weights), start=1
+    ):
+        logger.debug(f"Folding checkpoint {count}/{len(model_paths)}: {model_path}")
+
+        if state_dict is None:
+            # skipped silo: the mean is over the weights of the aggregated silos only
+            continue
+        if min_silos is not None and reference is not None:
+            try:
+                validate_state_dict_schema(reference, state_dict, model_path)
+            except ValueError as e:
+                logger.warning(f"Skipping silo {model_path}: {e}")
+                continue
+
+        total_weight += weight
+        aggregated_paths.append(model_path)
+        if diagnostics is not None:
+            # before folding, which modifies the state_dict in place
+            diagnostics.add(model_path, state_dict, weight)
+
+        if accumulator is None:
+            # keep only the schema (shapes, dtypes) of the first checkpoint
+            reference = {
+                k: torch.empty_like(v, device="meta") for k, v in state_dict.items()
+            }
+            accumulator = {
+                k: to_dense(v).to(accumulator_dtype, copy=True)
+                for k, v in state_dict.items()
+            }
+        else:
+            validate_state_dict_schema(reference, state_dict, model_path)
+            alpha = weight / total_weight
+            for k in accumulator.keys():
+                value = state_dict[k].to(accumulator_dtype)
+                if value.is_sparse:
+                    # sparse updates (top-k) are added without being densified
+                    accumulator[k].mul_(1.0 - alpha).add_(value, alpha=alpha)
+                else:
+                    # weighted running mean: acc += (x - acc) * weight / total_weight
+                    accumulator[k].add_(value.sub_(accumulator[k]), alpha=alpha)
+
+        # release the silo checkpoint before loading the next one
+        del state_dict
+
+    check_quorum(aggregated_paths, model_paths, min_silos)
+    return {
+        k: v.to(reference[k].dtype) for k, v in accumulator.items()
+    }, aggregated_paths
+
+
+def is_masked(model_path):
+    """Tell if a silo sent a model (or update) masked for secure aggregation."""
+    return find_checkpoint(model_path, name="masked")[0] is not None
+
+
+def load_masked_state_dict(model_path):
+    """Load the masked tensors (int32) and the tensors sent in the clear by a silo.
+
+    Args:
+        model_path (str): silo model folder
+
+    Returns:
+        dict: the masked and plain tensors (str -> torch.Tensor)
+    """
+    if "secure_aggregation" not in read_metadata(model_path):
+        raise ValueError(
+            f"Silo {model_path} sent a masked checkpoint without its spec in metadata.json"
+        )
+    state_dict = dict(load_checkpoint(model_path, name="masked"))
+    if find_checkpoint(model_path, name="plain")[0] is not None:
+        state_dict.update(load_checkpoint(model_path, name="plain"))
+    return state_dict
+
+
+def load_reveals(recovery_folder, round_name):
+    """Load what the surviving silos revealed for a round.
+
+    Args:
+        recovery_folder (str): folder of the json files written by the surviving silos (see secure_aggregation.reveal())
+        round_name (str): the round being aggregated
+
+    Returns:
+        List[dict]: the reveals of the round
+    """
+    reveals = []
+    if not recovery_folder:
+        return reveals
+    for entry in sorted(os.listdir(recovery_folder)):
+        if not entry.endswith(".json"):
+            continue
+        with open(os.path.join(recovery_folder, entry), "r") as seeds_file:
+            revealed = json.load(seeds_file)
+        if revealed.get("round") == round_name:
+            reveals.append(revealed)
+    return reveals
+
+
+def secure_aggregate_model_weights(
+    model_paths, max_workers=1, min_silos=None, recovery_folder=None
+):
+    """Mean of silo models (or updates) masked for secure aggregation.
+
+    The masked tensors are summed in Z_2^32 one silo at a time, then the
+    self-masks of the surviving silos and the pair masks of the dropped silos
+    are removed (see secure_aggregation.unmask_sum()) and the sum is decoded:
+    no silo model is ever unmasked on its own.
+
+    Args:
+        model_paths (List[str]): silo model folders
+        max_workers (int): number of checkpoints loaded concurrently
+        min_silos (int): if set, skip the invalid silos as long as at least min_silos are aggregated
+        recovery_folder (str): folder of the seeds and shares revealed by the surviving silos
+
+    Returns:
+        dict: the averaged state_dict (or update)
+        List[str]: the silo model folders aggregated
+        dict: the secure aggregation spec of the silos (content, round...)
+    """
+    load_fn = load_masked_state_dict
+    if min_silos is not None:
+        load_fn = functools.partial(load_valid_state_dict, load_fn=load_fn)
+
+    spec = None
+    masked_sum = {}
+    plain_sum = {}
+    plain_dtypes = {}
+    survivors = []
+    aggregated_paths = []
+    for model_path, state_dict in iter_state_dicts(model_paths, max_workers, load_fn):
+        if state_dict is None:
+            continue
+        silo_spec = read_metadata(model_path)["secure_aggregation"]
+        if spec is None:
+            spec = silo_spec
+        mismatch = [
+            key
+            for key in [
+                "round",
+                "num_silos",
+                "precision_bits",
+                "content",
+                "tensors",
+                "threshold",
+            ]
+            if silo_spec[key] != spec[key]
+        ]
+        if silo_spec["silo_index"] in survivors:
+            mismatch.append("silo_index (duplicate)")
+        if mismatch:
+            message = f"Silo {model_path} does not match the secure aggregation spec of the other silos: {mismatch}"
+            if min_silos is None:
+                raise ValueError(message)
+            logger.warning(f"Skipping silo {model_path}: {message}")
+            continue
+
+        for k, v in state_dict.items():
+            if k in spec["tensors"]:
+                # uint32 arithmetic is modulo 2^32
+                masked = v.numpy().reshape(-1).view(np.uint32)
+                if k in masked_sum:
+                    masked_sum[k] += masked
+                else:
+                    masked_sum[k] = masked.copy()
+            elif k in plain_sum:
+                plain_sum[k] += v.double()
+            else:
+                plain_sum[k] = v.double()
+                plain_dtypes[k] = v.dtype
+        survivors.append(silo_spec["silo_index"])
+        aggregated_paths.append(model_path)
+        del state_dict
+
+    check_quorum(aggregated_paths, model_paths, min_silos)
+    dropped = sorted(set(range(spec["num_silos"])) - set(survivors))
+    if dropped:
+        logger.warning(f"Silos {dropped} dropped out, removing their pairwise masks")
+    summed = unmask_sum(
+        masked_sum, spec, survivors, load_reveals(recovery_folder, spec["round"])
     )
-    num_ftrs = model.fc.in_features
-    model.fc = nn.Linear(num_ftrs, 10)
-    if model_path:
-        model.load_state_dict(torch.load(model_path + "/model.pt"))
-    return model
 
+    aggregated_state_dict = dict(
+        (k, (v / len(survivors)).to(getattr(torch, spec["tensors"][k]["dtype"])))
+        for k, v in summed.items()
+    )
+    for k, v in plain_sum.items():
+        # tensors sent in the clear, e.g. batch norm counters
+        aggregated_state_dict[k] = (v / len(survivors)).to(plain_dtypes[k])
+    return aggregated_state_dict, aggregated_paths, spec
 
-def get_client_models(args):
-    """Get the list of client models.
 
-    args: an argument parser instance
+def count_silos(model_paths, skipped=False):
+    """Number of silos behind a list of inputs (a partial aggregation counts for all its silos).
+
+    Args:
+        model_paths (List[str]): silo (or partial aggregation) folders
+        skipped (bool): also count the silos skipped by the partial aggregations
+
+    Returns:
+        int: the number of silos
+    """
+    num_silos = 0
+    for model_path in model_paths:
+        try:
+            metadata = read_metadata(model_path)
+            num_silos += metadata.get("num_silos", 1)
+            if skipped:
+                num_silos += metadata.get("num_skipped_silos", 0)
+        except (OSError, ValueError):
+            # unreadable metadata, counted as a single silo
+            num_silos += 1
+    return num_silos
+
+
+class QuorumError(ValueError):
+    """Raised when too few silos could be aggregated, see check_quorum()."""
+
+
+def check_quorum(aggregated_paths, model_paths, min_silos=None):
+    """Verify enough silos were aggregated.
+
+    Args:
+        aggregated_paths (List[str]): silo (or partial aggregation) folders aggregated
+        model_paths (List[str]): silo (or partial aggregation) folders provided
+        min_silos (int): minimum number of valid silos (None: all of them)
+
+    Raises:
+        QuorumError: if the quorum is not reached
     """
-    client_models = []
-    for i in range(1, len(args.__dict__)):
-        client_model_name = "input_silo_" + str(i)
-        if client_model_name in args.__dict__:
-            client_models.append(get_model(args.__dict__[client_model_name]))
-    return client_models
+    num_aggregated = count_silos(aggregated_paths)
+    num_silos = count_silos(model_paths, skipped=True)
+    min_silos = num_silos if min_silos is None else min_silos
+    if not aggregated_paths or num_aggregated < min_silos:
+        raise QuorumError(
+            f"Only {num_aggregated}/{num_silos} silos are valid, at least {min_silos} are required"
+        )
+    logger.info(f"{num_aggregated}/{num_silos} valid silos")
 
 
-def get_global_model(args):
-    """Get the global model.
+def get_client_model_paths(args):
+    """Get the list of client model folders provided as arguments.
+
+    Silos are given either with (repeated) --input_silo, or as subfolders
+    of --input_silos_folder (sorted by name), or both.
 
     args: an argument parser instance
     """
+    client_model_paths = [path for path in args.input_silos if path]
+
+    if args.input_silos_folder:
+        client_model_paths.extend(
+            os.path.join(args.input_silos_folder, entry)
+            for entry in sorted(os.listdir(args.input_silos_folder))
+            if os.path.isdir(os.path.join(args.input_silos_folder, entry))
+        )
+
+    if not client_model_paths:
+        raise ValueError(
+            "No silo model provided, use --input_silo or --input_silos_folder."
+        )
+    return client_model_paths
+
+
+def get_silo_weight(model_path, weighting):
+    """Get the weight of a silo in the aggregation from its metadata sidecar.
+
+    Args:
+        model_path (str): silo model folder, containing a metadata.json written by the training
+        weighting (str): uniform, samples, steps or custom
+
+    Returns:
+        float: the weight of this silo
+    """
+    metadata = read_metadata(model_path)
+    if weighting == "uniform":
+        # a partial aggregation counts for all the silos it aggregated
+        return float(metadata.get("num_silos", 1))
+
+    metadata_key = WEIGHTING_METADATA_KEYS[weighting]
+    if metadata_key not in metadata:
+        raise ValueError(
+            f"weighting={weighting} requires key '{metadata_key}' in the metadata.json of silo {model_path}, found keys {list(metadata.keys())}"
+        )
+    return float(metadata[metadata_key])
+
+
+def save_partial_aggregation(
+    aggregated_state_dict,
+    client_model_paths,
+    output_path,
+    checkpoint_format,
+    is_update,
+    model_paths=None,
+):
+    """Save a partial aggregation, to be aggregated again with other silos or partial aggregations.
+
+    The metadata of the inputs are summed up (num_silos, num_samples, num_steps
+    and weight, when all inputs have them), so that the next aggregation weights
+    this partial mean by the total weight of the silos it aggregated.
+
+    Args:
+        aggregated_state_dict (dict): the mean of the inputs (models or updates)
+        client_model_paths (List[str]): the silo (or partial aggregation) folders aggregated
+        output_path (str): output folder
+        checkpoint_format (str): torch, mmap or chunked
+        is_update (bool): True if the mean is an update relative to the base checkpoint
+        model_paths (List[str]): all the folders provided, to count the silos skipped (default: client_model_paths)
+    """
+    input_metadata = [read_metadata(model_path) for model_path in client_model_paths]
+    metadata = {}
+    for key in PARTIAL_METADATA_KEYS:
+        if key == "num_silos" or all(key in entry for entry in input_metadata):
+            metadata[key] = sum(entry.get(key, 1) for entry in input_metadata)
+    # the next aggregations check their quorum over all the silos, skipped ones included
+    metadata["num_skipped_silos"] = count_silos(
+        model_paths or client_model_paths, skipped=True
+    ) - count_silos(client_model_paths)
 
-    global_model = get_model(
-        args.aggregated_output
-        if args.aggregated_output
-        and os.path.isfile(args.aggregated_output + "/model.pt")
-        else None
+    if is_update:
+        # sent without any loss as a dense update, decoded like a silo update
+        tensors, spec = encode_update(aggregated_state_dict)
+        save_checkpoint(tensors, output_path, checkpoint_format, name="update")
+        metadata["update"] = {
+            "quantization": "none",
+            "granularity": "per_tensor",
+            "tensors": spec,
+        }
+    else:
+        save_checkpoint(aggregated_state_dict, output_path, checkpoint_format)
+
+    with open(os.path.join(output_path, "metadata.json"), "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    logger.info(
+        f"Partial aggregation of {metadata['num_silos']} silos saved to {output_path}"
+    )
+
+
+def save_empty_partial_aggregation(model_paths, output_path):
+    """Save a partial aggregation without any silo, skipped by the next aggregation.
+
+    Written instead of failing when every silo of a group of the aggregation
+    tree was skipped (--min_silos 0), so that the quorum is only checked by the
+    final aggregation, over all the silos.
+
+    Args:
+        model_paths (List[str]): the silo (or partial aggregation) folders provided
+        output_path (str): output folder
+    """
+    metadata = {
+        "num_silos": 0,
+        "num_skipped_silos": count_silos(model_paths, skipped=True),
+        "no_contribution": True,
+    }
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, "metadata.json"), "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    logger.warning(
+        f"None of the {metadata['num_skipped_silos']} silos could be aggregated, empty partial aggregation saved to {output_path}"
     )
-    return global_model
 
 
-def run(args):
+def get_silo_skip_reason(model_path, weighting):
+    """Tell why a silo can not be aggregated, from its metadata.
+
+    Args:
+        model_path (str): silo model folder
+        weighting (str): uniform, samples, steps or custom
+
+    Returns:
+        str: the reason to skip the silo, None if its weight can be read
+    """
+    try:
+        metadata = read_metadata(model_path)
+        if metadata.get("failed"):
+            return "its training failed"
+        if metadata.get("no_contribution"):
+            return "none of the silos of this partial aggregation could be aggregated"
+        get_silo_weight(model_path, weighting)
+    except (OSError, ValueError) as e:
+        return str(e)
+    return None
+
+
+def get_weighted_silos(client_model_paths, weighting, min_silos):
+    """Keep the silos whose weight can be read from their metadata.
+
+    Args:
+        client_model_paths (List[str]): list of silo model folders
+        weighting (str): uniform, samples, steps or custom
+        min_silos (int): minimum number of silos to keep
+
+    Returns:
+        List[str]: the silo model folders with a valid weight
+    """
+    valid_paths = []
+    for model_path in client_model_paths:
+        skip_reason = get_silo_skip_reason(model_path, weighting)
+        if skip_reason is not None:
+            logger.warning(f"Skipping silo {model_path}: {skip_reason}")
+            continue
+        valid_paths.append(model_path)
+    check_quorum(valid_paths, client_model_paths, min_silos)
+    return valid_paths
+
+
+def get_client_state_dicts(
+    client_model_paths, max_workers=1, load_fn=load_state_dict, min_silos=None
+):
+    """Load all client checkpoints as state_dicts and validate their schema.
+
+    Args:
+        client_model_paths (List[str]): list of silo model folders
+        max_workers (int): number of checkpoints loaded concurrently
+        load_fn (Callable): function loading a state_dict (or an update) from a silo model folder
+        min_silos (int): if set, skip the invalid silos (see load_valid_state_dict()) as long as at least min_silos are left
+
+    Returns:
+        List[str]: list of the silo model folders loaded
+        List[dict]: list of client state_dicts
+    """
+    if min_silos is not None:
+        load_fn = functools.partial(load_valid_state_dict, load_fn=load_fn)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        client_state_dicts = list(executor.map(load_fn, client_model_paths))
+
+    valid_paths = []
+    valid_state_dicts = []
+    for path, state_dict in zip(client_model_paths, client_state_dicts):
+        if state_dict is None:
+            continue
+        try:
+            if valid_state_dicts:
+                validate_state_dict_schema(valid_state_dicts[0], state_dict, path)
+        except ValueError as e:
+            if min_silos is None:
+                raise
+            logger.warning(f"Skipping silo {path}: {e}")
+            continue
+        valid_paths.append(path)
+        valid_state_dicts.append(state_dict)
+
+    check_quorum(valid_paths, client_model_paths, min_silos)
+    return valid_paths, valid_state_dicts
+
+
+def get_mlflow_logger(mlflow_run):
+    """Get the logger of the metrics, sending them to the root run in the background.
+
+    Args:
+        mlflow_run (mlflow.ActiveRun): the run of this job, None if this job does not log
+
+    Returns:
+        BatchedMlflowLogger: the logger, to use as a context manager (flushed on exit)
+    """
+    if mlflow_run is None:
+        return contextlib.nullcontext()
+    # outside of a pipeline there is no root run
+    root_run_id = mlflow_run.data.tags.get("mlflow.rootRunId", mlflow_run.info.run_id)
+    return BatchedMlflowLogger(mlflow.tracking.client.MlflowClient(), root_run_id)
+
+
+def run(args, mlflow_logger=None):
     """Run script with arguments (the core of the component).
 
     Args:
         args (argparse.namespace): command line arguments provided to script
+        mlflow_logger (BatchedMlflowLogger): if set, the logger of the diagnostics metrics
+    """
+    try:
+        aggregate(args, mlflow_logger)
+    except QuorumError:
+        # with --min_silos 0, only raised when no silo at all could be aggregated
+        if args.aggregation_output != "partial" or args.min_silos != 0:
+            raise
+        save_empty_partial_aggregation(
+            get_client_model_paths(args), args.aggregated_output
+        )
+
+
+def aggregate(args, mlflow_logger=None):
+    """Aggregate the silos given as arguments and save the result, see run().
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+        mlflow_logger (BatchedMlflowLogger): if set, the logger of the diagnostics metrics
     """
-    logger.debug("Get client models")
-    client_models = get_client_models(args)
-    logger.info(f"Total number of client models: {len(client_models)}")
+    model_paths = client_model_paths = get_client_model_paths(args)
+    silo_names = dict(
+        (model_path, f"silo_{index}")
+        for index, model_path in enumerate(client_model_paths, start=1)
+    )
+    if args.min_silos is not None:
+        # silos without a readable metadata (e.g. failed trainings) are skipped
+        client_model_paths = get_weighted_silos(
+            client_model_paths, args.weighting, args.min_silos
+        )
+    weights = [
+        get_silo_weight(model_path, args.weighting) for model_path in client_model_paths
+    ]
+    logger.info(f"Silo weights ({args.weighting}): {weights}")
+    if sum(weights) <= 0:
+        raise ValueError(f"Silo weights must sum to a positive value, got {weights}")
+
+    partial_aggregation = args.aggregation_output == "partial"
+    if partial_aggregation and args.aggregation_method != "mean":
+        raise ValueError(
+            f"aggregation_output=partial requires aggregation_method=mean, got {args.aggregation_method}"
+        )
+
+    server_optimizer = None
+    if args.server_optimizer and partial_aggregation:
+        logger.info(
+            "The server optimizer is only applied by the final aggregation (aggregation_output=model)"
+        )
+    elif args.server_optimizer:
+        if args.base_checkpoint:
+            server_optimizer = ServerOptimizer(
+                args.server_optimizer,
+                lr=args.server_lr,
+                beta1=args.server_beta1,
+                beta2=args.server_beta2,
+                epsilon=args.server_epsilon,
+            )
+        else:
+            logger.warning(
+                f"server_optimizer={args.server_optimizer} requires --base_checkpoint, silo models are only averaged (first iteration?)"
+            )
+
+    secure_aggregation = any(is_masked(path) for path in client_model_paths)
+    if secure_aggregation and (
+        args.weighting != "uniform"
+        or args.aggregation_method != "mean"
+        or partial_aggregation
+        or args.diagnostics == "on"
+    ):
+        raise ValueError(
+            "Secure aggregation only gives the uniform mean of the silos: it requires weighting=uniform, aggregation_method=mean, aggregation_output=model and diagnostics=off"
+        )
+
+    # silos may send updates relative to the base checkpoint instead of models
+    load_fn = load_state_dict
+    base_state_dict = None
+    silos_sent_updates = any(is_update(path) for path in client_model_paths)
+    if secure_aggregation:
+        # masked updates are only told apart from masked models by their metadata
+        silos_sent_updates = any(
+            read_metadata(path).get("secure_aggregation", {}).get("content") == "update"
+            for path in client_model_paths
+        )
+    if silos_sent_updates and not args.base_checkpoint:
+        raise ValueError(
+            "Some silos sent updates instead of models, --base_checkpoint is required to apply them."
+        )
+    if silos_sent_updates or server_optimizer is not None:
+        logger.info(f"Aggregating updates relative to {args.base_checkpoint}")
+        base_state_dict = load_state_dict(args.base_checkpoint)
+        load_fn = functools.partial(load_silo_update, base_state_dict=base_state_dict)
 
-    logger.debug(f"Get global model")
-    global_model = get_global_model(args)
+    diagnostics = None
+    if args.diagnostics == "on":
+        diagnostics_base = None
+        if load_fn is load_state_dict and args.base_checkpoint:
+            # silo models, the diagnostics are computed on their difference with the base checkpoint
+            diagnostics_base = load_state_dict(args.base_checkpoint)
+        elif load_fn is load_state_dict:
+            logger.warning(
+                "No --base_checkpoint (first iteration?), the diagnostics are computed on the silo models instead of their updates"
+            )
+        diagnostics = UpdateDiagnostics(
+            diagnostics_base, args.diagnostics_sketch_size, silo_names
+        )
 
-    logger.debug("aggregate model weights")
-    global_model = aggregate_model_weights(global_model, client_models)
+    if secure_aggregation:
+        logger.debug("aggregate model weights (secure aggregation)")
+        (
+            aggregated_state_dict,
+            client_model_paths,
+            secure_aggregation_spec,
+        ) = secure_aggregate_model_weights(
+            client_model_paths,
+            max_workers=args.max_loader_threads,
+            min_silos=args.min_silos,
+            recovery_folder=args.secagg_recovery,
+        )
+        if (
+            server_optimizer is not None
+            and secure_aggregation_spec["content"] == "model"
+        ):
+            aggregated_state_dict = compute_update(
+                aggregated_state_dict, base_state_dict
+            )
+    elif args.aggregation_method != "mean":
+        logger.debug("Get client models")
+        silo_weights = dict(zip(client_model_paths, weights))
+        client_model_paths, client_state_dicts = get_client_state_dicts(
+            client_model_paths,
+            max_workers=args.max_loader_threads,
+            load_fn=load_fn,
+            min_silos=args.min_silos,
+        )
+        logger.info(f"Total number of client models: {len(client_state_dicts)}")
+        if diagnostics is not None:
+            for path, state_dict in zip(client_model_paths, client_state_dicts):
+                diagnostics.add(path, state_dict, silo_weights[path])
+
+        logger.debug(f"aggregate model weights ({args.aggregation_method})")
+        aggregated_state_dict, selected = robust_aggregate_model_weights(
+            client_state_dicts,
+            args.aggregation_method,
+            [silo_weights[path] for path in client_model_paths],
+            trim_ratio=args.trim_ratio,
+            num_byzantine=args.num_byzantine,
+            num_selected=args.multi_krum_selected,
+            chunk_size=args.robust_chunk_size,
+        )
+        client_model_paths = [client_model_paths[index] for index in selected]
+        logger.info(f"Aggregated silos: {client_model_paths}")
+    elif args.aggregation_mode == "streaming":
+        logger.info(f"Total number of client models: {len(client_model_paths)}")
+
+        logger.debug("aggregate model weights (streaming)")
+        (
+            aggregated_state_dict,
+            client_model_paths,
+        ) = streaming_aggregate_model_weights(
+            client_model_paths,
+            ACCUMULATOR_DTYPES[args.accumulator_dtype],
+            weights,
+            max_workers=args.max_loader_threads,
+            load_fn=load_fn,
+            min_silos=args.min_silos,
+            diagnostics=diagnostics,
+        )
+    else:
+        logger.debug("Get client models")
+        silo_weights = dict(zip(client_model_paths, weights))
+        client_model_paths, client_state_dicts = get_client_state_dicts(
+            client_model_paths,
+            max_workers=args.max_loader_threads,
+            load_fn=load_fn,
+            min_silos=args.min_silos,
+        )
+        logger.info(f"Total number of client models: {len(client_state_dicts)}")
+        if diagnostics is not None:
+            for path, state_dict in zip(client_model_paths, client_state_dicts):
+                diagnostics.add(path, state_dict, silo_weights[path])
+
+        if args.aggregation_mode == "parallel":
+            logger.debug("aggregate model weights (parallel)")
+            aggregated_state_dict = parallel_aggregate_model_weights(
+                client_state_dicts,
+                [silo_weights[path] for path in client_model_paths],
+                num_workers=args.num_workers,
+            )
+        else:
+            logger.debug("aggregate model weights")
+            aggregated_state_dict = aggregate_model_weights(
+                client_state_dicts, [silo_weights[path] for path in client_model_paths]
+            )
+
+    if diagnostics is not None:
+        report = diagnostics.report()
+        for silo in report["silos"]:
+            logger.info(
+                f"Diagnostics of {silo['name']} ({silo['path']}): l2_norm={silo['l2_norm']:.4g}, cosine_to_mean={silo['cosine_to_mean']:.4f}, max_abs_change={silo['max_abs_change']:.4g}"
+            )
+        os.makedirs(args.aggregated_output, exist_ok=True)
+        logger.info(
+            f"Diagnostics saved to {save_diagnostics(report, args.aggregated_output)}"
+        )
+        if mlflow_logger is not None:
+            log_diagnostics(
+                report, mlflow_logger, args.metrics_prefix, args.iteration_name
+            )
+
+    if partial_aggregation:
+        save_partial_aggregation(
+            aggregated_state_dict,
+            client_model_paths,
+            args.aggregated_output,
+            args.checkpoint_format,
+            is_update=silos_sent_updates,
+            model_paths=model_paths,
+        )
+        return
+
+    if server_optimizer is not None:
+        logger.debug(f"apply aggregated update with {args.server_optimizer}")
+        aggregated_state_dict, server_optimizer_state = server_optimizer.step(
+            base_state_dict,
+            aggregated_state_dict,
+            load_server_optimizer_state(args.base_checkpoint),
+        )
+        # saved with the model so that the next iteration finds it in its base checkpoint
+        if server_optimizer_state:
+            save_checkpoint(
+                server_optimizer_state,
+                args.aggregated_output,
+                args.checkpoint_format,
+                name="server_optimizer",
+            )
+    elif silos_sent_updates:
+        logger.debug("apply aggregated update to base checkpoint")
+        aggregated_state_dict = apply_update(base_state_dict, aggregated_state_dict)
 
     logger.info("Saving model weights")
-    torch.save(global_model.state_dict(), args.aggregated_output + "/model.pt")
+    save_checkpoint(
+        aggregated_state_dict, args.aggregated_output, args.checkpoint_format
+    )
 
 
 def main(cli_args=None):
@@ -134,7 +1272,19 @@ def main(cli_args=None):
     args = parser.parse_args(cli_args)
 
     print(f"Running script with arguments: {args}")
-    run(args)
+    if args.chunk_store:
+        set_chunk_store(ChunkStore(args.chunk_store, cache_folder=args.chunk_cache))
+    # only the diagnostics are logged, in batches, to the run of this job
+    with (
+        mlflow.start_run() if args.diagnostics == "on" else contextlib.nullcontext()
+    ) as mlflow_run, get_mlflow_logger(mlflow_run) as mlflow_logger:
+        run(args, mlflow_logger)
+    if mlflow_logger is not None:
+        for error in mlflow_logger.errors:
+            logger.warning(f"Logging to mlflow failed ({error})")
+        logger.debug(f"Mlflow log_batch requests: {mlflow_logger.num_requests}")
+    if args.chunk_store:
+        logger.info(f"Chunk store: {get_chunk_store().stats}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+"""Server-side optimizers applied by the orchestrator to the aggregated update.
+
+The weighted mean of the silo updates (trained model - global model) is used
+as a pseudo-gradient, pointing in the descent direction, and applied to the
+global model with a server optimizer (see Reddi et al., Adaptive Federated
+Optimization, 2020):
+- fedavg: x += lr * delta (lr=1.0 is plain federated averaging),
+- fedavgm: m = beta1 * m + delta ; x += lr * m,
+- fedadam: m = beta1 * m + (1 - beta1) * delta ; v = beta2 * v + (1 - beta2) * delta^2 ;
+  x += lr * m / (sqrt(v) + epsilon),
+- fedyogi: same as fedadam, with v -= (1 - beta2) * delta^2 * sign(v - delta^2).
+
+The optimizer state (m, v) is a flat dict of tensors, saved next to the
+aggregated model so that the next iteration finds it in its base checkpoint.
+"""
+import torch
+
+SERVER_OPTIMIZERS = ["fedavg", "fedavgm", "fedadam", "fedyogi"]
+
+# suffix of the optimizer state tensors of each model key
+MOMENTUM_SUFFIX = "::m"
+VARIANCE_SUFFIX = "::v"
+
+
+class ServerOptimizer:
+    def __init__(self, optimizer="fedavg", lr=1.0, beta1=0.9, beta2=0.99, epsilon=1e-3):
+        """Server optimizer applying aggregated updates to the global model.
+
+        Args:
+            optimizer (str): fedavg, fedavgm, fedadam or fedyogi
+            lr (float): server learning rate
+            beta1 (float): momentum (fedavgm) or first moment decay (fedadam, fedyogi)
+            beta2 (float): second moment decay (fedadam, fedyogi)
+            epsilon (float): adaptivity degree, added to sqrt(v) (fedadam, fedyogi)
+        """
+        if optimizer not in SERVER_OPTIMIZERS:
+            raise ValueError(
+                f"Unknown server optimizer {optimizer}, use one of {SERVER_OPTIMIZERS}"
+            )
+        self.optimizer = optimizer
+        self.lr = lr
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def init_state(self, update):
+        """Create the initial optimizer state for a given update schema.
+
+        Args:
+            update (dict): str -> torch.Tensor, an aggregated update
+
+        Returns:
+            dict: str -> torch.Tensor, the optimizer state (empty for fedavg)
+        """
+        state = {}
+        for key, tensor in update.items():
+            if not tensor.is_floating_point() or self.optimizer == "fedavg":
+                continue
+            state[key + MOMENTUM_SUFFIX] = torch.zeros(tensor.shape)
+            if self.optimizer in ["fedadam", "fedyogi"]:
+                state[key + VARIANCE_SUFFIX] = torch.full(
+                    tensor.shape, self.epsilon**2
+                )
+        return state
+
+    def step(self, base_state_dict, update, state=None):
+        """Apply an aggregated update to the global model.
+
+        Args:
+            base_state_dict (dict): the global model the silos started from
+            update (dict): the aggregated update (mean of the silo updates)
+            state (dict): the optimizer state of the previous iteration (None to initialize it)
+
+        Returns:
+            dict: the new global state_dict, in the base checkpoint dtypes
+            dict: the new optimizer state
+        """
+        initial_state = self.init_state(update)
+        if state is None:
+            state = initial_state
+        elif set(state.keys()) != set(initial_state.keys()):
+            raise ValueError(
+                f"Server optimizer state does not match the model, expected keys {sorted(initial_state.keys())}, found {sorted(state.keys())}"
+            )
+
+        new_state_dict = {}
+        new_state = {}
+        for key, base in base_state_dict.items():
+            if not base.is_floating_point():
+                # counters (e.g. batchnorm num_batches_tracked) are not optimized
+                new_state_dict[key] = (base + update[key]).to(base.dtype)
+                continue
+
+            delta = update[key].float()
+            if self.optimizer == "fedavg":
+                step = delta
+            elif self.optimizer == "fedavgm":
+                momentum = state[key + MOMENTUM_SUFFIX].float() * self.beta1 + delta
+                new_state[key + MOMENTUM_SUFFIX] = momentum
+                step = momentum
+            else:
+                momentum = torch.lerp(
+                    delta, state[key + MOMENTUM_SUFFIX].float(), self.beta1
+                )
+                variance = state[key + VARIANCE_SUFFIX].float()
+                squared = delta * delta
+                if self.optimizer == "fedadam":
+                    variance = torch.lerp(squared, variance, self.beta2)
+                else:
+                    variance = variance - (1.0 - self.beta2) * squared * torch.sign(
+                        variance - squared
+                    )
+                new_state[key + MOMENTUM_SUFFIX] = momentum
+                new_state[key + VARIANCE_SUFFIX] = variance
+                step = momentum / (variance.sqrt() + self.epsilon)
+
+            new_state_dict[key] = (base.float() + self.lr * step).to(base.dtype)
+
+        return new_state_dict, new_state
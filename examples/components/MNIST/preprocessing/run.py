@@ -7,9 +7,13 @@ from torchvision import transforms
 from torchvision.utils import save_image
 from torch.utils.data import Dataset
 import torch
+import numpy as np
 import pandas as pd
 import mlflow
 
+from packed_dataset import to_uint8, write_packed
+from batched_logger import BatchedMlflowLogger
+
 
 def get_arg_parser(parser=None):
     """Parse the command line arguments for merge using argparse.
@@ -35,6 +39,14 @@ def get_arg_parser(parser=None):
     parser.add_argument(
         "--metrics_prefix", type=str, required=False, help="Metrics prefix"
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        required=False,
+        choices=["packed", "jpeg"],
+        default="packed",
+        help="packed: one uint8 image array, one label array and a json header per output (see packed_dataset.py), jpeg: one image file per sample, in one folder per label",
+    )
     return parser
 
 
@@ -72,6 +84,7 @@ def preprocess_data(
     train_data_dir="./",
     test_data_dir="./",
     metrics_prefix="default-prefix",
+    output_format="packed",
 ):
     """Preprocess the raw_training_data and raw_testing_data and save the processed data to train_data_dir and test_data_dir.
 
@@ -80,6 +93,7 @@ def preprocess_data(
         raw_testing_data: Testing data directory that need to be processed
         train_data_dir: Train data directory where processed train data will be saved
         test_data_dir: Test data directory where processed test data will be saved
+        output_format: packed (uint8 arrays, see packed_dataset.py) or jpeg (one file per sample)
     Returns:
         None
     """
@@ -130,6 +144,16 @@ def preprocess_data(
 
     for x in ["train", "test"]:
         processed_data_dir = train_data_dir if x == "train" else test_data_dir
+        if output_format == "packed":
+            # same pixel values as the jpeg images, without the compression loss
+            images = np.empty((len(datasets[x]), 1, 28, 28), dtype=np.uint8)
+            labels = np.empty(len(datasets[x]), dtype=np.int64)
+            for idx, (data, target) in enumerate(datasets[x]):
+                images[idx] = to_uint8(data).numpy()
+                labels[idx] = target
+            write_packed(processed_data_dir, images, labels)
+            continue
+
         for idx, (data, target) in enumerate(datasets[x]):
             os.makedirs(processed_data_dir + f"/{target}", exist_ok=True)
             save_image(data, processed_data_dir + f"/{target}/{idx}.jpg")
@@ -140,18 +164,22 @@ def log_metadata(X_train, X_test, metrics_prefix):
         # get Mlflow client
         mlflow_client = mlflow.tracking.client.MlflowClient()
         logger.debug(f"Root runId: {mlflow_run.data.tags.get('mlflow.rootRunId')}")
-        root_run_id = mlflow_run.data.tags.get("mlflow.rootRunId")
-        mlflow_client.log_metric(
-            run_id=root_run_id,
-            key=f"{metrics_prefix}/Number of train datapoints",
-            value=f"{X_train.size(dim=0)}",
-        )
-
-        mlflow_client.log_metric(
-            run_id=root_run_id,
-            key=f"{metrics_prefix}/Number of test datapoints",
-            value=f"{X_test.size(dim=0)}",
+        # outside of a pipeline there is no root run
+        root_run_id = mlflow_run.data.tags.get(
+            "mlflow.rootRunId", mlflow_run.info.run_id
         )
+        # both metrics are sent in a single request when leaving the logger context
+        with BatchedMlflowLogger(mlflow_client, root_run_id) as mlflow_logger:
+            mlflow_logger.log_metric(
+                key=f"{metrics_prefix}/Number of train datapoints",
+                value=X_train.size(dim=0),
+            )
+            mlflow_logger.log_metric(
+                key=f"{metrics_prefix}/Number of test datapoints",
+                value=X_test.size(dim=0),
+            )
+        for error in mlflow_logger.errors:
+            logger.warning(f"Logging to mlflow failed ({error})")
 
 
 def run(args):
@@ -167,6 +195,7 @@ def run(args):
         args.train_output,
         args.test_output,
         args.metrics_prefix,
+        args.output_format,
     )
 
 
@@ -0,0 +1,121 @@
+"""Asynchronous batched logging of metrics and params to an MLflow run.
+
+MlflowClient.log_metric() and log_param() make one blocking request per
+value. BatchedMlflowLogger only appends the values to a buffer: a background
+thread sends the buffer with MlflowClient.log_batch() every flush_interval
+seconds, or as soon as it holds max_batch_size metrics. close() (or leaving
+the logger context) sends what is left, so does the interpreter exit.
+
+Every value keeps the timestamp and step of the time it was logged at.
+
+This module is duplicated in the preprocessing, traininsilo and
+aggregatemodelweights components (each component only uploads its own
+folder), please keep all copies identical.
+"""
+import atexit
+import threading
+import time
+
+from mlflow.entities import Metric, Param
+
+# limits of a single log_batch request
+MAX_BATCH_METRICS = 1000
+MAX_BATCH_PARAMS = 100
+
+
+class BatchedMlflowLogger:
+    def __init__(self, client, run_id, flush_interval=5.0, max_batch_size=1000):
+        """Log metrics and params to a run from a background thread, in batches.
+
+        Args:
+            client (mlflow.tracking.MlflowClient): the client
+            run_id (str): run receiving the metrics and params
+            flush_interval (float): maximum number of seconds a value waits in the buffer
+            max_batch_size (int): number of buffered metrics triggering a flush (at most 1000)
+        """
+        self.client = client
+        self.run_id = run_id
+        self.flush_interval = flush_interval
+        self.max_batch_size = min(max(max_batch_size, 1), MAX_BATCH_METRICS)
+        # number of log_batch requests sent, and errors of the failed ones
+        self.num_requests = 0
+        self.errors = []
+        self._metrics = []
+        self._params = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log_metric(self, key, value, step=0):
+        """Buffer a metric.
+
+        Args:
+            key (str): metric key
+            value (float): metric value
+            step (int): metric step
+        """
+        metric = Metric(
+            key=key, value=float(value), timestamp=int(time.time() * 1000), step=step
+        )
+        with self._condition:
+            self._metrics.append(metric)
+            if len(self._metrics) >= self.max_batch_size:
+                self._condition.notify()
+
+    def log_param(self, key, value):
+        """Buffer a param.
+
+        Args:
+            key (str): param key
+            value: param value (logged as a string)
+        """
+        with self._condition:
+            self._params.append(Param(key=key, value=str(value)))
+
+    def _send(self, metrics, params):
+        for start in range(0, len(params), MAX_BATCH_PARAMS):
+            self._log_batch(params=params[start : start + MAX_BATCH_PARAMS])
+        for start in range(0, len(metrics), MAX_BATCH_METRICS):
+            self._log_batch(metrics=metrics[start : start + MAX_BATCH_METRICS])
+
+    def _log_batch(self, metrics=(), params=()):
+        try:
+            self.client.log_batch(self.run_id, metrics=metrics, params=params)
+        except Exception as e:
+            # losing metrics must not fail the job, the caller reports the errors
+            self.errors.append(repr(e))
+        self.num_requests += 1
+
+    def _take(self):
+        metrics, params = self._metrics, self._params
+        self._metrics, self._params = [], []
+        return metrics, params
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                if not self._closed and len(self._metrics) < self.max_batch_size:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+                metrics, params = self._take()
+            self._send(metrics, params)
+            if closed:
+                return
+
+    def close(self):
+        """Send the buffered values and stop the background thread."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,97 @@
+"""Compiled execution of a model, with fallback modes.
+
+- compile: torch.compile (PyTorch 2+). The compiled graphs can be cached on
+  local disk (inductor FX graph cache), to be reused by the next jobs on the
+  same compute.
+- script: TorchScript tracing. One graph is traced per mode (train/eval), on
+  the first batch of that mode, since tracing freezes the batch norm behavior.
+- off: eager execution.
+
+auto picks torch.compile where available, TorchScript tracing otherwise.
+If a mode fails to compile a graph, that graph runs eagerly instead.
+"""
+import os
+import time
+
+import torch
+
+COMPILE_MODES = ["off", "auto", "compile", "script"]
+
+
+def resolve_compile_mode(compile_mode):
+    """Get the compile mode actually used in this environment.
+
+    Args:
+        compile_mode (str): one of COMPILE_MODES
+
+    Returns:
+        str: compile, script or off
+    """
+    if compile_mode in ["auto", "compile"]:
+        return "compile" if hasattr(torch, "compile") else "script"
+    return compile_mode
+
+
+class CompiledModel:
+    def __init__(self, model, compile_mode="auto", cache_folder=None):
+        """Callable running a model compiled with the first available compile mode.
+
+        The parameters are the ones of model: the optimizer, the state_dict and
+        the checkpoints keep using model.
+
+        Args:
+            model (torch.nn.Module): the model
+            compile_mode (str): one of COMPILE_MODES
+            cache_folder (str): local folder caching the compiled graphs (compile mode only)
+        """
+        self.model = model
+        self.compile_mode = resolve_compile_mode(compile_mode)
+        # time spent in the first call of every graph (compilation + one forward pass)
+        self.compile_seconds = 0.0
+        # errors of the graphs that fell back to eager execution
+        self.errors = []
+        self._runners = {}
+        self._compiled = None
+
+        if self.compile_mode == "compile" and cache_folder:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_folder
+            import torch._inductor.config
+
+            if hasattr(torch._inductor.config, "fx_graph_cache"):
+                torch._inductor.config.fx_graph_cache = True
+
+    def _trace(self, inputs):
+        # tracing runs the model once, do not let it update the batch norm statistics
+        buffers = {name: buffer.clone() for name, buffer in self.model.named_buffers()}
+        try:
+            return torch.jit.trace(self.model, inputs, check_trace=False)
+        finally:
+            with torch.no_grad():
+                for name, buffer in self.model.named_buffers():
+                    buffer.copy_(buffers[name])
+
+    def _build(self, inputs):
+        if self.compile_mode == "compile":
+            if self._compiled is None:
+                self._compiled = torch.compile(self.model)
+            return self._compiled
+        if self.compile_mode == "script":
+            return self._trace(inputs)
+        return self.model
+
+    def __call__(self, inputs):
+        key = self.model.training
+        if key in self._runners:
+            return self._runners[key](inputs)
+
+        start_time = time.time()
+        try:
+            runner = self._build(inputs)
+            outputs = runner(inputs)
+        except Exception as e:
+            self.errors.append(f"{'train' if key else 'eval'}: {e!r}")
+            runner = self.model
+            outputs = runner(inputs)
+        self.compile_seconds += time.time() - start_time
+        self._runners[key] = runner
+        return outputs
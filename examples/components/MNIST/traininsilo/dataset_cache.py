@@ -0,0 +1,94 @@
+"""Decode-once cache of image folder datasets.
+
+An ImageFolder dataset decodes every image file again at every epoch and
+every test. Here the images of a folder are decoded once, by a pool of
+threads, into one uint8 array (N x 1 x H x W, converted to grayscale like
+transforms.Grayscale(1)). The result is a PackedDataset: batches are fetched
+with a single indexing of the array, and converted to float per batch.
+
+With a cache folder (e.g. a local disk of the compute), the decoded arrays
+are also written there in the packed format, under a key computed from the
+list of files of the image folder (relative paths, sizes and labels). The
+next job reading the same images finds them already decoded.
+"""
+import os
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from torchvision.datasets import ImageFolder
+from torchvision.datasets.folder import default_loader
+
+from packed_dataset import PackedDataset, is_packed, write_packed
+
+
+class DecodedDataset(PackedDataset):
+    def __init__(self, images, labels):
+        """PackedDataset over arrays in memory.
+
+        Args:
+            images (np.ndarray): uint8 array of shape N x C x H x W
+            labels (np.ndarray): int64 array of shape N
+        """
+        self.folder = None
+        self.header = {
+            "num_samples": len(labels),
+            "image_shape": list(images.shape[1:]),
+        }
+        self._images = images
+        self._labels = labels
+
+
+def _decode(path):
+    # same conversions as ImageFolder followed by transforms.Grayscale(1)
+    return np.asarray(default_loader(path).convert("L"), dtype=np.uint8)
+
+
+def get_cache_key(samples, root):
+    """Key identifying the content of an image folder, independent of where it is mounted.
+
+    Args:
+        samples (List[Tuple[str, int]]): (path, label) of every image, as listed by ImageFolder
+        root (str): root of the image folder
+
+    Returns:
+        str: the key
+    """
+    listing = hashlib.sha256()
+    for path, label in samples:
+        listing.update(
+            json.dumps(
+                [os.path.relpath(path, root), os.path.getsize(path), label]
+            ).encode("utf-8")
+        )
+    return listing.hexdigest()
+
+
+def decode_image_folder(folder, cache_folder=None, num_threads=None):
+    """Decode all the images of an image folder once, or read them from the cache folder.
+
+    Args:
+        folder (str): image folder, with one subfolder per class (see torchvision ImageFolder)
+        cache_folder (str): optional folder where the decoded images are persisted
+        num_threads (int): number of decoding threads (default: number of cores)
+
+    Returns:
+        PackedDataset: the decoded dataset, yielding (float images in [0, 1], labels) batches
+    """
+    samples = ImageFolder(folder).samples
+    cache_path = None
+    if cache_folder:
+        cache_path = os.path.join(cache_folder, get_cache_key(samples, folder))
+        if is_packed(cache_path):
+            return PackedDataset(cache_path)
+
+    with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+        decoded = list(executor.map(_decode, [path for path, _ in samples]))
+    images = np.stack(decoded)[:, None]
+    labels = np.array([label for _, label in samples], dtype=np.int64)
+
+    if cache_path is None:
+        return DecodedDataset(images, labels)
+    write_packed(cache_path, images, labels)
+    return PackedDataset(cache_path)
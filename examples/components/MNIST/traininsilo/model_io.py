@@ -0,0 +1,427 @@
+"""Read and write model checkpoints exchanged between silos and orchestrator.
+
+Three formats are supported:
+- torch: a model.pt written with torch.save (pickle based),
+- mmap: a model.tensors flat file, made of a header indexing every tensor
+  followed by the raw tensor bytes. It is read through a memory map without
+  pickle, so tensors are only paged in when they are actually used.
+- chunked: a model.manifest.json listing, for every tensor, the content hashes
+  of its chunks, the chunks themselves being stored once in a ChunkStore shared
+  by all the checkpoints (see set_chunk_store()). Chunks that did not change
+  from one checkpoint to the next (e.g. frozen layers) are neither written nor
+  read again.
+
+This module is duplicated in the traininsilo and aggregatemodelweights components
+(each component only uploads its own folder), please keep both copies identical.
+"""
+import os
+import json
+import struct
+import hashlib
+import uuid
+
+import numpy as np
+import torch
+
+CHECKPOINT_FORMATS = ["torch", "mmap", "chunked"]
+CHECKPOINT_EXTENSIONS = {
+    "torch": ".pt",
+    "mmap": ".tensors",
+    "chunked": ".manifest.json",
+}
+
+# flat file layout: MAGIC | header size (uint64, little endian) | header (json) | data
+_FLAT_MAGIC = b"FLTNSR01"
+_FLAT_ALIGNMENT = 64
+
+# dtype name -> (torch dtype, numpy dtype used to map the raw bytes)
+_FLAT_DTYPES = {
+    "float64": (torch.float64, np.float64),
+    "float32": (torch.float32, np.float32),
+    "float16": (torch.float16, np.float16),
+    "bfloat16": (torch.bfloat16, np.int16),
+    "int64": (torch.int64, np.int64),
+    "int32": (torch.int32, np.int32),
+    "int16": (torch.int16, np.int16),
+    "int8": (torch.int8, np.int8),
+    "uint8": (torch.uint8, np.uint8),
+    "bool": (torch.bool, np.bool_),
+}
+_FLAT_DTYPE_NAMES = {
+    torch_dtype: name for name, (torch_dtype, _) in _FLAT_DTYPES.items()
+}
+
+
+def _align(offset):
+    return (offset + _FLAT_ALIGNMENT - 1) // _FLAT_ALIGNMENT * _FLAT_ALIGNMENT
+
+
+def save_flat(state_dict, path, metadata=None):
+    """Write a state_dict as a flat, header-indexed tensor file.
+
+    Args:
+        state_dict (dict): str -> torch.Tensor
+        path (str): path of the file to write
+        metadata (dict): optional json-serializable metadata stored in the header
+    """
+    tensors = {}
+    arrays = []
+    offset = 0
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype not in _FLAT_DTYPE_NAMES:
+            raise ValueError(f"Tensor {key} has unsupported dtype {tensor.dtype}")
+        dtype_name = _FLAT_DTYPE_NAMES[tensor.dtype]
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        array = tensor.numpy()
+
+        offset = _align(offset)
+        tensors[key] = {
+            "dtype": dtype_name,
+            "shape": list(array.shape),
+            "offset": offset,
+            "nbytes": array.nbytes,
+        }
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    header = json.dumps({"metadata": metadata or {}, "tensors": tensors}).encode(
+        "utf-8"
+    )
+    # pad the header (json ignores trailing spaces) so that the data section is aligned
+    prefix_size = len(_FLAT_MAGIC) + 8
+    header += b" " * (_align(prefix_size + len(header)) - prefix_size - len(header))
+
+    with open(path, "wb") as out_file:
+        out_file.write(_FLAT_MAGIC)
+        out_file.write(struct.pack("<Q", len(header)))
+        out_file.write(header)
+        data_start = out_file.tell()
+        for offset, array in arrays:
+            out_file.seek(data_start + offset)
+            out_file.write(array.tobytes())
+
+
+def read_flat_header(path):
+    """Read the header of a flat tensor file.
+
+    Args:
+        path (str): path of the flat tensor file
+
+    Returns:
+        dict: header with keys "metadata" and "tensors"
+        int: offset of the data section in the file
+    """
+    with open(path, "rb") as in_file:
+        magic = in_file.read(len(_FLAT_MAGIC))
+        if magic != _FLAT_MAGIC:
+            raise ValueError(f"{path} is not a flat tensor file (magic={magic})")
+        (header_size,) = struct.unpack("<Q", in_file.read(8))
+        header = json.loads(in_file.read(header_size).decode("utf-8"))
+    return header, len(_FLAT_MAGIC) + 8 + header_size
+
+
+def load_flat(path, keys=None):
+    """Map a flat tensor file as a state_dict, without copying or unpickling.
+
+    Tensors are views on a copy-on-write memory map of the file: their
+    content is only read from disk when accessed.
+
+    Args:
+        path (str): path of the flat tensor file
+        keys (List[str]): optional subset of keys to map (default: all)
+
+    Returns:
+        dict: str -> torch.Tensor
+    """
+    header, data_start = read_flat_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+
+    state_dict = {}
+    for key in keys if keys is not None else header["tensors"].keys():
+        entry = header["tensors"][key]
+        torch_dtype, numpy_dtype = _FLAT_DTYPES[entry["dtype"]]
+        if entry["nbytes"] == 0:
+            state_dict[key] = torch.empty(entry["shape"], dtype=torch_dtype)
+            continue
+        start = data_start + entry["offset"]
+        array = (
+            buffer[start : start + entry["nbytes"]]
+            .view(numpy_dtype)
+            .reshape(entry["shape"])
+        )
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[key] = tensor
+    return state_dict
+
+
+def _tensor_bytes(tensor):
+    """Get the raw bytes of a tensor as a flat uint8 array, and its dtype name.
+
+    Args:
+        tensor (torch.Tensor): any tensor with a dtype supported by the flat format
+
+    Returns:
+        np.ndarray: uint8 1D array
+        str: dtype name (see _FLAT_DTYPES)
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype not in _FLAT_DTYPE_NAMES:
+        raise ValueError(f"Tensor has unsupported dtype {tensor.dtype}")
+    dtype_name = _FLAT_DTYPE_NAMES[tensor.dtype]
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().reshape(-1).view(np.uint8), dtype_name
+
+
+class ChunkStore:
+    def __init__(self, root, cache_folder=None, chunk_size=4 * 1024 * 1024):
+        """Content-addressed store of the chunks of chunked checkpoints.
+
+        Every tensor is split into chunks of at most chunk_size bytes (a tensor
+        smaller than chunk_size is a single chunk), stored in root as
+        chunks/<hash[:2]>/<hash>, where hash is the sha256 of the chunk bytes.
+        A chunk already in the store is not written again, and a chunk already
+        in the local cache folder is not read from the store again.
+
+        Args:
+            root (str): root folder of the store (e.g. a mounted datastore path shared by all the steps)
+            cache_folder (str): optional local folder keeping a copy of the chunks read from the store
+            chunk_size (int): maximum size of a chunk, in bytes
+        """
+        self.root = root
+        self.cache_folder = cache_folder
+        self.chunk_size = chunk_size
+        self.stats = {
+            "chunks_written": 0,
+            "bytes_written": 0,
+            "chunks_skipped": 0,
+            "bytes_skipped": 0,
+            "chunks_read": 0,
+            "bytes_read": 0,
+            "chunks_cached": 0,
+            "bytes_cached": 0,
+        }
+
+    @staticmethod
+    def _chunk_path(folder, chunk_hash):
+        return os.path.join(folder, "chunks", chunk_hash[:2], chunk_hash)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """Write a file through a temporary file, so that a chunk is either complete or absent."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as out_file:
+            out_file.write(data)
+        os.replace(temp_path, path)
+
+    def put(self, data):
+        """Store a chunk, unless the store already has it.
+
+        Args:
+            data (np.ndarray): uint8 1D array
+
+        Returns:
+            str: the chunk hash
+        """
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(self.root, chunk_hash)
+        if os.path.isfile(path):
+            self.stats["chunks_skipped"] += 1
+            self.stats["bytes_skipped"] += data.nbytes
+        else:
+            self._write_atomic(path, data)
+            self.stats["chunks_written"] += 1
+            self.stats["bytes_written"] += data.nbytes
+        return chunk_hash
+
+    def get(self, chunk_hash, out):
+        """Read a chunk into a buffer, from the local cache if possible.
+
+        Args:
+            chunk_hash (str): the chunk hash
+            out (np.ndarray): uint8 1D array receiving the chunk, of the chunk size
+        """
+        if self.cache_folder:
+            cache_path = self._chunk_path(self.cache_folder, chunk_hash)
+            if os.path.isfile(cache_path):
+                with open(cache_path, "rb") as in_file:
+                    in_file.readinto(memoryview(out))
+                self.stats["chunks_cached"] += 1
+                self.stats["bytes_cached"] += out.nbytes
+                return
+
+        path = self._chunk_path(self.root, chunk_hash)
+        with open(path, "rb") as in_file:
+            if in_file.readinto(memoryview(out)) != out.nbytes:
+                raise ValueError(f"Chunk {path} is shorter than {out.nbytes} bytes")
+        self.stats["chunks_read"] += 1
+        self.stats["bytes_read"] += out.nbytes
+        if self.cache_folder:
+            self._write_atomic(cache_path, out)
+
+    def save(self, state_dict, path, metadata=None):
+        """Store the chunks of a state_dict and write its manifest.
+
+        Args:
+            state_dict (dict): str -> torch.Tensor
+            path (str): path of the manifest to write
+            metadata (dict): optional json-serializable metadata stored in the manifest
+        """
+        tensors = {}
+        for key, tensor in state_dict.items():
+            data, dtype_name = _tensor_bytes(tensor)
+            tensors[key] = {
+                "dtype": dtype_name,
+                "shape": list(tensor.shape),
+                "nbytes": data.nbytes,
+                "chunks": [
+                    self.put(data[start : start + self.chunk_size])
+                    for start in range(0, data.nbytes, self.chunk_size)
+                ],
+                "chunk_size": self.chunk_size,
+            }
+        with open(path, "w") as out_file:
+            json.dump({"metadata": metadata or {}, "tensors": tensors}, out_file)
+
+    def load(self, path, keys=None):
+        """Read a state_dict from its manifest, fetching only the chunks of the requested keys.
+
+        Args:
+            path (str): path of the manifest
+            keys (List[str]): optional subset of keys to load (default: all)
+
+        Returns:
+            dict: str -> torch.Tensor
+        """
+        with open(path, "r") as in_file:
+            manifest = json.load(in_file)
+
+        state_dict = {}
+        for key in keys if keys is not None else manifest["tensors"].keys():
+            entry = manifest["tensors"][key]
+            torch_dtype, numpy_dtype = _FLAT_DTYPES[entry["dtype"]]
+            data = np.empty(entry["nbytes"], dtype=np.uint8)
+            for index, chunk_hash in enumerate(entry["chunks"]):
+                start = index * entry["chunk_size"]
+                self.get(chunk_hash, data[start : start + entry["chunk_size"]])
+            tensor = torch.from_numpy(data.view(numpy_dtype).reshape(entry["shape"]))
+            if torch_dtype == torch.bfloat16:
+                tensor = tensor.view(torch.bfloat16)
+            state_dict[key] = tensor
+        return state_dict
+
+
+# store of the chunked checkpoints of this process, see set_chunk_store()
+_CHUNK_STORE = None
+
+
+def set_chunk_store(chunk_store):
+    """Set the ChunkStore used to save and load the chunked checkpoints.
+
+    Args:
+        chunk_store (ChunkStore): the store, or None to unset it
+    """
+    global _CHUNK_STORE
+    _CHUNK_STORE = chunk_store
+
+
+def get_chunk_store():
+    """Get the ChunkStore of the chunked checkpoints.
+
+    Returns:
+        ChunkStore: the store set with set_chunk_store()
+    """
+    if _CHUNK_STORE is None:
+        raise ValueError(
+            "The chunked checkpoint format requires a chunk store, see set_chunk_store()"
+        )
+    return _CHUNK_STORE
+
+
+def find_checkpoint(folder, name="model"):
+    """Find a checkpoint in a folder, whatever its format.
+
+    Args:
+        folder (str): folder containing the checkpoint
+        name (str): checkpoint name, without extension
+
+    Returns:
+        (str, str): path and format of the checkpoint, or (None, None) if not found
+
+    Raises:
+        ValueError: if checkpoints of several formats are found
+    """
+    found = []
+    for checkpoint_format in CHECKPOINT_FORMATS:
+        path = os.path.join(folder, name + CHECKPOINT_EXTENSIONS[checkpoint_format])
+        if os.path.isfile(path):
+            found.append((path, checkpoint_format))
+    if len(found) > 1:
+        # e.g. a model.pt left over next to a newer model.tensors, loading either one could be stale
+        raise ValueError(
+            f"Several checkpoints {name} found in {folder}: {[path for path, _ in found]}, remove the stale ones"
+        )
+    return found[0] if found else (None, None)
+
+
+def save_checkpoint(state_dict, folder, checkpoint_format="torch", name="model"):
+    """Save a state_dict in a folder with the given format.
+
+    Args:
+        state_dict (dict): str -> torch.Tensor
+        folder (str): output folder
+        checkpoint_format (str): torch, mmap or chunked
+        name (str): checkpoint name, without extension
+
+    Returns:
+        str: path of the checkpoint written (the manifest for the chunked format)
+    """
+    if checkpoint_format not in CHECKPOINT_FORMATS:
+        raise ValueError(
+            f"Unknown checkpoint format {checkpoint_format}, use one of {CHECKPOINT_FORMATS}"
+        )
+    # remove a checkpoint of another format left in the folder by a previous run, see find_checkpoint()
+    for other_format in CHECKPOINT_FORMATS:
+        other_path = os.path.join(folder, name + CHECKPOINT_EXTENSIONS[other_format])
+        if other_format != checkpoint_format and os.path.isfile(other_path):
+            os.remove(other_path)
+    path = os.path.join(folder, name + CHECKPOINT_EXTENSIONS[checkpoint_format])
+    if checkpoint_format == "mmap":
+        save_flat(state_dict, path)
+    elif checkpoint_format == "chunked":
+        get_chunk_store().save(state_dict, path)
+    else:
+        torch.save(state_dict, path)
+    return path
+
+
+def load_checkpoint(folder, name="model", keys=None):
+    """Load a state_dict from a folder, detecting its format.
+
+    Args:
+        folder (str): folder containing the checkpoint
+        name (str): checkpoint name, without extension
+        keys (List[str]): optional subset of keys to load (mmap and chunked formats only avoid reading the others)
+
+    Returns:
+        dict: str -> torch.Tensor, on cpu
+    """
+    path, checkpoint_format = find_checkpoint(folder, name)
+    if path is None:
+        raise FileNotFoundError(
+            f"No checkpoint {name} found in {folder} (formats: {CHECKPOINT_FORMATS})"
+        )
+    if checkpoint_format == "mmap":
+        return load_flat(path, keys=keys)
+    if checkpoint_format == "chunked":
+        return get_chunk_store().load(path, keys=keys)
+
+    state_dict = torch.load(path, map_location="cpu")
+    if keys is not None:
+        state_dict = {key: state_dict[key] for key in keys}
+    return state_dict
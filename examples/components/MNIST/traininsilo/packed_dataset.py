@@ -0,0 +1,183 @@
+"""Packed image dataset: one contiguous uint8 image array, one label array, one json header.
+
+A processed data folder in the packed format contains:
+- dataset.json: the header, with the number of samples, the shape of an
+  image and the dtype/shape/file of both arrays,
+- images.bin: the N images, as raw uint8 pixels (N x C x H x W),
+- labels.bin: the N labels, as raw int64.
+
+Reading it needs neither one file per sample nor any image decoding: the
+arrays are opened with numpy.memmap, and whole batches of samples are
+gathered at once (see PackedDataset and get_packed_loader()).
+
+This module is duplicated in the preprocessing and traininsilo components
+(each component only uploads its own folder), please keep both copies identical.
+"""
+import os
+import json
+
+import numpy as np
+import torch
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    SequentialSampler,
+)
+
+PACKED_HEADER = "dataset.json"
+PACKED_IMAGES = "images.bin"
+PACKED_LABELS = "labels.bin"
+PACKED_FORMAT = "packed_uint8"
+
+
+def is_packed(folder):
+    """Check if a folder holds a packed dataset.
+
+    Args:
+        folder (str): data folder
+
+    Returns:
+        bool: True if the folder has a packed dataset header
+    """
+    return os.path.isfile(os.path.join(folder, PACKED_HEADER))
+
+
+def to_uint8(images):
+    """Quantize float images in [0, 1] to uint8 pixels, rounding like torchvision save_image().
+
+    Args:
+        images (torch.Tensor): float images
+
+    Returns:
+        torch.Tensor: uint8 images
+    """
+    return images.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+def write_packed(folder, images, labels):
+    """Write a packed dataset.
+
+    Args:
+        folder (str): output folder
+        images (np.ndarray): uint8 array of shape N x C x H x W
+        labels (np.ndarray): integer array of shape N
+    """
+    images = np.ascontiguousarray(images, dtype=np.uint8)
+    labels = np.ascontiguousarray(labels, dtype=np.int64)
+    if len(images) != len(labels):
+        raise ValueError(f"Got {len(images)} images for {len(labels)} labels")
+
+    os.makedirs(folder, exist_ok=True)
+    images.tofile(os.path.join(folder, PACKED_IMAGES))
+    labels.tofile(os.path.join(folder, PACKED_LABELS))
+    header = {
+        "format": PACKED_FORMAT,
+        "num_samples": len(labels),
+        "image_shape": list(images.shape[1:]),
+        "images": {"file": PACKED_IMAGES, "dtype": "uint8"},
+        "labels": {"file": PACKED_LABELS, "dtype": "int64"},
+    }
+    # written last, a folder with a header has complete arrays
+    with open(os.path.join(folder, PACKED_HEADER), "w") as header_file:
+        json.dump(header, header_file)
+
+
+class PackedDataset(Dataset):
+    def __init__(self, folder):
+        """Dataset reading a packed dataset folder, indexed by batches of indices.
+
+        The arrays are memory mapped (copy-on-write, the files are never modified)
+        on first access, so that DataLoader workers map them on their own instead
+        of receiving a copy.
+
+        Args:
+            folder (str): folder written by write_packed()
+        """
+        self.folder = folder
+        with open(os.path.join(folder, PACKED_HEADER)) as header_file:
+            self.header = json.load(header_file)
+        if self.header.get("format") != PACKED_FORMAT:
+            raise ValueError(
+                f"Unknown packed dataset format {self.header.get('format')} in {folder}"
+            )
+        self._images = None
+        self._labels = None
+
+    def __len__(self):
+        return self.header["num_samples"]
+
+    def _map(self):
+        shape = [self.header["num_samples"]] + self.header["image_shape"]
+        self._images = np.memmap(
+            os.path.join(self.folder, self.header["images"]["file"]),
+            dtype=np.uint8,
+            mode="c",
+            shape=tuple(shape),
+        )
+        self._labels = np.memmap(
+            os.path.join(self.folder, self.header["labels"]["file"]),
+            dtype=np.int64,
+            mode="c",
+            shape=(shape[0],),
+        )
+
+    def get_labels(self):
+        """Get the labels of all the samples, without reading the images.
+
+        Returns:
+            np.ndarray: int64 labels, of shape N
+        """
+        if self._labels is None:
+            self._map()
+        return np.array(self._labels)
+
+    def __getitem__(self, indices):
+        """Gather a batch of samples.
+
+        Args:
+            indices (List[int]): indices of the samples of the batch
+
+        Returns:
+            torch.Tensor: float images in [0, 1], of shape B x C x H x W
+            torch.Tensor: int64 labels, of shape B
+        """
+        if self._images is None:
+            self._map()
+        # read the memory map in increasing order, the order within a batch does not matter
+        indices = np.sort(np.asarray(indices, dtype=np.int64))
+        if len(indices) and indices[-1] - indices[0] + 1 == len(indices):
+            # contiguous batch (no shuffling): a single slice of the memory map
+            images = self._images[indices[0] : indices[-1] + 1]
+            labels = self._labels[indices[0] : indices[-1] + 1]
+        else:
+            images = self._images[indices]
+            labels = self._labels[indices]
+        return (
+            torch.from_numpy(images).float().div_(255),
+            torch.from_numpy(np.array(labels)),
+        )
+
+
+def get_packed_loader(dataset, batch_size, shuffle=True, sampler=None, **loader_kwargs):
+    """Get a DataLoader yielding whole batches of a PackedDataset.
+
+    Args:
+        dataset (PackedDataset): the dataset
+        batch_size (int): batch size
+        shuffle (bool): shuffle the samples at every epoch
+        sampler (Sampler): optional sampler of the sample indices (e.g. a DistributedSampler), replaces shuffle
+        **loader_kwargs: other DataLoader arguments (num_workers, pin_memory...)
+
+    Returns:
+        DataLoader: the loader, each item is one (images, labels) batch
+    """
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False),
+        batch_size=None,
+        **loader_kwargs,
+    )
@@ -1,16 +1,77 @@
 """Script for mock components."""
+import os
 import argparse
 import logging
 import sys
+import json
+import time
+import socket
+import contextlib
 
 import mlflow
+import numpy as np
 import torch
 from torch import nn
 from torch.optim import SGD
+from torch.utils.data import Subset
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import models, datasets, transforms
 from mlflow import log_metric, log_param
 
+from model_io import (
+    CHECKPOINT_FORMATS,
+    ChunkStore,
+    find_checkpoint,
+    get_chunk_store,
+    load_checkpoint,
+    save_checkpoint,
+    set_chunk_store,
+)
+from update_codec import (
+    UPDATE_QUANTIZATIONS,
+    QUANTIZATION_GRANULARITIES,
+    compute_update,
+    encode_update,
+    decode_update,
+    relative_error,
+    encoded_size,
+    to_dense,
+)
+from compiled_model import COMPILE_MODES, CompiledModel
+from batched_logger import BatchedMlflowLogger
+from dataset_cache import decode_image_folder
+from packed_dataset import PackedDataset, get_packed_loader, is_packed
+from secure_aggregation import (
+    get_default_threshold,
+    get_pair_seeds,
+    load_private_key,
+    load_public_keys,
+    make_self_mask,
+    mask_state_dict,
+)
+
+
+def stratified_subsample(labels, size, seed=0):
+    """Pick a fixed subsample of samples with the same label proportions as the whole set.
+
+    Args:
+        labels (np.ndarray): label of every sample
+        size (int): number of samples to pick
+        seed (int): seed of the pick, the same subsample is picked at every call
+
+    Returns:
+        List[int]: sorted indices of the picked samples
+    """
+    generator = np.random.default_rng(seed)
+    indices = []
+    for label in np.unique(labels):
+        label_indices = np.flatnonzero(labels == label)
+        count = max(1, int(round(len(label_indices) * size / len(labels))))
+        indices.extend(generator.permutation(label_indices)[:count].tolist())
+    return sorted(indices)
+
 
 class MnistTrainer:
     def __init__(
@@ -23,6 +84,32 @@ class MnistTrainer:
         batch_size=64,
         experiment_name="default-experiment",
         iteration_name="default-iteration",
+        aggregation_weight=None,
+        checkpoint_format="torch",
+        output_mode="model",
+        update_quantization="none",
+        quantization_granularity="per_tensor",
+        topk_ratio=None,
+        residual_path=None,
+        previous_residual_path=None,
+        max_train_seconds=None,
+        secure_aggregation=None,
+        num_workers=0,
+        persistent_workers=True,
+        prefetch_factor=None,
+        pin_memory=None,
+        sharing_strategy=None,
+        dataset_cache=False,
+        dataset_cache_folder=None,
+        precision="fp32",
+        channels_last=False,
+        compile_mode="off",
+        compile_cache_folder=None,
+        log_flush_interval=5.0,
+        log_batch_size=1000,
+        eval_batch_size=None,
+        eval_every=1,
+        eval_subsample_size=None,
     ):
         """MNIST Trainer trains RESNET18 model on the MNIST dataset.
 
@@ -32,6 +119,32 @@ class MnistTrainer:
             lr (float, optional): Learning rate. Defaults to 0.01
             epochs (int, optional): Epochs. Defaults to 1
             batch_size (int, optional): DataLoader batch size. Defaults to 64.
+            aggregation_weight (float, optional): custom weight of this silo in the aggregation. Defaults to None.
+            checkpoint_format (str, optional): torch (model.pt), mmap (model.tensors) or chunked (model.manifest.json). Defaults to torch.
+            output_mode (str, optional): model (full weights) or update (difference with the checkpoint). Defaults to model.
+            update_quantization (str, optional): none, fp16, bf16 or int8 encoding of the update. Defaults to none.
+            quantization_granularity (str, optional): per_tensor or per_channel int8 scales. Defaults to per_tensor.
+            topk_ratio (float, optional): fraction of the largest update entries to send, with error feedback. Defaults to None (send all).
+            residual_path (str, optional): folder to save the entries of the update that were not sent. Defaults to None.
+            previous_residual_path (str, optional): folder of the residual saved by the previous round. Defaults to None.
+            max_train_seconds (float, optional): stop training at the first batch boundary after this many seconds (counted from the trainer creation), and still save the model. Defaults to None (no deadline).
+            secure_aggregation (dict, optional): if set, send the model (or update) masked for secure aggregation, with keys silo_index, num_silos, round, precision_bits, pair_seeds (see secure_aggregation.get_pair_seeds()), threshold, self_mask_seed and self_mask_shares (see secure_aggregation.make_self_mask()). Defaults to None.
+            num_workers (int, optional): number of DataLoader worker processes. Defaults to 0 (load in the training process).
+            persistent_workers (bool, optional): keep the DataLoader workers alive from one epoch to the next (with num_workers > 0). Defaults to True.
+            prefetch_factor (int, optional): number of batches loaded in advance by each worker (with num_workers > 0). Defaults to None (DataLoader default).
+            pin_memory (bool, optional): load the batches in page-locked memory, for faster copies to the GPU. Defaults to None (only on GPU).
+            sharing_strategy (str, optional): torch.multiprocessing sharing strategy of the batches sent by the workers (file_descriptor or file_system). Defaults to None (torch default).
+            dataset_cache (bool, optional): decode the image folders once, in parallel, and fetch whole batches from the decoded images. Defaults to False.
+            dataset_cache_folder (str, optional): local folder where the decoded images are persisted for the next jobs (with dataset_cache). Defaults to None (in memory only).
+            precision (str, optional): fp32, or bf16 to run the forward passes under bfloat16 autocast. Defaults to fp32.
+            channels_last (bool, optional): run the convolutions on channels_last (NHWC) tensors. Defaults to False.
+            compile_mode (str, optional): off (eager), auto, compile (torch.compile) or script (TorchScript tracing), see compiled_model.py. Defaults to off.
+            compile_cache_folder (str, optional): local folder caching the compiled graphs across rounds (torch.compile only). Defaults to None.
+            log_flush_interval (float, optional): maximum number of seconds the metrics wait before being sent to mlflow, in the background. Defaults to 5.0.
+            log_batch_size (int, optional): number of buffered metrics sending them to mlflow right away (at most 1000). Defaults to 1000.
+            eval_batch_size (int, optional): test DataLoader batch size. Defaults to None (batch_size).
+            eval_every (int, optional): test every eval_every epochs, the last epoch is always tested. Defaults to 1.
+            eval_subsample_size (int, optional): test the epochs before the last one on a fixed stratified subsample of about this many test samples, the last epoch is tested on the full test set. Defaults to None (full test set).
 
         Attributes:
             model_: RESNET18 model
@@ -41,6 +154,7 @@ class MnistTrainer:
             train_loader_: Training DataLoader
             test_dataset_: Testing Dataset obj
             test_loader_: Testing DataLoader
+            test_subsample_loader_: Testing DataLoader of the stratified subsample (None without eval_subsample_size)
         """
 
         # Training setup
@@ -49,8 +163,38 @@ class MnistTrainer:
         self._batch_size = batch_size
         self._experiment_name = experiment_name
         self._iteration_name = iteration_name
+        self._aggregation_weight = aggregation_weight
+        self._checkpoint_format = checkpoint_format
+        self._output_mode = output_mode
+        self._update_quantization = update_quantization
+        self._quantization_granularity = quantization_granularity
+        self._base_state_dict = None
+        self._topk_ratio = topk_ratio
+        self._residual_path = residual_path
+        self._previous_residual_path = previous_residual_path
+        self._num_steps = 0
+        self._deadline = (
+            time.time() + max_train_seconds if max_train_seconds is not None else None
+        )
+        self._deadline_reached = False
+        self._secure_aggregation = secure_aggregation
+        self._log_flush_interval = log_flush_interval
+        self._log_batch_size = log_batch_size
+        self._eval_every = max(eval_every, 1)
+
+        # the gpu of this process (see torch.cuda.set_device() in run())
+        self.device_ = (
+            torch.device("cuda", torch.cuda.current_device())
+            if torch.cuda.is_available()
+            else torch.device("cpu")
+        )
 
-        self.device_ = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        # data parallel training, if this process is part of a process group (see run())
+        self._distributed = torch.distributed.is_initialized()
+        self._rank = torch.distributed.get_rank() if self._distributed else 0
+        self._world_size = (
+            torch.distributed.get_world_size() if self._distributed else 1
+        )
 
         # Build model
         self.model_ = models.resnet18(pretrained=True)
@@ -60,19 +204,117 @@ class MnistTrainer:
         num_ftrs = self.model_.fc.in_features
         self.model_.fc = nn.Linear(num_ftrs, 10)
         self.model_.to(self.device_)
+        self._precision = precision
+        self._channels_last = channels_last
+        if channels_last:
+            self.model_.to(memory_format=torch.channels_last)
+        self.compiled_model_ = CompiledModel(
+            self.model_, compile_mode, cache_folder=compile_cache_folder
+        )
+        self.eval_model_ = self.compiled_model_
+        if self._distributed:
+            # gradients are averaged across processes, the tests only run in rank 0
+            self.compiled_model_ = CompiledModel(
+                DistributedDataParallel(
+                    self.model_,
+                    device_ids=[self.device_.index]
+                    if self.device_.type == "cuda"
+                    else None,
+                ),
+                compile_mode,
+                cache_folder=compile_cache_folder,
+            )
         self._model_path = model_path
 
         self.loss_ = nn.CrossEntropyLoss()
         self.optimizer_ = SGD(self.model_.parameters(), lr=lr, momentum=0.9)
 
+        self._dataset_cache = dataset_cache
+        self._dataset_cache_folder = dataset_cache_folder
         self.train_dataset_, self.test_dataset_ = self.load_dataset(
             train_data_dir, test_data_dir
         )
-        self.train_loader_ = DataLoader(
-            self.train_dataset_, batch_size=batch_size, shuffle=True
+        if sharing_strategy:
+            # file_system does not keep a file descriptor open per shared batch
+            torch.multiprocessing.set_sharing_strategy(sharing_strategy)
+        self._num_workers = num_workers
+        self._pin_memory = (
+            pin_memory if pin_memory is not None else self.device_.type == "cuda"
         )
-        self.test_loader_ = DataLoader(
-            self.test_dataset_, batch_size=batch_size, shuffle=True
+        loader_kwargs = {"num_workers": num_workers, "pin_memory": self._pin_memory}
+        if num_workers > 0:
+            loader_kwargs["persistent_workers"] = persistent_workers
+            if prefetch_factor is not None:
+                loader_kwargs["prefetch_factor"] = prefetch_factor
+        # each process trains on its own shard of the training data
+        self._train_sampler = (
+            DistributedSampler(self.train_dataset_, shuffle=True)
+            if self._distributed
+            else None
+        )
+        if isinstance(self.train_dataset_, PackedDataset):
+            # whole batches are gathered at once from the packed arrays
+            self.train_loader_ = get_packed_loader(
+                self.train_dataset_,
+                batch_size,
+                shuffle=True,
+                sampler=self._train_sampler,
+                **loader_kwargs,
+            )
+        else:
+            self.train_loader_ = DataLoader(
+                self.train_dataset_,
+                batch_size=batch_size,
+                shuffle=self._train_sampler is None,
+                sampler=self._train_sampler,
+                **loader_kwargs,
+            )
+
+        # the test order does not matter, and without gradients larger batches fit in memory
+        eval_batch_size = eval_batch_size or batch_size
+        self.test_loader_ = self.get_test_loader(eval_batch_size, None, loader_kwargs)
+        self.test_subsample_loader_ = None
+        if eval_subsample_size and eval_subsample_size < len(self.test_dataset_):
+            self.test_subsample_loader_ = self.get_test_loader(
+                eval_batch_size,
+                stratified_subsample(self.get_test_labels(), eval_subsample_size),
+                loader_kwargs,
+            )
+
+    def get_test_labels(self):
+        """Get the labels of the test samples, without loading the images.
+
+        Returns:
+            np.ndarray: the labels
+        """
+        if isinstance(self.test_dataset_, PackedDataset):
+            return self.test_dataset_.get_labels()
+        return np.array(self.test_dataset_.targets)
+
+    def get_test_loader(self, eval_batch_size, indices, loader_kwargs):
+        """Get a DataLoader of the test samples, in order.
+
+        Args:
+            eval_batch_size (int): batch size
+            indices (List[int]): indices of the samples to test, None for the whole test set
+            loader_kwargs (dict): other DataLoader arguments (num_workers, pin_memory...)
+
+        Returns:
+            DataLoader: the loader
+        """
+        if isinstance(self.test_dataset_, PackedDataset):
+            return get_packed_loader(
+                self.test_dataset_,
+                eval_batch_size,
+                shuffle=False,
+                sampler=indices,
+                **loader_kwargs,
+            )
+        dataset = self.test_dataset_
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        return DataLoader(
+            dataset, batch_size=eval_batch_size, shuffle=False, **loader_kwargs
         )
 
     def load_dataset(self, train_data_dir, test_data_dir):
@@ -86,6 +328,22 @@ class MnistTrainer:
             batch_size (int, optional): DataLoader batch size. Defaults to 64.
         """
         logger.info(f"Train data dir: {train_data_dir}, Test data dir: {test_data_dir}")
+        if is_packed(train_data_dir) and is_packed(test_data_dir):
+            logger.info("Loading packed datasets")
+            return PackedDataset(train_data_dir), PackedDataset(test_data_dir)
+        if self._dataset_cache:
+            start_time = time.time()
+            train_dataset = decode_image_folder(
+                train_data_dir, self._dataset_cache_folder
+            )
+            test_dataset = decode_image_folder(
+                test_data_dir, self._dataset_cache_folder
+            )
+            logger.info(
+                f"Decoded {len(train_dataset)} train and {len(test_dataset)} test images in {time.time() - start_time:.1f}s (cache folder: {self._dataset_cache_folder})"
+            )
+            return train_dataset, test_dataset
+
         transformer = transforms.Compose(
             [
                 transforms.Grayscale(num_output_channels=1),
@@ -97,44 +355,109 @@ class MnistTrainer:
 
         return train_dataset, test_dataset
 
-    def log_params(self, client, run_id):
-        client.log_param(
-            run_id=run_id, key=f"learning_rate {self._experiment_name}", value=self._lr
-        )
-        client.log_param(
-            run_id=run_id, key=f"epochs {self._experiment_name}", value=self._epochs
-        )
-        client.log_param(
-            run_id=run_id,
-            key=f"batch_size {self._experiment_name}",
-            value=self._batch_size,
-        )
-        client.log_param(
-            run_id=run_id,
-            key=f"loss {self._experiment_name}",
-            value=self.loss_.__class__.__name__,
-        )
-        client.log_param(
-            run_id=run_id,
-            key=f"optimizer {self._experiment_name}",
-            value=self.optimizer_.__class__.__name__,
-        )
+    def log_params(self, mlflow_logger):
+        if self._rank != 0:
+            return
+        params = {
+            "learning_rate": self._lr,
+            "epochs": self._epochs,
+            "batch_size": self._batch_size,
+            "num_workers": self._num_workers,
+            "precision": self._precision,
+            "channels_last": self._channels_last,
+            "compile_mode": self.compiled_model_.compile_mode,
+            "processes": self._world_size,
+            "loss": self.loss_.__class__.__name__,
+            "optimizer": self.optimizer_.__class__.__name__,
+        }
+        for key, value in params.items():
+            mlflow_logger.log_param(key=f"{key} {self._experiment_name}", value=value)
+
+    def forward(self, model, images):
+        """Run a model in the configured precision and memory format.
 
-    def log_metrics(self, client, run_id, key, value, pipeline_level=False):
+        Args:
+            model (CompiledModel): compiled_model_ to train, eval_model_ to test
+            images (torch.Tensor): batch of images, on the device
+
+        Returns:
+            torch.Tensor: fp32 predictions
+        """
+        if self._channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+            device_type=self.device_.type,
+            dtype=torch.bfloat16,
+            enabled=self._precision == "bf16",
+        ):
+            predictions = model(images)
+        # the loss and the metrics are computed in fp32
+        return predictions.float()
+
+    def all_reduce(self, value, op=torch.distributed.ReduceOp.SUM):
+        """Reduce a number across the processes (identity without data parallel training).
+
+        Args:
+            value (float): the value of this process
+            op (torch.distributed.ReduceOp): reduction
+
+        Returns:
+            float: the reduced value
+        """
+        if not self._distributed:
+            return value
+        # nccl only reduces gpu tensors
+        tensor = torch.tensor([value], dtype=torch.float64, device=self.device_)
+        torch.distributed.all_reduce(tensor, op=op)
+        return tensor.item()
+
+    def log_metrics(self, mlflow_logger, key, value, pipeline_level=False):
+        if self._rank != 0:
+            return
 
         if pipeline_level:
-            client.log_metric(
-                run_id=run_id,
-                key=f"{self._experiment_name}/{key}",
-                value=value,
-            )
+            mlflow_logger.log_metric(key=f"{self._experiment_name}/{key}", value=value)
         else:
-            client.log_metric(
-                run_id=run_id,
+            mlflow_logger.log_metric(
                 key=f"{self._iteration_name}/{self._experiment_name}/{key}",
                 value=value,
             )
 
+    def get_mlflow_logger(self, mlflow_run):
+        """Get the logger of the metrics and params, sending them to the root run in the background.
+
+        Args:
+            mlflow_run (mlflow.ActiveRun): the run of this job, None if this process does not log
+
+        Returns:
+            BatchedMlflowLogger: the logger, to use as a context manager (flushed on exit)
+        """
+        if mlflow_run is None:
+            return contextlib.nullcontext()
+        logger.debug(f"Root runId: {mlflow_run.data.tags.get('mlflow.rootRunId')}")
+        # outside of a pipeline (e.g. local asynchronous runs) there is no root run
+        root_run_id = mlflow_run.data.tags.get(
+            "mlflow.rootRunId", mlflow_run.info.run_id
+        )
+        return BatchedMlflowLogger(
+            mlflow.tracking.client.MlflowClient(),
+            root_run_id,
+            flush_interval=self._log_flush_interval,
+            max_batch_size=self._log_batch_size,
+        )
+
+    def report_logging(self, mlflow_logger):
+        """Report the requests sent by a closed logger, and the ones that failed.
+
+        Args:
+            mlflow_logger (BatchedMlflowLogger): the logger, None if this process does not log
+        """
+        if mlflow_logger is None:
+            return
+        for error in mlflow_logger.errors:
+            logger.warning(f"Logging to mlflow failed ({error})")
+        logger.debug(f"Mlflow log_batch requests: {mlflow_logger.num_requests}")
+
     def local_train(self, checkpoint):
         """Perform local training for a given number of epochs
 
@@ -143,41 +466,72 @@ class MnistTrainer:
         """
 
         if checkpoint:
-            self.model_.load_state_dict(torch.load(checkpoint + "/model.pt"))
-
-        with mlflow.start_run() as mlflow_run:
-
-            # get Mlflow client and root run id
-            mlflow_client = mlflow.tracking.client.MlflowClient()
-            logger.debug(f"Root runId: {mlflow_run.data.tags.get('mlflow.rootRunId')}")
-            root_run_id = mlflow_run.data.tags.get("mlflow.rootRunId")
+            self.model_.load_state_dict(load_checkpoint(checkpoint))
+            if self._output_mode == "update":
+                # keep the starting point to compute the update after training
+                self._base_state_dict = {
+                    k: v.detach().cpu().clone()
+                    for k, v in self.model_.state_dict().items()
+                }
+
+        # with data parallel training, only rank 0 logs to mlflow
+        with (
+            mlflow.start_run() if self._rank == 0 else contextlib.nullcontext()
+        ) as mlflow_run, self.get_mlflow_logger(mlflow_run) as mlflow_logger:
 
             # log params
-            self.log_params(mlflow_client, root_run_id)
+            self.log_params(mlflow_logger)
 
-            self.model_.train()
             logger.debug("Local training started")
 
             training_loss = 0.0
             test_loss = 0.0
             test_acc = 0.0
+            # training throughput, excluding the tests
+            train_samples = 0
+            train_seconds = 0.0
+            # duration of the training steps, excluding the first one (compilation)
+            steady_steps = 0
+            steady_seconds = 0.0
 
             for epoch in range(self._epochs):
+                # test() of the previous epoch left the model in eval mode
+                self.model_.train()
 
                 running_loss = 0.0
                 num_of_batches_before_logging = 100
+                epoch_samples = 0
+                epoch_start = time.time()
+                if self._train_sampler is not None:
+                    self._train_sampler.set_epoch(epoch)
 
                 for i, batch in enumerate(self.train_loader_):
+                    # all the processes must stop at the same step
+                    if self._deadline is not None and self.all_reduce(
+                        float(time.time() > self._deadline),
+                        op=torch.distributed.ReduceOp.MAX,
+                    ):
+                        logger.warning(
+                            f"Training deadline reached at epoch {epoch}, iteration {i} ({self._num_steps} steps), stopping early"
+                        )
+                        self._deadline_reached = True
+                        break
 
-                    images, labels = batch[0].to(self.device_), batch[1].to(
-                        self.device_
-                    )
+                    images, labels = batch[0].to(
+                        self.device_, non_blocking=self._pin_memory
+                    ), batch[1].to(self.device_, non_blocking=self._pin_memory)
+                    step_start = time.time()
                     self.optimizer_.zero_grad()
 
-                    predictions = self.model_(images)
+                    predictions = self.forward(self.compiled_model_, images)
                     cost = self.loss_(predictions, labels)
                     cost.backward()
                     self.optimizer_.step()
+                    if self._num_steps > 0:
+                        steady_steps += 1
+                        steady_seconds += time.time() - step_start
+                    self._num_steps += 1
+                    epoch_samples += images.size()[0]
 
                     running_loss += cost.cpu().detach().numpy() / images.size()[0]
                     if i != 0 and i % num_of_batches_before_logging == 0:
@@ -188,58 +542,117 @@ class MnistTrainer:
 
                         # log train loss
                         self.log_metrics(
-                            mlflow_client,
-                            root_run_id,
+                            mlflow_logger,
                             "Train Loss",
                             training_loss,
                         )
 
                         running_loss = 0.0
 
-                test_loss, test_acc = self.test()
+                epoch_seconds = time.time() - epoch_start
+                # samples of all the processes
+                epoch_samples = int(self.all_reduce(epoch_samples))
+                train_samples += epoch_samples
+                train_seconds += epoch_seconds
+                samples_per_second = epoch_samples / max(epoch_seconds, 1e-9)
+                if self._rank == 0:
+                    logger.info(
+                        f"Epoch: {epoch}, Training throughput: {samples_per_second:.1f} samples/sec"
+                    )
+                self.log_metrics(
+                    mlflow_logger,
+                    "Train Samples Per Second",
+                    samples_per_second,
+                )
+
+                if self._deadline_reached:
+                    # do not spend more time testing, the model is saved as is
+                    break
+                if self._rank != 0:
+                    continue
+                last_epoch = epoch == self._epochs - 1
+                if not last_epoch and (epoch + 1) % self._eval_every != 0:
+                    continue
 
-                # log test metrics after each epoch
-                self.log_metrics(mlflow_client, root_run_id, "Test Loss", test_loss)
-                self.log_metrics(mlflow_client, root_run_id, "Test Accuracy", test_acc)
+                # the last epoch is always tested on the full test set
+                test_loss, test_acc = self.test(subsample=not last_epoch)
+
+                # log test metrics after each tested epoch
+                self.log_metrics(mlflow_logger, "Test Loss", test_loss)
+                self.log_metrics(mlflow_logger, "Test Accuracy", test_acc)
 
                 logger.info(
                     f"Epoch: {epoch}, Test Loss: {test_loss} and Test Accuracy: {test_acc}"
                 )
 
+            # compilation cost vs steady-state step time, to tell if a round amortizes it
+            step_seconds = steady_seconds / max(steady_steps, 1)
+            for error in self.compiled_model_.errors:
+                logger.warning(f"Compilation failed, running eagerly ({error})")
+            logger.info(
+                f"Compile mode: {self.compiled_model_.compile_mode}, first calls (compilation): {self.compiled_model_.compile_seconds:.2f}s, steady-state step: {step_seconds:.4f}s"
+            )
+            self.log_metrics(
+                mlflow_logger,
+                "Compile Seconds",
+                self.compiled_model_.compile_seconds,
+            )
+            self.log_metrics(mlflow_logger, "Step Seconds", step_seconds)
+
             # log metrics at the pipeline level
             self.log_metrics(
-                mlflow_client,
-                root_run_id,
+                mlflow_logger,
                 "Train Loss",
                 training_loss,
                 pipeline_level=True,
             )
+            self.log_metrics(mlflow_logger, "Test Loss", test_loss, pipeline_level=True)
             self.log_metrics(
-                mlflow_client, root_run_id, "Test Loss", test_loss, pipeline_level=True
-            )
-            self.log_metrics(
-                mlflow_client,
-                root_run_id,
+                mlflow_logger,
                 "Test Accuracy",
                 test_acc,
                 pipeline_level=True,
             )
+            self.log_metrics(
+                mlflow_logger,
+                "Train Samples Per Second",
+                train_samples / max(train_seconds, 1e-9),
+                pipeline_level=True,
+            )
+        self.report_logging(mlflow_logger)
+
+    def test(self, subsample=False):
+        """Test the trained model and report test loss and accuracy
 
-    def test(self):
-        """Test the trained model and report test loss and accuracy"""
+        The loss and the number of correct predictions are summed on the device,
+        and read once at the end.
+
+        Args:
+            subsample (bool, optional): test on the stratified subsample, if any. Defaults to False.
+
+        Returns:
+            float: mean loss of the test samples
+            float: accuracy
+        """
+        test_loader = self.test_loader_
+        if subsample and self.test_subsample_loader_ is not None:
+            test_loader = self.test_subsample_loader_
         self.model_.eval()
-        test_loss = 0
-        correct = 0
-        with torch.no_grad():
-            for data, target in self.test_loader_:
+        test_loss = torch.zeros((), dtype=torch.float64, device=self.device_)
+        correct = torch.zeros((), dtype=torch.int64, device=self.device_)
+        num_samples = 0
+        with torch.inference_mode():
+            for data, target in test_loader:
                 data, target = data.to(self.device_), target.to(self.device_)
-                output = self.model_(data)
-                test_loss += self.loss_(output, target).item()
-                pred = output.argmax(dim=1, keepdim=True)
-                correct += pred.eq(target.view_as(pred)).sum().item()
+                output = self.forward(self.eval_model_, data)
+                test_loss += nn.functional.cross_entropy(
+                    output, target, reduction="sum"
+                )
+                correct += output.argmax(dim=1).eq(target).sum()
+                num_samples += target.size()[0]
 
-        test_loss /= len(self.test_loader_.dataset)
-        acc = correct / len(self.test_loader_.dataset)
+        test_loss = test_loss.item() / max(num_samples, 1)
+        acc = correct.item() / max(num_samples, 1)
 
         return test_loss, acc
 
@@ -250,11 +663,198 @@ class MnistTrainer:
             checkpoint: Previous model checkpoint from where training has to be started.
         """
         logger.debug("Start training")
+        start_time = time.time()
         self.local_train(checkpoint)
+        wall_time = time.time() - start_time
+        if self._rank != 0:
+            # the processes hold the same model, it is saved once by rank 0
+            return
+
+        update_spec = None
+        secure_aggregation_spec = None
+        if self._secure_aggregation is not None:
+            logger.debug("Save masked model")
+            secure_aggregation_spec = self.save_masked()
+        elif self._output_mode == "update" and self._base_state_dict is not None:
+            logger.debug("Save update")
+            update_spec = self.save_update()
+        else:
+            if self._output_mode == "update":
+                logger.warning(
+                    "No checkpoint to compute an update from, saving the full model instead"
+                )
+            logger.debug("Save model")
+            model_path = save_checkpoint(
+                self.model_.state_dict(),
+                os.path.dirname(self._model_path),
+                self._checkpoint_format,
+                name=os.path.splitext(os.path.basename(self._model_path))[0],
+            )
+            logger.info(f"Model saved to {model_path}")
+
+        self.save_metadata(wall_time, update_spec, secure_aggregation_spec)
 
-        logger.debug("Save model")
-        torch.save(self.model_.state_dict(), self._model_path)
-        logger.info(f"Model saved to {self._model_path}")
+    def save_masked(self):
+        """Save the model (or the update) masked with the self-mask and the pairwise masks of this silo.
+
+        The floating point tensors are saved as "masked", the other ones in the clear as "plain".
+
+        Returns:
+            dict: the spec required to aggregate the masked tensors (see secure_aggregation.mask_state_dict())
+        """
+        state_dict = {k: v.detach().cpu() for k, v in self.model_.state_dict().items()}
+        content = "model"
+        if self._output_mode == "update" and self._base_state_dict is not None:
+            state_dict = compute_update(state_dict, self._base_state_dict)
+            content = "update"
+
+        masked, plain, spec = mask_state_dict(
+            state_dict,
+            self._secure_aggregation["silo_index"],
+            self._secure_aggregation["pair_seeds"],
+            self._secure_aggregation["self_mask_seed"],
+            self._secure_aggregation["num_silos"],
+            self._secure_aggregation["precision_bits"],
+        )
+        model_folder = os.path.dirname(self._model_path)
+        masked_path = save_checkpoint(
+            masked, model_folder, self._checkpoint_format, name="masked"
+        )
+        if plain:
+            save_checkpoint(plain, model_folder, self._checkpoint_format, name="plain")
+        logger.info(
+            f"Masked {content} saved to {masked_path} (silo {spec['silo_index']} of {spec['num_silos']})"
+        )
+
+        spec["round"] = self._secure_aggregation["round"]
+        spec["content"] = content
+        # the orchestrator forwards the encrypted shares to the surviving silos
+        spec["threshold"] = self._secure_aggregation["threshold"]
+        spec["self_mask_shares"] = self._secure_aggregation["self_mask_shares"]
+        return spec
+
+    def save_update(self):
+        """Save the encoded difference between the trained model and the checkpoint it started from.
+
+        Returns:
+            dict: the spec required to decode the update (see update_codec.encode_update())
+        """
+        update = compute_update(self.model_.state_dict(), self._base_state_dict)
+
+        if self._topk_ratio is not None:
+            # error feedback: add back what previous rounds did not send
+            residual = self.load_residual()
+            if residual is not None:
+                update = {
+                    k: v + residual[k] if k in residual else v
+                    for k, v in update.items()
+                }
+
+        tensors, spec = encode_update(
+            update,
+            self._update_quantization,
+            self._quantization_granularity,
+            topk_ratio=self._topk_ratio,
+        )
+        decoded_update = decode_update(tensors, spec)
+
+        if self._topk_ratio is not None:
+            # keep what this round did not send for the next round
+            self.save_residual(
+                {
+                    k: v - to_dense(decoded_update[k])
+                    for k, v in update.items()
+                    if v.is_floating_point()
+                }
+            )
+
+        # measure what the encoding costs in precision and saves in bytes
+        compression_error = relative_error(update, decoded_update)
+        compression_ratio = encoded_size(update) / max(encoded_size(tensors), 1)
+        logger.info(
+            f"Update encoded with quantization={self._update_quantization}, topk_ratio={self._topk_ratio}: relative error {compression_error}, compression ratio {compression_ratio}"
+        )
+        with mlflow.start_run() as mlflow_run, self.get_mlflow_logger(
+            mlflow_run
+        ) as mlflow_logger:
+            self.log_metrics(
+                mlflow_logger,
+                "Update Compression Error",
+                compression_error,
+            )
+            self.log_metrics(
+                mlflow_logger,
+                "Update Compression Ratio",
+                compression_ratio,
+            )
+        self.report_logging(mlflow_logger)
+
+        update_path = save_checkpoint(
+            tensors,
+            os.path.dirname(self._model_path),
+            self._checkpoint_format,
+            name="update",
+        )
+        logger.info(f"Update saved to {update_path}")
+        return {
+            "quantization": self._update_quantization,
+            "granularity": self._quantization_granularity,
+            "tensors": spec,
+        }
+
+    def load_residual(self):
+        """Load the residual (update entries not sent) saved by the previous round, if any."""
+        if not self._previous_residual_path:
+            return None
+        if find_checkpoint(self._previous_residual_path, name="residual")[0] is None:
+            logger.info(f"No residual found in {self._previous_residual_path}")
+            return None
+        return load_checkpoint(self._previous_residual_path, name="residual")
+
+    def save_residual(self, residual):
+        """Save the residual (update entries not sent) for the next round.
+
+        Args:
+            residual (dict): str -> torch.Tensor, the compensated update minus what was sent
+        """
+        if not self._residual_path:
+            logger.warning("No residual output provided, error feedback is disabled")
+            return
+        # the residual stays in the silo, its chunks must not go to the shared chunk store
+        residual_path = save_checkpoint(
+            residual,
+            self._residual_path,
+            "mmap" if self._checkpoint_format == "chunked" else self._checkpoint_format,
+            name="residual",
+        )
+        logger.info(f"Residual saved to {residual_path}")
+
+    def save_metadata(self, wall_time, update_spec=None, secure_aggregation_spec=None):
+        """Write a metadata sidecar next to the model, used by the aggregation to weight silos.
+
+        Args:
+            wall_time (float): duration of the local training in seconds
+            update_spec (dict, optional): spec of the update, if an update was saved instead of the model
+            secure_aggregation_spec (dict, optional): spec of the masked tensors, if they were masked
+        """
+        metadata = {
+            "num_samples": len(self.train_dataset_),
+            "num_steps": self._num_steps,
+            "wall_time": wall_time,
+        }
+        if self._aggregation_weight is not None:
+            metadata["weight"] = self._aggregation_weight
+        if update_spec is not None:
+            metadata["update"] = update_spec
+        if self._deadline_reached:
+            metadata["deadline_reached"] = True
+        if secure_aggregation_spec is not None:
+            metadata["secure_aggregation"] = secure_aggregation_spec
+
+        metadata_path = os.path.join(os.path.dirname(self._model_path), "metadata.json")
+        with open(metadata_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        logger.info(f"Metadata saved to {metadata_path}")
 
 
 def get_arg_parser(parser=None):
@@ -294,27 +894,459 @@ def get_arg_parser(parser=None):
         required=False,
         help="Total number of epochs for local training",
     )
-    parser.add_argument("--batch_size", type=int, required=False, help="Batch Size")
+    parser.add_argument(
+        "--batch_size", type=int, required=False, default=64, help="Batch Size"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        required=False,
+        default=0,
+        help="Number of DataLoader worker processes (0: load the batches in the training process)",
+    )
+    parser.add_argument(
+        "--persistent_workers",
+        type=str,
+        required=False,
+        choices=["off", "on"],
+        default="on",
+        help="Keep the DataLoader workers alive from one epoch to the next (with num_workers > 0)",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        required=False,
+        help="Number of batches loaded in advance by each DataLoader worker (with num_workers > 0)",
+    )
+    parser.add_argument(
+        "--pin_memory",
+        type=str,
+        required=False,
+        choices=["auto", "off", "on"],
+        default="auto",
+        help="Load the batches in page-locked memory (auto: only when training on GPU)",
+    )
+    parser.add_argument(
+        "--sharing_strategy",
+        type=str,
+        required=False,
+        choices=torch.multiprocessing.get_all_sharing_strategies(),
+        help="Strategy used to share the batches of the DataLoader workers (file_system avoids running out of file descriptors)",
+    )
+    parser.add_argument(
+        "--dataset_cache",
+        type=str,
+        required=False,
+        choices=["off", "on"],
+        default="off",
+        help="Decode the image folders once, in parallel, and fetch whole batches from the decoded images (ignored for packed datasets)",
+    )
+    parser.add_argument(
+        "--dataset_cache_folder",
+        type=str,
+        required=False,
+        help="Local folder where the decoded images are persisted, to be reused by the next jobs on this compute",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        required=False,
+        choices=["fp32", "bf16"],
+        default="fp32",
+        help="Precision of the training and test forward passes: fp32, or bf16 (autocast, the weights stay in fp32)",
+    )
+    parser.add_argument(
+        "--channels_last",
+        type=str,
+        required=False,
+        choices=["off", "on"],
+        default="off",
+        help="Run the convolutions on channels_last (NHWC) tensors",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        type=str,
+        required=False,
+        choices=COMPILE_MODES,
+        default="off",
+        help="off: eager, compile: torch.compile, script: TorchScript tracing, auto: torch.compile if available, else TorchScript (falls back to eager on failure)",
+    )
+    parser.add_argument(
+        "--compile_cache_folder",
+        type=str,
+        required=False,
+        help="Local folder caching the compiled graphs for the next rounds on this compute (torch.compile only)",
+    )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of data parallel training processes forked on this node (gloo backend), each training on a shard of the data with batch_size samples per batch (ignored when started by a launcher setting WORLD_SIZE)",
+    )
+    parser.add_argument(
+        "--eval_batch_size",
+        type=int,
+        required=False,
+        default=None,
+        help="Test DataLoader batch size (default: --batch_size), larger batches make the tests faster",
+    )
+    parser.add_argument(
+        "--eval_every",
+        type=int,
+        required=False,
+        default=1,
+        help="Test every eval_every epochs, the last epoch is always tested",
+    )
+    parser.add_argument(
+        "--eval_subsample_size",
+        type=int,
+        required=False,
+        default=None,
+        help="Test the epochs before the last one on a fixed stratified subsample of about this many test samples (the last epoch is tested on the full test set)",
+    )
+    parser.add_argument(
+        "--log_flush_interval",
+        type=float,
+        required=False,
+        default=5.0,
+        help="Maximum number of seconds the metrics are buffered before being sent to mlflow (in batches, from a background thread)",
+    )
+    parser.add_argument(
+        "--log_batch_size",
+        type=int,
+        required=False,
+        default=1000,
+        help="Number of buffered metrics sending them to mlflow right away (at most 1000)",
+    )
+    parser.add_argument(
+        "--distributed_backend",
+        type=str,
+        required=False,
+        choices=["auto", "gloo", "nccl"],
+        default="auto",
+        help="Backend of the process group when started by a launcher (auto: nccl on gpu, gloo otherwise), --num_processes always uses gloo",
+    )
+    parser.add_argument(
+        "--aggregation_weight",
+        type=float,
+        required=False,
+        help="Custom weight of this silo, used by the aggregation when weighting=custom",
+    )
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        required=False,
+        choices=CHECKPOINT_FORMATS,
+        default="torch",
+        help="Format of the output checkpoint: torch (model.pt), mmap (model.tensors, memory-mapped flat file) or chunked (model.manifest.json, chunks in --chunk_store)",
+    )
+    parser.add_argument(
+        "--chunk_store",
+        type=str,
+        required=False,
+        default=None,
+        help="Root folder of the content-addressed chunk store shared by all the steps, required to read or write chunked checkpoints",
+    )
+    parser.add_argument(
+        "--chunk_cache",
+        type=str,
+        required=False,
+        default=None,
+        help="Local folder keeping a copy of the chunks read from the chunk store, so that they are not read again",
+    )
+    parser.add_argument(
+        "--output_mode",
+        type=str,
+        required=False,
+        choices=["model", "update"],
+        default="model",
+        help="Send the full model, or only the update relative to the checkpoint",
+    )
+    parser.add_argument(
+        "--update_quantization",
+        type=str,
+        required=False,
+        choices=UPDATE_QUANTIZATIONS,
+        default="none",
+        help="Encoding of the update when output_mode=update",
+    )
+    parser.add_argument(
+        "--quantization_granularity",
+        type=str,
+        required=False,
+        choices=QUANTIZATION_GRANULARITIES,
+        default="per_tensor",
+        help="Granularity of the int8 quantization scales",
+    )
+    parser.add_argument(
+        "--topk_ratio",
+        type=float,
+        required=False,
+        help="If set with output_mode=update, only send this fraction of the largest magnitude update entries",
+    )
+    parser.add_argument(
+        "--residual",
+        type=str,
+        required=False,
+        help="Output folder (in the silo) for the update entries not sent, used for error feedback",
+    )
+    parser.add_argument(
+        "--previous_residual",
+        type=str,
+        required=False,
+        help="Folder of the residual saved by the previous round",
+    )
+    parser.add_argument(
+        "--max_train_seconds",
+        type=float,
+        required=False,
+        help="Soft deadline: stop training at the first batch boundary after this many seconds, and still save the model",
+    )
+    parser.add_argument(
+        "--failure_mode",
+        type=str,
+        required=False,
+        choices=["raise", "skip"],
+        default="raise",
+        help="raise: fail the job on error, skip: write a failed metadata.json and succeed, so the aggregation can skip this silo",
+    )
+    parser.add_argument(
+        "--secagg_private_key",
+        type=str,
+        required=False,
+        help="If set, mask the output for secure aggregation: private key of this silo (private_key.json or its folder, see secure_aggregation.py keygen)",
+    )
+    parser.add_argument(
+        "--secagg_public_keys",
+        type=str,
+        required=False,
+        help="Json file with the public keys of all silos, in silo order",
+    )
+    parser.add_argument(
+        "--secagg_silo_index",
+        type=int,
+        required=False,
+        help="Index of this silo in the public keys",
+    )
+    parser.add_argument(
+        "--secagg_round",
+        type=str,
+        required=False,
+        help="Name of the round, the masks must change at every round (default: iteration_name)",
+    )
+    parser.add_argument(
+        "--secagg_precision_bits",
+        type=int,
+        required=False,
+        default=16,
+        help="Number of fractional bits of the fixed-point encoding of the masked values",
+    )
+    parser.add_argument(
+        "--secagg_threshold",
+        type=int,
+        required=False,
+        help="Number of surviving silos required to remove the self-mask of this silo, the same for all silos (default: a strict majority of the silos)",
+    )
     return parser
 
 
+def get_secure_aggregation(args):
+    """Derive the secure aggregation settings of this silo from the arguments.
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+
+    Returns:
+        dict: the secure_aggregation argument of MnistTrainer, or None if not enabled
+    """
+    if not args.secagg_private_key:
+        return None
+    if args.secagg_public_keys is None or args.secagg_silo_index is None:
+        raise ValueError(
+            "Secure aggregation requires --secagg_public_keys and --secagg_silo_index"
+        )
+    if args.update_quantization != "none" or args.topk_ratio is not None:
+        raise ValueError(
+            "Secure aggregation can not be combined with update_quantization or topk_ratio"
+        )
+    round_name = args.secagg_round or args.iteration_name
+    if not round_name:
+        raise ValueError(
+            "Secure aggregation requires a round name (--secagg_round or --iteration_name), unique to every round"
+        )
+
+    public_keys = load_public_keys(args.secagg_public_keys)
+    private_key = load_private_key(args.secagg_private_key)
+    threshold = args.secagg_threshold or get_default_threshold(len(public_keys))
+    self_mask_seed, self_mask_shares = make_self_mask(
+        private_key, public_keys, args.secagg_silo_index, round_name, threshold
+    )
+    return {
+        "silo_index": args.secagg_silo_index,
+        "num_silos": len(public_keys),
+        "round": round_name,
+        "precision_bits": args.secagg_precision_bits,
+        "pair_seeds": get_pair_seeds(
+            private_key, public_keys, args.secagg_silo_index, round_name
+        ),
+        "threshold": threshold,
+        "self_mask_seed": self_mask_seed,
+        "self_mask_shares": self_mask_shares,
+    }
+
+
+def train(args):
+    """Train in this process (one of the processes with data parallel training).
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+    """
+    try:
+        trainer = MnistTrainer(
+            train_data_dir=args.train_data,
+            test_data_dir=args.test_data,
+            model_path=args.model + "/model.pt",
+            lr=args.lr,
+            epochs=args.epochs,
+            batch_size=args.batch_size,
+            experiment_name=args.metrics_prefix,
+            iteration_name=args.iteration_name,
+            aggregation_weight=args.aggregation_weight,
+            checkpoint_format=args.checkpoint_format,
+            output_mode=args.output_mode,
+            update_quantization=args.update_quantization,
+            quantization_granularity=args.quantization_granularity,
+            topk_ratio=args.topk_ratio,
+            residual_path=args.residual,
+            previous_residual_path=args.previous_residual,
+            max_train_seconds=args.max_train_seconds,
+            secure_aggregation=get_secure_aggregation(args),
+            num_workers=args.num_workers,
+            persistent_workers=args.persistent_workers == "on",
+            prefetch_factor=args.prefetch_factor,
+            pin_memory=None if args.pin_memory == "auto" else args.pin_memory == "on",
+            sharing_strategy=args.sharing_strategy,
+            dataset_cache=args.dataset_cache == "on",
+            dataset_cache_folder=args.dataset_cache_folder,
+            precision=args.precision,
+            channels_last=args.channels_last == "on",
+            compile_mode=args.compile_mode,
+            compile_cache_folder=args.compile_cache_folder,
+            log_flush_interval=args.log_flush_interval,
+            log_batch_size=args.log_batch_size,
+            eval_batch_size=args.eval_batch_size,
+            eval_every=args.eval_every,
+            eval_subsample_size=args.eval_subsample_size,
+        )
+        trainer.execute(args.checkpoint)
+    except Exception as e:
+        if args.failure_mode != "skip":
+            raise
+        # a failed step would stop the pipeline, instead let the aggregation skip this silo
+        logger.exception("Training failed, the aggregation will skip this silo")
+        if torch.distributed.is_initialized() and torch.distributed.get_rank() != 0:
+            return
+        os.makedirs(args.model, exist_ok=True)
+        with open(os.path.join(args.model, "metadata.json"), "w") as metadata_file:
+            json.dump({"failed": True, "error": repr(e)}, metadata_file)
+
+
+def get_free_port():
+    """Get a free TCP port on this machine, for the rendezvous of the processes.
+
+    Returns:
+        int: the port
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+def get_backend(distributed_backend):
+    """Get the torch.distributed backend to use.
+
+    Args:
+        distributed_backend (str): auto, gloo or nccl
+
+    Returns:
+        str: gloo or nccl (auto: nccl if gpus are available, gloo otherwise)
+    """
+    if distributed_backend == "auto":
+        return "nccl" if torch.cuda.is_available() else "gloo"
+    return distributed_backend
+
+
+def run_distributed(args):
+    """Train in one process of a process group described by the environment.
+
+    The launcher (torchrun, or the AzureML pytorch distribution on a multi-node
+    compute) sets MASTER_ADDR, MASTER_PORT, WORLD_SIZE, RANK and LOCAL_RANK.
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+    """
+    backend = get_backend(args.distributed_backend)
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    torch.distributed.init_process_group(backend, init_method="env://")
+    logger.info(
+        f"Process {torch.distributed.get_rank()}/{torch.distributed.get_world_size()} (local rank {local_rank}, {backend}) joined the process group"
+    )
+    if "LOCAL_WORLD_SIZE" in os.environ:
+        # share the cores of the node between its processes
+        torch.set_num_threads(
+            max(1, (os.cpu_count() or 1) // int(os.environ["LOCAL_WORLD_SIZE"]))
+        )
+    try:
+        train(args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def run_process(rank, args, world_size, master_port):
+    """Train in one process of a data parallel process group on this node.
+
+    Args:
+        rank (int): rank of this process
+        args (argparse.namespace): command line arguments provided to script
+        world_size (int): number of processes
+        master_port (int): port of the rendezvous on this machine
+    """
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(master_port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+    # share the cores of the node between the processes
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    try:
+        train(args)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
 def run(args):
     """Run script with arguments (the core of the component).
 
     Args:
         args (argparse.namespace): command line arguments provided to script
     """
-
-    trainer = MnistTrainer(
-        train_data_dir=args.train_data,
-        test_data_dir=args.test_data,
-        model_path=args.model + "/model.pt",
-        lr=args.lr,
-        epochs=args.epochs,
-        experiment_name=args.metrics_prefix,
-        iteration_name=args.iteration_name,
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1:
+        # started by a launcher, possibly on several nodes
+        run_distributed(args)
+        return
+    if args.num_processes <= 1:
+        train(args)
+        return
+
+    logger.info(f"Data parallel training with {args.num_processes} processes (gloo)")
+    # forked processes inherit the logger of this script
+    torch.multiprocessing.start_processes(
+        run_process,
+        args=(args, args.num_processes, get_free_port()),
+        nprocs=args.num_processes,
+        start_method="fork",
     )
-    trainer.execute(args.checkpoint)
 
 
 def main(cli_args=None):
@@ -333,7 +1365,11 @@ def main(cli_args=None):
     args = parser.parse_args(cli_args)
 
     print(f"Running script with arguments: {args}")
+    if args.chunk_store:
+        set_chunk_store(ChunkStore(args.chunk_store, cache_folder=args.chunk_cache))
     run(args)
+    if args.chunk_store:
+        logger.info(f"Chunk store: {get_chunk_store().stats}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,678 @@
+"""Secure aggregation of silo updates with double masking (Bonawitz et al., 2017).
+
+Every silo adds to its update masks that only the sum over all silos gets rid
+of, so the orchestrator sees the sum of the updates and nothing else:
+- every pair of silos (i, j) agrees on a seed s_ij with a Diffie-Hellman key
+  exchange: silo i only needs its private key and the public key of silo j,
+- every silo i also draws a random self-mask seed b_i for the round, and
+  splits it into Shamir shares (any threshold t of them give b_i back): the
+  share of silo j is encrypted with a key only silos i and j can derive,
+  and sent along with the masked update,
+- a mask is a counter-based PRNG stream (Philox) keyed by its seed,
+  regenerated instead of being transmitted,
+- silo i sends enc(x_i) + PRG(b_i) + sum_{j > i} PRG(s_ij) - sum_{j < i} PRG(s_ij),
+  where enc is a fixed-point encoding in Z_2^32 (uint32 arithmetic wraps
+  around), so the masked update has the size of a float32 update.
+
+The pairwise masks cancel out in the sum, the self-masks do not: once the
+orchestrator has received the masked updates, every surviving silo j gets the
+metadata of the received silos and reveals (see reveal()), for every silo i:
+- its share of b_i if the update of silo i was received: t shares give b_i,
+  and PRG(b_i) is removed from the sum,
+- s_ij if silo i dropped out: PRG(s_ij) is removed from the sum,
+never both. The pair seeds of a dropped silo only unmask what it would have
+sent up to its self-mask, so an update received late (or withheld by the
+orchestrator) stays masked by PRG(b_i), whose shares are never revealed.
+The seeds are different for every round, so revealing them does not
+compromise the other rounds.
+
+Threat model: the orchestrator and the silos are honest but curious, and the
+orchestrator colludes with fewer than t silos. A malicious orchestrator could
+tell some survivors that silo i dropped out and others that it was received,
+and get both b_i and the s_ij: a silo refuses to reveal twice for a round
+with different received silos (see check_single_reveal()), but the survivors
+do not check that they were all given the same list. The encrypted shares are
+not authenticated, tampering with them corrupts the aggregate but does not
+leak updates.
+
+Only the floating point tensors are masked, the other ones (e.g. batch norm
+counters) are sent in the clear.
+
+This file is shared by the traininsilo and aggregatemodelweights components
+(a component only uploads its own folder), keep both copies identical.
+
+Round protocol. The reveal step runs between the training and the aggregation,
+the FL pipelines (fl_cross_silo_factory, fl_cross_silo_literal) do not run it
+and reject secure aggregation, so a round is driven by hand:
+1. once, every silo creates its key pair, in the silo:
+
+       python secure_aggregation.py keygen --output <silo private folder>
+
+   and the public keys (public_key.json) are gathered, in silo order, in a
+   json file {"public_keys": [hex, ...]} given to every silo,
+2. every silo trains with --secagg_private_key, --secagg_public_keys,
+   --secagg_silo_index and a --secagg_round unique to the round (and to the
+   run: reusing a round name reuses the pair masks),
+3. the orchestrator gives the metadata.json of every silo it received (not
+   the masked checkpoints) to every surviving silo, which runs:
+
+       python secure_aggregation.py reveal --private_key <silo private folder>
+           --public_keys <public keys> --silo_index <index> --round <round>
+           --received <metadata.json of every received silo> --output <json file>
+
+4. the aggregation runs with the json files of the survivors in the folder
+   given to --secagg_recovery: the shares of at least threshold survivors
+   are required, and the seeds of every survivor if a silo dropped out.
+"""
+import argparse
+import hashlib
+import json
+import os
+import secrets
+
+import numpy as np
+import torch
+
+# RFC 3526 2048-bit MODP group (group 14)
+DH_PRIME = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF",
+    16,
+)
+DH_GENERATOR = 2
+# the Shamir shares of the self-mask seeds live in Z_p, with p = 2^127 - 1 (prime)
+SHARE_PRIME = 2**127 - 1
+
+
+def generate_keypair():
+    """Generate a Diffie-Hellman key pair.
+
+    Returns:
+        int: the private key, to keep in the silo
+        int: the public key, to share with the other silos
+    """
+    private_key = secrets.randbelow(DH_PRIME - 3) + 2
+    return private_key, pow(DH_GENERATOR, private_key, DH_PRIME)
+
+
+def save_keypair(folder):
+    """Generate a key pair and save it as private_key.json and public_key.json in a folder.
+
+    Returns:
+        str: path of the public key file
+    """
+    private_key, public_key = generate_keypair()
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "private_key.json"), "w") as key_file:
+        json.dump({"private_key": format(private_key, "x")}, key_file)
+    public_key_path = os.path.join(folder, "public_key.json")
+    with open(public_key_path, "w") as key_file:
+        json.dump({"public_key": format(public_key, "x")}, key_file)
+    return public_key_path
+
+
+def load_private_key(path):
+    """Load a private key from a private_key.json file, or a folder containing one."""
+    if os.path.isdir(path):
+        path = os.path.join(path, "private_key.json")
+    with open(path, "r") as key_file:
+        return int(json.load(key_file)["private_key"], 16)
+
+
+def load_public_keys(path):
+    """Load the public keys of all silos, in silo order.
+
+    Args:
+        path (str): json file {"public_keys": [hex, ...]}
+
+    Returns:
+        List[int]: the public keys
+    """
+    with open(path, "r") as keys_file:
+        return [int(key, 16) for key in json.load(keys_file)["public_keys"]]
+
+
+def derive_shared_key(private_key, peer_public_key, label):
+    """Derive a 128 bits key shared by two silos, from a Diffie-Hellman exchange.
+
+    Both silos get the same key: g^(a*b) mod p is hashed with the label.
+
+    Args:
+        private_key (int): private key of this silo
+        peer_public_key (int): public key of the other silo
+        label (str): what the key is used for (pair, round...)
+
+    Returns:
+        int: the key
+    """
+    shared_secret = pow(peer_public_key, private_key, DH_PRIME)
+    digest = hashlib.sha256(
+        f"{label}:".encode()
+        + shared_secret.to_bytes((DH_PRIME.bit_length() + 7) // 8, "big")
+    ).digest()
+    return int.from_bytes(digest[:16], "big")
+
+
+def derive_pair_seed(private_key, peer_public_key, silo_index, peer_index, round_name):
+    """Derive the seed of a pair of silos for a round, from a Diffie-Hellman exchange.
+
+    Args:
+        private_key (int): private key of this silo
+        peer_public_key (int): public key of the other silo
+        silo_index (int): index of this silo
+        peer_index (int): index of the other silo
+        round_name (str): name of the round (the seeds change at every round)
+
+    Returns:
+        int: the 128 bits seed of the pair
+    """
+    return derive_shared_key(
+        private_key,
+        peer_public_key,
+        f"{min(silo_index, peer_index)}-{max(silo_index, peer_index)}-{round_name}",
+    )
+
+
+def derive_share_key(
+    private_key, peer_public_key, sender_index, recipient_index, round_name
+):
+    """Derive the key encrypting the self-mask share a silo sends to another one for a round.
+
+    The silo also sends a share to itself, with a key derived from its own key pair.
+
+    Args:
+        private_key (int): private key of this silo
+        peer_public_key (int): public key of the other silo
+        sender_index (int): index of the silo whose self-mask seed is shared
+        recipient_index (int): index of the silo receiving the share
+        round_name (str): name of the round
+
+    Returns:
+        int: the 128 bits key of the share
+    """
+    return derive_shared_key(
+        private_key,
+        peer_public_key,
+        f"share-{sender_index}-{recipient_index}-{round_name}",
+    )
+
+
+def get_pair_seeds(private_key, public_keys, silo_index, round_name, peers=None):
+    """Derive the seeds of a silo with the other silos.
+
+    Args:
+        private_key (int): private key of this silo
+        public_keys (List[int]): public keys of all silos, in silo order
+        silo_index (int): index of this silo
+        round_name (str): name of the round
+        peers (List[int]): indices of the other silos (default: all of them)
+
+    Returns:
+        dict: peer index -> seed
+    """
+    if peers is None:
+        peers = [index for index in range(len(public_keys)) if index != silo_index]
+    return dict(
+        (
+            peer,
+            derive_pair_seed(
+                private_key, public_keys[peer], silo_index, peer, round_name
+            ),
+        )
+        for peer in peers
+    )
+
+
+def get_default_threshold(num_silos):
+    """Number of shares required to recover a self-mask seed: a strict majority of the silos."""
+    return num_silos // 2 + 1
+
+
+def split_secret(secret, num_shares, threshold):
+    """Split a secret of Z_p into Shamir shares, any threshold of them give it back.
+
+    Args:
+        secret (int): the secret, below SHARE_PRIME
+        num_shares (int): number of shares
+        threshold (int): number of shares required to recover the secret
+
+    Returns:
+        List[int]: the shares, share k is the random polynomial evaluated at k + 1
+    """
+    if not 1 <= threshold <= num_shares:
+        raise ValueError(
+            f"The threshold must be between 1 and the number of silos ({num_shares}), got {threshold}"
+        )
+    coefficients = [secret] + [
+        secrets.randbelow(SHARE_PRIME) for _ in range(threshold - 1)
+    ]
+    shares = []
+    for x in range(1, num_shares + 1):
+        y = 0
+        for coefficient in reversed(coefficients):
+            y = (y * x + coefficient) % SHARE_PRIME
+        shares.append(y)
+    return shares
+
+
+def combine_shares(shares):
+    """Recover a secret from its Shamir shares (Lagrange interpolation at 0).
+
+    Args:
+        shares (dict): share index -> share, see split_secret()
+
+    Returns:
+        int: the secret
+    """
+    secret = 0
+    for index, share in shares.items():
+        numerator, denominator = 1, 1
+        for other in shares:
+            if other != index:
+                numerator = numerator * (other + 1) % SHARE_PRIME
+                denominator = denominator * (other - index) % SHARE_PRIME
+        # modular inverse by Fermat's little theorem (pow(x, -1, p) requires python 3.8)
+        secret += share * numerator * pow(denominator, SHARE_PRIME - 2, SHARE_PRIME)
+    return secret % SHARE_PRIME
+
+
+def make_self_mask(private_key, public_keys, silo_index, round_name, threshold):
+    """Draw the self-mask seed of a silo for a round, and its encrypted shares.
+
+    Args:
+        private_key (int): private key of this silo
+        public_keys (List[int]): public keys of all silos, in silo order
+        silo_index (int): index of this silo
+        round_name (str): name of the round
+        threshold (int): number of shares required to recover the seed
+
+    Returns:
+        int: the self-mask seed, to mask the update with (and forget)
+        dict: "<recipient index>" -> hex encrypted share, to send with the masked update
+    """
+    seed = secrets.randbelow(SHARE_PRIME)
+    shares = split_secret(seed, len(public_keys), threshold)
+    return seed, dict(
+        (
+            str(recipient),
+            format(
+                share
+                ^ derive_share_key(
+                    private_key,
+                    public_keys[recipient],
+                    silo_index,
+                    recipient,
+                    round_name,
+                ),
+                "x",
+            ),
+        )
+        for recipient, share in enumerate(shares)
+    )
+
+
+def iter_masks(seed, numels):
+    """Regenerate a mask (of a pair of silos, or a self-mask), one tensor at a time.
+
+    Args:
+        seed (int): seed of the mask
+        numels (List[int]): number of entries of every masked tensor, in order
+
+    Yields:
+        np.ndarray: uint32 mask of every tensor
+    """
+    bit_generator = np.random.Philox(key=seed)
+    for numel in numels:
+        # each 64 bits draw of the stream gives the masks of 2 entries
+        yield bit_generator.random_raw((numel + 1) // 2).view(np.uint32)[:numel]
+
+
+def encode_fixed_point(tensor, precision_bits, clip):
+    """Encode a float tensor in Z_2^32 with precision_bits fractional bits.
+
+    Args:
+        tensor (torch.Tensor): float tensor
+        precision_bits (int): number of fractional bits
+        clip (float): values are clipped to [-clip, clip] so that sums do not overflow
+
+    Returns:
+        np.ndarray: flat uint32 array
+    """
+    values = tensor.detach().cpu().double().reshape(-1).numpy()
+    values = np.round(np.clip(values, -clip, clip) * 2.0**precision_bits)
+    # two's complement: negative values wrap around 2^32
+    return values.astype(np.int64).astype(np.uint32)
+
+
+def decode_fixed_point(array, precision_bits):
+    """Decode a flat uint32 array encoded with encode_fixed_point() as a float64 tensor."""
+    return torch.from_numpy(array.view(np.int32).astype(np.float64)) / (
+        2.0**precision_bits
+    )
+
+
+def get_clip(precision_bits, num_silos):
+    """Largest absolute value a silo can send without overflowing the sum of num_silos silos."""
+    return (2.0 ** (31 - precision_bits) - 1.0) / num_silos
+
+
+def mask_state_dict(
+    state_dict, silo_index, pair_seeds, self_mask_seed, num_silos, precision_bits=16
+):
+    """Mask the floating point tensors of a silo state_dict (or update).
+
+    Args:
+        state_dict (dict): the silo state_dict (or update)
+        silo_index (int): index of this silo
+        pair_seeds (dict): seed of every other silo, see get_pair_seeds()
+        self_mask_seed (int): self-mask seed of this silo, see make_self_mask()
+        num_silos (int): number of silos in the federation
+        precision_bits (int): number of fractional bits of the fixed-point encoding
+
+    Returns:
+        dict: the masked tensors, as int32 tensors holding the uint32 bits
+        dict: the other tensors, in the clear
+        dict: spec of the masked tensors, to be saved in metadata.json (see unmask_sum())
+    """
+    keys = [k for k, v in state_dict.items() if v.is_floating_point()]
+    clip = get_clip(precision_bits, num_silos)
+    masked = dict(
+        (k, encode_fixed_point(state_dict[k], precision_bits, clip)) for k in keys
+    )
+    numels = [masked[k].size for k in keys]
+    for k, mask in zip(keys, iter_masks(self_mask_seed, numels)):
+        # uint32 arithmetic is modulo 2^32
+        masked[k] += mask
+    for peer, seed in sorted(pair_seeds.items()):
+        for k, mask in zip(keys, iter_masks(seed, numels)):
+            if silo_index < peer:
+                masked[k] += mask
+            else:
+                masked[k] -= mask
+
+    spec = {
+        "silo_index": silo_index,
+        "num_silos": num_silos,
+        "precision_bits": precision_bits,
+        "tensors": dict(
+            (
+                k,
+                {
+                    "shape": list(state_dict[k].shape),
+                    "dtype": str(state_dict[k].dtype).replace("torch.", ""),
+                },
+            )
+            for k in keys
+        ),
+    }
+    return (
+        dict(
+            (k, torch.from_numpy(masked[k].view(np.int32)).reshape(state_dict[k].shape))
+            for k in keys
+        ),
+        dict((k, v) for k, v in state_dict.items() if not v.is_floating_point()),
+        spec,
+    )
+
+
+def reveal(private_key, public_keys, silo_index, received_specs, round_name):
+    """Seeds a surviving silo reveals for the aggregation to remove the masks.
+
+    For every silo, either its self-mask share (the update of the silo was
+    received) or its pair seed (the silo dropped out) is revealed, never both.
+
+    Args:
+        private_key (int): private key of this silo
+        public_keys (List[int]): public keys of all silos, in silo order
+        silo_index (int): index of this silo
+        received_specs (List[dict]): secure aggregation spec of every silo the orchestrator received (see mask_state_dict())
+        round_name (str): name of the round
+
+    Returns:
+        dict: {"round": round_name, "silo_index": silo_index, "received": [silo indices],
+        "seeds": {"<silo_index>-<dropped index>": hex seed},
+        "self_mask_shares": {"<silo_index>-<received index>": hex share}}
+
+    Raises:
+        ValueError: if the received silos do not belong to this round, or do not include this silo
+    """
+    received = {}
+    for spec in received_specs:
+        if spec["round"] != round_name or spec["num_silos"] != len(public_keys):
+            raise ValueError(
+                f"Silo {spec['silo_index']} was received for round {spec['round']} with {spec['num_silos']} silos, not round {round_name} with {len(public_keys)} silos"
+            )
+        if spec["silo_index"] in received:
+            raise ValueError(f"Silo {spec['silo_index']} was received twice")
+        received[spec["silo_index"]] = spec
+    if silo_index not in received:
+        raise ValueError(
+            f"The update of silo {silo_index} was not received, a dropped silo has nothing to reveal"
+        )
+
+    dropped = sorted(set(range(len(public_keys))) - set(received))
+    seeds = get_pair_seeds(private_key, public_keys, silo_index, round_name, dropped)
+    shares = dict(
+        (
+            sender,
+            int(spec["self_mask_shares"][str(silo_index)], 16)
+            ^ derive_share_key(
+                private_key, public_keys[sender], sender, silo_index, round_name
+            ),
+        )
+        for sender, spec in received.items()
+    )
+    return {
+        "round": round_name,
+        "silo_index": silo_index,
+        "received": sorted(received),
+        "seeds": dict(
+            (f"{silo_index}-{peer}", format(seed, "x")) for peer, seed in seeds.items()
+        ),
+        "self_mask_shares": dict(
+            (f"{silo_index}-{sender}", format(share, "x"))
+            for sender, share in sorted(shares.items())
+        ),
+    }
+
+
+def check_single_reveal(log_path, round_name, received):
+    """Refuse to reveal the seeds of a round again for other received silos.
+
+    Revealing for two lists of received silos could give both the self-mask
+    seed and the pair seeds of a silo. The rounds revealed are logged in a
+    json file {round: [received silo indices]}.
+
+    Args:
+        log_path (str): json file logging the rounds revealed by this silo
+        round_name (str): name of the round
+        received (List[int]): indices of the received silos
+
+    Raises:
+        ValueError: if the round was already revealed for other received silos
+    """
+    revealed_rounds = {}
+    if os.path.isfile(log_path):
+        with open(log_path, "r") as log_file:
+            revealed_rounds = json.load(log_file)
+    if revealed_rounds.get(round_name, received) != received:
+        raise ValueError(
+            f"The seeds of round {round_name} were already revealed for the received silos {revealed_rounds[round_name]}, refusing to reveal them for {received}"
+        )
+    revealed_rounds[round_name] = received
+    with open(log_path, "w") as log_file:
+        json.dump(revealed_rounds, log_file)
+
+
+def unmask_sum(masked_sum, spec, survivors, reveals=None):
+    """Remove the self-masks of the surviving silos and the pair masks of the dropped silos from the sum of the masked tensors, and decode it.
+
+    Args:
+        masked_sum (dict): key -> flat uint32 sum of the masked tensors of the surviving silos
+        spec (dict): spec of the masked tensors, see mask_state_dict()
+        survivors (List[int]): indices of the silos in the sum
+        reveals (List[dict]): what the surviving silos revealed for this sum, see reveal()
+
+    Returns:
+        dict: the decoded float64 sum of the tensors (not averaged)
+
+    Raises:
+        ValueError: if a seed or too few shares were revealed to remove the masks, or if they were revealed for other silos
+    """
+    keys = list(spec["tensors"].keys())
+    numels = [masked_sum[k].size for k in keys]
+    dropped = sorted(set(range(spec["num_silos"])) - set(survivors))
+
+    revealed_seeds = {}
+    revealed_shares = {}
+    for revealed in reveals or []:
+        if revealed["received"] != sorted(survivors):
+            raise ValueError(
+                f"Silo {revealed['silo_index']} revealed its seeds for the silos {revealed['received']}, the sum is over the silos {sorted(survivors)}"
+            )
+        revealed_seeds.update(revealed["seeds"])
+        revealed_shares.update(revealed["self_mask_shares"])
+
+    missing = [
+        f"{survivor}-{peer}"
+        for survivor in survivors
+        for peer in dropped
+        if f"{survivor}-{peer}" not in revealed_seeds
+    ]
+    if missing:
+        raise ValueError(
+            f"Silos {dropped} dropped out, the seeds of the pairs {missing} must be revealed by the surviving silos (see reveal())"
+        )
+
+    self_mask_seeds = {}
+    for silo in survivors:
+        shares = dict(
+            (revealer, int(revealed_shares[f"{revealer}-{silo}"], 16))
+            for revealer in survivors
+            if f"{revealer}-{silo}" in revealed_shares
+        )
+        if len(shares) < spec["threshold"]:
+            raise ValueError(
+                f"The self-mask of silo {silo} requires the shares of {spec['threshold']} surviving silos, {len(shares)} were revealed (see reveal())"
+            )
+        self_mask_seeds[silo] = combine_shares(shares)
+
+    masked_sum = dict((k, masked_sum[k].copy()) for k in keys)
+    for seed in self_mask_seeds.values():
+        for k, mask in zip(keys, iter_masks(seed, numels)):
+            masked_sum[k] -= mask
+    for survivor in survivors:
+        for peer in dropped:
+            seed = int(revealed_seeds[f"{survivor}-{peer}"], 16)
+            for k, mask in zip(keys, iter_masks(seed, numels)):
+                # remove what the survivor added for this pair
+                if survivor < peer:
+                    masked_sum[k] -= mask
+                else:
+                    masked_sum[k] += mask
+
+    return dict(
+        (
+            k,
+            decode_fixed_point(masked_sum[k], spec["precision_bits"]).reshape(
+                spec["tensors"][k]["shape"]
+            ),
+        )
+        for k in keys
+    )
+
+
+def load_received_spec(path):
+    """Load the secure aggregation spec of a received silo, from its metadata.json (or its folder)."""
+    if os.path.isdir(path):
+        path = os.path.join(path, "metadata.json")
+    with open(path, "r") as metadata_file:
+        metadata = json.load(metadata_file)
+    return metadata.get("secure_aggregation", metadata)
+
+
+def get_arg_parser(parser=None):
+    """Parse the command line arguments of the key management commands using argparse.
+
+    Args:
+        parser (argparse.ArgumentParser or CompliantArgumentParser):
+        an argument parser instance
+
+    Returns:
+        ArgumentParser: the argument parser instance
+
+    Notes:
+        if parser is None, creates a new parser instance
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "command",
+        type=str,
+        choices=["keygen", "reveal"],
+        help="keygen: create the key pair of a silo, reveal: write the seeds and shares this silo reveals for the received silos",
+    )
+    parser.add_argument(
+        "--output", type=str, required=True, help="Output folder (or file for reveal)"
+    )
+    parser.add_argument("--private_key", type=str, required=False)
+    parser.add_argument("--public_keys", type=str, required=False)
+    parser.add_argument("--silo_index", type=int, required=False)
+    parser.add_argument(
+        "--received",
+        type=str,
+        nargs="+",
+        required=False,
+        help="metadata.json (or model folder) of every silo received by the orchestrator",
+    )
+    parser.add_argument("--round", type=str, required=False)
+    return parser
+
+
+def main(cli_args=None):
+    """Key management main function.
+
+    Args:
+        cli_args (List[str], optional): list of args to feed script, useful for debugging. Defaults to None.
+    """
+    parser = get_arg_parser()
+    args = parser.parse_args(cli_args)
+
+    if args.command == "keygen":
+        print(f"Public key saved to {save_keypair(args.output)}")
+        return
+
+    revealed = reveal(
+        load_private_key(args.private_key),
+        load_public_keys(args.public_keys),
+        args.silo_index,
+        [load_received_spec(path) for path in args.received],
+        args.round,
+    )
+    # the log is kept next to the private key, in the silo
+    key_folder = (
+        args.private_key
+        if os.path.isdir(args.private_key)
+        else os.path.dirname(args.private_key)
+    )
+    check_single_reveal(
+        os.path.join(key_folder, "revealed_rounds.json"),
+        args.round,
+        revealed["received"],
+    )
+    with open(args.output, "w") as seeds_file:
+        json.dump(revealed, seeds_file)
+    print(
+        f"Silo {args.silo_index} revealed its shares for silos {revealed['received']} and its seeds with the other silos to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Encode and decode model updates (deltas) sent from the silos to the orchestrator.
+
+An update is a state_dict of differences between the model trained in the silo
+and the checkpoint the silo started from. It is encoded into a flat dict of
+tensors (so it can be written with any format of model_io) plus a json spec
+describing how to decode every key, stored in the silo metadata sidecar.
+
+Updates can be quantized (fp16, bf16, int8) and/or sparsified by keeping only
+the top-k largest magnitude entries of each tensor, as (indices, values).
+Sparsified keys are decoded as torch sparse COO tensors so that the aggregation
+can add them into a dense accumulator without densifying them.
+
+This module is duplicated in the traininsilo and aggregatemodelweights components
+(each component only uploads its own folder), please keep both copies identical.
+"""
+import math
+
+import torch
+
+UPDATE_QUANTIZATIONS = ["none", "fp16", "bf16", "int8"]
+QUANTIZATION_GRANULARITIES = ["per_tensor", "per_channel"]
+
+# suffix of the extra tensors stored alongside an encoded key
+SCALE_SUFFIX = "::scale"
+INDICES_SUFFIX = "::indices"
+
+_CAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+_DTYPES = {
+    str(dtype).replace("torch.", ""): dtype
+    for dtype in [
+        torch.float64,
+        torch.float32,
+        torch.float16,
+        torch.bfloat16,
+        torch.int64,
+        torch.int32,
+        torch.int16,
+        torch.int8,
+        torch.uint8,
+        torch.bool,
+    ]
+}
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace("torch.", "")
+
+
+def compute_update(state_dict, base_state_dict):
+    """Compute the difference between a state_dict and the one it started from.
+
+    Args:
+        state_dict (dict): trained state_dict
+        base_state_dict (dict): state_dict before training
+
+    Returns:
+        dict: str -> torch.Tensor, state_dict - base_state_dict (same dtypes)
+    """
+    return {
+        key: state_dict[key].detach().cpu() - base_state_dict[key].cpu()
+        for key in state_dict.keys()
+    }
+
+
+def _quantize_int8(tensor, granularity):
+    """Symmetric int8 quantization, one scale per tensor or per output channel (dim 0)."""
+    tensor = tensor.float()
+    if granularity == "per_channel" and tensor.dim() > 1:
+        max_abs = tensor.abs().reshape(tensor.shape[0], -1).amax(dim=1)
+        scale = max_abs / 127.0
+        scale[scale == 0] = 1.0
+        quantized = tensor / scale.reshape(-1, *([1] * (tensor.dim() - 1)))
+    else:
+        max_abs = tensor.abs().max() if tensor.numel() > 0 else torch.tensor(0.0)
+        scale = (max_abs / 127.0).reshape(1)
+        scale[scale == 0] = 1.0
+        quantized = tensor / scale
+    return quantized.round_().clamp_(-127, 127).to(torch.int8), scale
+
+
+def _quantize_values(tensors, key, values, quantization, granularity):
+    """Store values under key with the given quantization, return the value encoding."""
+    if quantization == "none":
+        tensors[key] = values
+        return "dense"
+    if quantization in _CAST_DTYPES:
+        tensors[key] = values.to(_CAST_DTYPES[quantization])
+        return "cast"
+    tensors[key], tensors[key + SCALE_SUFFIX] = _quantize_int8(values, granularity)
+    return "int8"
+
+
+def encode_update(
+    update, quantization="none", granularity="per_tensor", topk_ratio=None
+):
+    """Encode an update for transmission.
+
+    Only floating point tensors are quantized or sparsified, other tensors
+    (e.g. batchnorm counters) are sent as is.
+
+    Args:
+        update (dict): str -> torch.Tensor, see compute_update()
+        quantization (str): none, fp16, bf16 or int8
+        granularity (str): per_tensor or per_channel (int8 scales, dense tensors only)
+        topk_ratio (float): if set, only keep this fraction of the largest magnitude entries of each tensor
+
+    Returns:
+        dict: str -> torch.Tensor, the encoded tensors
+        dict: the json-serializable spec required by decode_update()
+    """
+    if quantization not in UPDATE_QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown quantization {quantization}, use one of {UPDATE_QUANTIZATIONS}"
+        )
+    if granularity not in QUANTIZATION_GRANULARITIES:
+        raise ValueError(
+            f"Unknown granularity {granularity}, use one of {QUANTIZATION_GRANULARITIES}"
+        )
+
+    if topk_ratio is not None and not 0.0 < topk_ratio <= 1.0:
+        raise ValueError(f"topk_ratio should be in ]0, 1], got {topk_ratio}")
+
+    tensors = {}
+    spec = {}
+    for key, tensor in update.items():
+        entry = {"dtype": _dtype_name(tensor.dtype), "shape": list(tensor.shape)}
+        if not tensor.is_floating_point():
+            entry["encoding"] = "dense"
+            tensors[key] = tensor
+        elif topk_ratio is not None and tensor.dim() > 0:
+            flat = tensor.reshape(-1)
+            k = max(1, int(math.ceil(topk_ratio * flat.numel())))
+            indices = flat.abs().topk(k, sorted=False).indices
+            tensors[key + INDICES_SUFFIX] = indices.to(
+                torch.int32 if flat.numel() < 2**31 else torch.int64
+            )
+            entry["encoding"] = "topk"
+            entry["values"] = _quantize_values(
+                tensors, key, flat[indices], quantization, "per_tensor"
+            )
+        else:
+            entry["encoding"] = _quantize_values(
+                tensors, key, tensor, quantization, granularity
+            )
+        spec[key] = entry
+    return tensors, spec
+
+
+def _dequantize_values(tensors, key, encoding, dtype):
+    """Read back the values stored under key, see _quantize_values()."""
+    if encoding == "int8":
+        scale = tensors[key + SCALE_SUFFIX].float()
+        values = tensors[key].float()
+        if scale.numel() > 1:
+            scale = scale.reshape(-1, *([1] * (values.dim() - 1)))
+        return (values * scale).to(dtype)
+    return tensors[key].to(dtype)
+
+
+def _unravel_index(flat_indices, shape):
+    """Convert indices in a flattened tensor into coordinates, shape [len(shape), nnz]."""
+    coordinates = []
+    for dim in reversed(shape):
+        coordinates.append(flat_indices % dim)
+        flat_indices = flat_indices // dim
+    return torch.stack(coordinates[::-1])
+
+
+def decode_tensor(tensors, spec, key):
+    """Decode a single key of an encoded update.
+
+    Args:
+        tensors (dict): encoded tensors, see encode_update()
+        spec (dict): encoding spec, see encode_update()
+        key (str): key to decode
+
+    Returns:
+        torch.Tensor: the decoded update for this key, in its original dtype
+            (a sparse COO tensor for top-k encoded keys)
+    """
+    entry = spec[key]
+    dtype = _DTYPES[entry["dtype"]]
+    if entry["encoding"] == "topk":
+        values = _dequantize_values(tensors, key, entry["values"], dtype)
+        indices = _unravel_index(tensors[key + INDICES_SUFFIX].long(), entry["shape"])
+        return torch.sparse_coo_tensor(
+            indices, values, entry["shape"], dtype=dtype
+        ).coalesce()
+    return _dequantize_values(tensors, key, entry["encoding"], dtype)
+
+
+def decode_update(tensors, spec):
+    """Decode an encoded update.
+
+    Args:
+        tensors (dict): encoded tensors, see encode_update()
+        spec (dict): encoding spec, see encode_update()
+
+    Returns:
+        dict: str -> torch.Tensor, the decoded update in its original dtypes
+            (sparse COO tensors for top-k encoded keys)
+    """
+    return {key: decode_tensor(tensors, spec, key) for key in spec.keys()}
+
+
+def to_dense(tensor):
+    """Return a dense version of a (possibly sparse) decoded tensor."""
+    return tensor.to_dense() if tensor.is_sparse else tensor
+
+
+def relative_error(update, decoded_update):
+    """Relative L2 error introduced by encoding, over all floating point tensors.
+
+    Args:
+        update (dict): original update
+        decoded_update (dict): update after encode_update() / decode_update()
+
+    Returns:
+        float: ||update - decoded|| / ||update||
+    """
+    error = 0.0
+    norm = 0.0
+    for key, tensor in update.items():
+        if not tensor.is_floating_point():
+            continue
+        decoded = to_dense(decoded_update[key]).double()
+        error += (tensor.double() - decoded).pow(2).sum().item()
+        norm += tensor.double().pow(2).sum().item()
+    return (error / norm) ** 0.5 if norm > 0 else 0.0
+
+
+def encoded_size(tensors):
+    """Number of bytes of the encoded tensors."""
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
@@ -0,0 +1,341 @@
+"""Run asynchronous buffered federated learning (FedBuff) on one machine.
+
+A local directory stands in for the datastore (see FolderStore in the
+aggregatemodelweights component). The asynchronous aggregator
+(aggregatemodelweights/async_run.py) runs in its own process, and every silo
+runs in a loop: pull the latest global version, train on it with the
+traininsilo component, submit the update to the store, repeat. Silos can be
+slowed down with --silo_delays to simulate heterogeneous silos.
+
+Example:
+    python run_local.py --train_data <train folder> --test_data <test folder> \\
+        --num_silos 3 --silo_delays 0 5 10 --buffer_size 2 --num_versions 5
+"""
+import os
+import sys
+import argparse
+import logging
+import subprocess
+import tempfile
+import threading
+import time
+
+# path to the components
+COMPONENTS_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "MNIST"
+)
+AGGREGATION_FOLDER = os.path.join(COMPONENTS_FOLDER, "aggregatemodelweights")
+TRAINING_SCRIPT = os.path.join(COMPONENTS_FOLDER, "traininsilo", "run.py")
+
+sys.path.insert(0, AGGREGATION_FOLDER)
+from async_store import FolderStore  # noqa: E402
+
+
+def get_arg_parser(parser=None):
+    """Parse the command line arguments using argparse.
+
+    Args:
+        parser (argparse.ArgumentParser or CompliantArgumentParser):
+        an argument parser instance
+
+    Returns:
+        ArgumentParser: the argument parser instance
+
+    Notes:
+        if parser is None, creates a new parser instance
+    """
+    if parser is None:
+        parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        "--train_data",
+        type=str,
+        required=True,
+        help="Preprocessed training data, used by every silo",
+    )
+    parser.add_argument(
+        "--test_data",
+        type=str,
+        required=True,
+        help="Preprocessed testing data, used by every silo",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        required=False,
+        default=None,
+        help="Local directory standing in for the datastore (default: a new temporary directory)",
+    )
+    parser.add_argument("--num_silos", type=int, required=False, default=3)
+    parser.add_argument(
+        "--silo_delays",
+        type=float,
+        nargs="*",
+        required=False,
+        default=[],
+        help="Extra seconds waited by each silo after every training, to simulate slow silos",
+    )
+    parser.add_argument("--buffer_size", type=int, required=False, default=2)
+    parser.add_argument("--num_versions", type=int, required=False, default=5)
+    parser.add_argument(
+        "--staleness_weighting", type=str, required=False, default="polynomial"
+    )
+    parser.add_argument(
+        "--server_optimizer", type=str, required=False, default="fedavg"
+    )
+    parser.add_argument("--server_lr", type=float, required=False, default=1.0)
+    parser.add_argument(
+        "--checkpoint_format", type=str, required=False, default="torch"
+    )
+    parser.add_argument("--epochs", type=int, required=False, default=1)
+    parser.add_argument("--lr", type=float, required=False, default=0.01)
+    parser.add_argument("--batch_size", type=int, required=False, default=64)
+    parser.add_argument(
+        "--update_quantization", type=str, required=False, default="none"
+    )
+    parser.add_argument("--topk_ratio", type=float, required=False, default=None)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        required=False,
+        default=600,
+        help="Stop the aggregator if no update arrives for this number of seconds",
+    )
+    return parser
+
+
+def get_training_command(args, checkpoint, model, residual, previous_residual):
+    """Build the command line of a training in a silo.
+
+    Args:
+        args (argparse.namespace): command line arguments of this script
+        checkpoint (str): global version folder to start from (None to start from scratch)
+        model (str): output folder of the training
+        residual (str): output folder of the update residual
+        previous_residual (str): residual of the previous training in this silo (or None)
+
+    Returns:
+        List[str]: the command line
+    """
+    command = [
+        sys.executable,
+        TRAINING_SCRIPT,
+        "--train_data",
+        args.train_data,
+        "--test_data",
+        args.test_data,
+        "--model",
+        model,
+        "--metrics_prefix",
+        "async",
+        "--iteration_name",
+        os.path.basename(model),
+        "--lr",
+        str(args.lr),
+        "--batch_size",
+        str(args.batch_size),
+        "--checkpoint_format",
+        args.checkpoint_format,
+    ]
+    if checkpoint is None:
+        # only used to create the initial global model
+        return command + ["--epochs", "0", "--output_mode", "model"]
+
+    command += [
+        "--checkpoint",
+        checkpoint,
+        "--epochs",
+        str(args.epochs),
+        "--output_mode",
+        "update",
+        "--update_quantization",
+        args.update_quantization,
+        "--residual",
+        residual,
+    ]
+    if args.topk_ratio:
+        command += ["--topk_ratio", str(args.topk_ratio)]
+    if previous_residual:
+        command += ["--previous_residual", previous_residual]
+    return command
+
+
+def run_silo(args, store, silo_index, work_dir, stop_event, errors):
+    """Run the loop of a silo, stop all the silos if it fails.
+
+    Args:
+        args (argparse.namespace): command line arguments of this script
+        store (FolderStore): the store shared with the aggregator
+        silo_index (int): index of the silo
+        work_dir (str): local folder of the silo
+        stop_event (threading.Event): set when the aggregator is done, or when a silo failed
+        errors (List[Exception]): the error of this silo is appended here
+    """
+    try:
+        silo_loop(args, store, silo_index, work_dir, stop_event)
+    except Exception as e:
+        logger.error(f"silo{silo_index} failed: {e!r}")
+        errors.append(e)
+        stop_event.set()
+
+
+def silo_loop(args, store, silo_index, work_dir, stop_event):
+    """Loop of a silo: pull the latest global version, train, submit the update.
+
+    Args:
+        args (argparse.namespace): command line arguments of this script
+        store (FolderStore): the store shared with the aggregator
+        silo_index (int): index of the silo
+        work_dir (str): local folder of the silo
+        stop_event (threading.Event): set when the aggregator is done
+    """
+    silo_name = f"silo{silo_index}"
+    delay = args.silo_delays[silo_index] if silo_index < len(args.silo_delays) else 0
+    previous_residual = None
+    training_index = 0
+
+    while not stop_event.is_set():
+        base_version = store.latest_version()
+        training_index += 1
+        model = os.path.join(work_dir, f"model_{training_index}")
+        residual = os.path.join(work_dir, f"residual_{training_index}")
+        os.makedirs(model, exist_ok=True)
+        os.makedirs(residual, exist_ok=True)
+
+        logger.info(
+            f"{silo_name} training #{training_index} from version {base_version}"
+        )
+        subprocess.run(
+            get_training_command(
+                args,
+                store.version_path(base_version),
+                model,
+                residual,
+                previous_residual,
+            ),
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        previous_residual = residual
+        stop_event.wait(delay)
+        if stop_event.is_set():
+            break
+
+        submission_id = store.submit(silo_name, model, base_version)
+        logger.info(f"{silo_name} submitted {submission_id}")
+
+
+def run(args):
+    """Run script with arguments.
+
+    Args:
+        args (argparse.namespace): command line arguments provided to script
+    """
+    root = args.store or tempfile.mkdtemp(prefix="fl_async_")
+    store = FolderStore(os.path.join(root, "store"))
+    logger.info(f"Local store in {store.root}")
+
+    initial_checkpoint = None
+    if store.latest_version() is None:
+        # the aggregator publishes this model as version 0
+        initial_checkpoint = os.path.join(root, "initial_model")
+        os.makedirs(initial_checkpoint, exist_ok=True)
+        subprocess.run(
+            get_training_command(args, None, initial_checkpoint, None, None),
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    aggregator_command = [
+        sys.executable,
+        os.path.join(AGGREGATION_FOLDER, "async_run.py"),
+        "--store",
+        store.root,
+        "--buffer_size",
+        str(args.buffer_size),
+        "--num_versions",
+        str(args.num_versions),
+        "--staleness_weighting",
+        args.staleness_weighting,
+        "--server_optimizer",
+        args.server_optimizer,
+        "--server_lr",
+        str(args.server_lr),
+        "--checkpoint_format",
+        args.checkpoint_format,
+        "--poll_interval",
+        "0.2",
+        "--timeout",
+        str(args.timeout),
+    ]
+    if initial_checkpoint:
+        aggregator_command += ["--initial_checkpoint", initial_checkpoint]
+    aggregator = subprocess.Popen(aggregator_command, cwd=AGGREGATION_FOLDER)
+
+    # wait for the aggregator to publish the first version
+    while store.latest_version() is None:
+        if aggregator.poll() is not None:
+            raise RuntimeError("The aggregator stopped before publishing any version")
+        time.sleep(0.2)
+
+    stop_event = threading.Event()
+    errors = []
+    silos = [
+        threading.Thread(
+            target=run_silo,
+            args=(
+                args,
+                store,
+                silo_index,
+                os.path.join(root, f"silo{silo_index}"),
+                stop_event,
+                errors,
+            ),
+            daemon=True,
+        )
+        for silo_index in range(args.num_silos)
+    ]
+    for silo in silos:
+        silo.start()
+
+    # a failed silo stops the aggregator, instead of letting it wait for --timeout
+    while aggregator.poll() is None:
+        if stop_event.wait(0.2):
+            aggregator.terminate()
+            break
+    return_code = aggregator.wait()
+    stop_event.set()
+    for silo in silos:
+        silo.join()
+    if errors:
+        raise errors[0]
+    if return_code != 0:
+        raise RuntimeError(f"The aggregator failed with return code {return_code}")
+    logger.info(
+        f"Done, latest global version is {store.version_path(store.latest_version())}"
+    )
+
+
+def main(cli_args=None):
+    """Script main function.
+
+    Args:
+        cli_args (List[str], optional): list of args to feed script, useful for debugging. Defaults to None.
+    """
+    parser = get_arg_parser()
+    args = parser.parse_args(cli_args)
+    run(args)
+
+
+if __name__ == "__main__":
+
+    # Set logging to sys.out
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    log_format = logging.Formatter("[%(asctime)s] [%(levelname)s] - %(message)s")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(log_format)
+    logger.addHandler(handler)
+
+    main()
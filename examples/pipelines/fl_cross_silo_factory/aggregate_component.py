@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+"""Load the aggregation component with as many silo inputs as a pipeline needs.
+
+Shared by the factory and the literal pipelines (fl_cross_silo_literal adds
+this folder to its path), so that both wire the silos the same way.
+"""
+import os
+
+from azure.ai.ml import load_component
+
+
+def load_aggregate_component(components_folder, num_silo_inputs):
+    """Load the aggregation component with at least num_silo_inputs input_silo_N inputs.
+
+    The component yaml declares input_silo_1..3, the missing inputs are added
+    (with their --input_silo argument in the command), so that the pipeline
+    works with any number of silos without editing the yaml. This requires a
+    component taking a repeatable --input_silo argument (MNIST).
+
+    Args:
+        components_folder (str): folder of the components of the example
+        num_silo_inputs (int): number of silo inputs of the largest aggregation step
+
+    Returns:
+        CommandComponent: the aggregation component
+    """
+    component_path = os.path.join(
+        components_folder, "aggregatemodelweights", "aggregatemodelweights.yaml"
+    )
+    component = load_component(path=component_path)
+    command = component.command
+    params_override = []
+    for silo_index in range(1, num_silo_inputs + 1):
+        input_name = f"input_silo_{silo_index}"
+        if input_name in component.inputs:
+            continue
+        if "$[[--input_silo ${{inputs.input_silo_1}}]]" not in command:
+            raise ValueError(
+                f"The aggregation component {component_path} takes at most {silo_index - 1} silos (it has no repeatable --input_silo argument), got {num_silo_inputs} silos"
+            )
+        params_override.append(
+            {
+                f"inputs.{input_name}": {
+                    "type": "uri_folder",
+                    "description": f"input from silo {silo_index} (e.g., model weights, or gradient updates)",
+                    "optional": True,
+                }
+            }
+        )
+        command += f" $[[--input_silo ${{{{inputs.{input_name}}}}}]]"
+    if not params_override:
+        return component
+    return load_component(
+        path=component_path, params_override=params_override + [{"command": command}]
+    )
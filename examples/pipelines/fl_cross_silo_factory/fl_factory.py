@@ -34,6 +34,8 @@ class FederatedLearningPipelineFactory:
         """Constructor"""
         self.silos = []
         self.orchestrator = {}
+        self.regional_aggregators = {}
+        self.checkpoint_store = None
         self.unique_identifier = self.getUniqueIdentifier()
 
         # see soft_validate()
@@ -48,22 +50,70 @@ class FederatedLearningPipelineFactory:
         """
         self.orchestrator = {"compute": compute, "datastore": datastore}
 
-    def add_silo(self, compute: str, datastore: str, **custom_input_args):
+    def add_silo(
+        self,
+        compute: str,
+        datastore: str,
+        region: Optional[str] = None,
+        **custom_input_args,
+    ):
         """Add a silo to the internal configuration of the builder.
 
         Args:
             compute (str): name of the compute target
             datastore (str): name of the datastore
+            region (str): optional region of the silo, used to group silos in an aggregation tree
             **custom_input_args: any of those will be passed to the preprocessing step as-is
         """
         self.silos.append(
             {
                 "compute": compute,
                 "datastore": datastore,
+                "region": region,
                 "custom_input_args": custom_input_args or {},
             }
         )
 
+    def set_regional_aggregator(self, region: str, compute: str, datastore: str):
+        """Set the compute/datastore running the intermediate aggregations of a region.
+
+        Silos of this region write their model outputs in this datastore, and
+        the intermediate aggregations of their outputs run on this compute
+        (see aggregation_tree_arity in build_basic_fl_pipeline()).
+
+        Args:
+            region (str): region, as given to add_silo()
+            compute (str): name of the compute target
+            datastore (str): name of the datastore
+        """
+        self.regional_aggregators[region] = {"compute": compute, "datastore": datastore}
+
+    def set_checkpoint_store(self, datastore: str):
+        """Set the datastore of the chunk store shared by the training and aggregation steps.
+
+        The chunks of the chunked checkpoints are stored once, addressed by
+        their content, under a path shared by all runs (see checkpoint_store_input()),
+        so that chunks unchanged from one iteration to the next are not written again.
+
+        Args:
+            datastore (str): name of the datastore (usually the orchestrator datastore)
+        """
+        self.checkpoint_store = datastore
+
+    def checkpoint_store_input(self):
+        """Returns an Input mounting the chunk store read-write, or None if not set.
+
+        Returns:
+            Input: the chunk store, see set_checkpoint_store()
+        """
+        if self.checkpoint_store is None:
+            return None
+        return Input(
+            type=AssetTypes.URI_FOLDER,
+            mode="rw_mount",
+            path=f"azureml://datastores/{self.checkpoint_store}/paths/federated_learning/chunk_store/",
+        )
+
     def custom_fl_data_output(
         self, datastore_name, output_name, unique_id="${{name}}", iteration_num=None
     ):
@@ -145,6 +195,10 @@ class FederatedLearningPipelineFactory:
         silo_training,
         orchestrator_aggregation,
         iterations=1,
+        silo_state_keys=None,
+        intermediate_aggregation=None,
+        aggregation_tree_arity=None,
+        silo_training_timeout=None,
         **training_kwargs,
     ):
         """Build a typical FL pipeline based on the provided steps.
@@ -154,8 +208,16 @@ class FederatedLearningPipelineFactory:
             silo_training (func): training step to run in each silo
             orchestrator_aggregation (func): aggregation step to run in the orchestrator
             iterations (int): number of iterations to run (default: 1)
+            silo_state_keys (List[str]): keys of the silo_training() outputs that are kept in the silo
+                and fed back to the next silo_training() of the same silo as previous_<key>, instead of being aggregated
+            intermediate_aggregation (func): partial aggregation step, required by aggregation_tree_arity
+            aggregation_tree_arity (int): if set, aggregate the silo outputs with a tree of intermediate_aggregation()
+                steps taking at most this number of inputs each, before the final orchestrator_aggregation()
+            silo_training_timeout (int): if set, maximum duration of each training step in seconds,
+                after which Azure ML cancels the step (prefer a soft deadline in the training itself, see the docs)
             **training_kwargs: any of those will be passed to the training step as-is
         """
+        silo_state_keys = silo_state_keys or []
 
         @pipeline(
             description=f'FL cross-silo basic pipeline and the unique identifier is "{self.unique_identifier}" that can help you to track files in the storage account.',
@@ -204,6 +266,11 @@ class FederatedLearningPipelineFactory:
 
             running_outputs = {}  # for iteration 1, we have no pre-existing checkpoint
 
+            # map of the silo state outputs (see silo_state_keys), per silo
+            silo_running_states = dict(
+                [(silo_index, {}) for silo_index in range(len(self.silos))]
+            )
+
             # now for each iteration, run training
             for iteration in range(1, iterations + 1):
                 # collect all outputs in a dict to be used for aggregation
@@ -217,11 +284,18 @@ class FederatedLearningPipelineFactory:
                             silo_index
                         ],  # feed kwargs as produced by silo_preprocessing()
                         **running_outputs,  # feed optional running kwargs as produced by aggregate_component()
+                        **silo_running_states[
+                            silo_index
+                        ],  # feed optional silo state as produced by the previous silo_training()
                         **training_kwargs,  # # providing training params
                     )
 
                     # TODO: verify _step is an actual step
 
+                    if silo_training_timeout:
+                        # hard backstop, a cancelled step fails the pipeline
+                        training_step.set_limits(timeout=silo_training_timeout)
+
                     # verify the outputs from the developer code
                     assert isinstance(
                         training_outputs, dict
@@ -233,11 +307,23 @@ class FederatedLearningPipelineFactory:
 
                     # make sure the compute corresponds to the silo
                     # make sure the data is written in the right datastore
+                    # (the one of the regional aggregator if any, to keep the traffic regional)
                     self.anchor_step_in_silo(
                         training_step,
                         compute=silo_config["compute"],
                         output_datastore=silo_config["datastore"],
-                        model_output_datastore=self.orchestrator["datastore"],
+                        model_output_datastore=self.get_aggregator(
+                            silo_config["region"] if aggregation_tree_arity else None
+                        )["datastore"],
+                    )
+
+                    # silo state outputs stay in the silo for its next training
+                    silo_running_states[silo_index] = dict(
+                        [
+                            (f"previous_{key}", training_outputs.pop(key))
+                            for key in silo_state_keys
+                            if key in training_outputs
+                        ]
                     )
 
                     # each output is indexed to be fed into aggregate_component as a distinct input
@@ -262,24 +348,25 @@ class FederatedLearningPipelineFactory:
                             Please make sure your silo_training() function returns a consistent set of keys for every silo."""
                         )
 
+                # reduce the number of outputs with intermediate aggregations (if any)
+                if aggregation_tree_arity:
+                    silo_training_outputs = self.build_aggregation_tree(
+                        silo_training_outputs,
+                        [silo_config["region"] for silo_config in self.silos],
+                        intermediate_aggregation,
+                        aggregation_tree_arity,
+                        running_outputs,
+                    )
+
                 # pivot the outputs from index->key to key->index
-                aggregation_kwargs_inputs = dict(
-                    [
-                        (
-                            key,  # for every key in the outputs
-                            [
-                                # create a list of all silos outputs
-                                _outputs[key]
-                                for _outputs in silo_training_outputs
-                            ],
-                        )
-                        for key in reference_keys
-                    ]
+                aggregation_kwargs_inputs = self.pivot_outputs(
+                    silo_training_outputs, reference_keys
                 )
 
                 # aggregate all silo models into one
                 aggregation_step, aggregation_outputs = orchestrator_aggregation(
-                    **aggregation_kwargs_inputs
+                    **aggregation_kwargs_inputs,
+                    **running_outputs,  # feed optional running kwargs as produced by the previous aggregation
                 )
 
                 # TODO: verify _step is an actual step
@@ -308,6 +395,117 @@ class FederatedLearningPipelineFactory:
 
         return _fl_cross_silo_factory_pipeline()
 
+    def get_aggregator(self, region=None):
+        """Get the compute/datastore aggregating the outputs of a region (default: the orchestrator)."""
+        return self.regional_aggregators.get(region, self.orchestrator)
+
+    def pivot_outputs(self, outputs_list, keys):
+        """Pivot a list of outputs from index->key to key->index.
+
+        Args:
+            outputs_list (List[Dict[str, PipelineOutputBase]]): outputs of a list of steps
+            keys (Set[str]): keys of the outputs
+
+        Returns:
+            Dict[str, List[PipelineOutputBase]]: for every key, the list of outputs of all steps
+        """
+        return dict(
+            [
+                (
+                    key,  # for every key in the outputs
+                    [
+                        # create a list of all steps outputs
+                        _outputs[key]
+                        for _outputs in outputs_list
+                    ],
+                )
+                for key in keys
+            ]
+        )
+
+    def build_aggregation_tree(
+        self,
+        silo_outputs,
+        silo_regions,
+        intermediate_aggregation,
+        arity,
+        running_outputs,
+    ):
+        """Aggregate silo outputs with a k-ary tree of intermediate aggregation steps.
+
+        Each level groups at most arity outputs of the same region into an
+        intermediate_aggregation() step, anchored on the regional aggregator if
+        any (see set_regional_aggregator()), else on the orchestrator. Once every
+        region is reduced to a single output, regions are aggregated together
+        in the orchestrator. The tree stops when at most arity outputs are left,
+        which the caller feeds into the final aggregation.
+
+        Args:
+            silo_outputs (List[Dict[str, PipelineOutputBase]]): outputs of every silo_training()
+            silo_regions (List[str]): region of every silo (or None)
+            intermediate_aggregation (func): partial aggregation step, taking the same kwargs as orchestrator_aggregation()
+                and returning outputs with the same keys as silo_training()
+            arity (int): maximum number of inputs of each intermediate aggregation
+            running_outputs (dict): running kwargs as produced by the previous aggregation
+
+        Returns:
+            List[Dict[str, PipelineOutputBase]]: at most arity outputs left to aggregate
+        """
+        assert (
+            intermediate_aggregation is not None
+        ), "aggregation_tree_arity requires an intermediate_aggregation() function"
+        assert arity >= 2, f"aggregation_tree_arity should be at least 2 (got {arity})"
+
+        reference_keys = set(silo_outputs[0].keys())
+        nodes = list(zip(silo_regions, silo_outputs))
+        level = 0
+        while len(nodes) > arity:
+            level += 1
+            regions = list(dict.fromkeys([region for region, _ in nodes]))
+            if len(regions) == len(nodes):
+                # every region is reduced to one output, continue in the orchestrator
+                nodes = [(None, outputs) for _, outputs in nodes]
+                regions = [None]
+
+            next_nodes = []
+            for region in regions:
+                region_outputs = [
+                    outputs for _region, outputs in nodes if _region == region
+                ]
+                for start in range(0, len(region_outputs), arity):
+                    group = region_outputs[start : start + arity]
+                    if len(group) == 1:
+                        next_nodes.append((region, group[0]))
+                        continue
+
+                    aggregation_step, aggregation_outputs = intermediate_aggregation(
+                        **self.pivot_outputs(group, reference_keys),
+                        **running_outputs,  # feed optional running kwargs as produced by the previous aggregation
+                    )
+
+                    # verify the outputs from the developer code
+                    assert isinstance(
+                        aggregation_outputs, dict
+                    ), f"your intermediate_aggregation() function should return a (step,outputs) tuple with outputs a dictionary (current type a {type(aggregation_outputs)})"
+                    if reference_keys != set(aggregation_outputs.keys()):
+                        raise Exception(
+                            f"""The output returned by intermediate_aggregation() has keys {set(aggregation_outputs.keys())} that differ from keys of silo_training() ({reference_keys}).
+                            Please make sure your intermediate_aggregation() function returns the same keys as silo_training()."""
+                        )
+
+                    # this is done in the regional aggregator compute/datastore
+                    aggregator = self.get_aggregator(region)
+                    self.anchor_step_in_silo(
+                        aggregation_step,
+                        compute=aggregator["compute"],
+                        output_datastore=aggregator["datastore"],
+                        model_output_datastore=aggregator["datastore"],
+                    )
+                    next_nodes.append((region, aggregation_outputs))
+            nodes = next_nodes
+
+        return [outputs for _, outputs in nodes]
+
     ###########################
     ### AFFINITY VALIDATION ###
     ###########################
@@ -377,6 +575,71 @@ class FederatedLearningPipelineFactory:
                 False,
             )  # NOT OK to write in silo?
 
+            if silo["region"] in self.regional_aggregators:
+                regional_datastore = self.regional_aggregators[silo["region"]][
+                    "datastore"
+                ]
+                self.set_affinity(
+                    silo["compute"],
+                    regional_datastore,
+                    self.OPERATION_READ,
+                    True,
+                    data_type=AssetTypes.CUSTOM_MODEL,
+                )  # OK to get a model out of the regional aggregator
+                self.set_affinity(
+                    silo["compute"],
+                    regional_datastore,
+                    self.OPERATION_WRITE,
+                    True,
+                    data_type=AssetTypes.CUSTOM_MODEL,
+                )  # OK to write a model into the regional aggregator
+
+            if self.checkpoint_store is not None:
+                # the chunk store holds the chunks of the models exchanged
+                self.set_affinity(
+                    silo["compute"],
+                    self.checkpoint_store,
+                    self.OPERATION_READ,
+                    True,
+                    data_type=AssetTypes.URI_FOLDER,
+                )
+
+        # regional aggregators permissions
+        for aggregator in self.regional_aggregators.values():
+            self.set_affinity(
+                aggregator["compute"],
+                aggregator["datastore"],
+                self.OPERATION_READ,
+                True,
+            )
+            self.set_affinity(
+                aggregator["compute"],
+                aggregator["datastore"],
+                self.OPERATION_WRITE,
+                True,
+            )
+            self.set_affinity(
+                aggregator["compute"],
+                self.orchestrator["datastore"],
+                self.OPERATION_READ,
+                True,
+            )  # OK to read the running checkpoint from the orchestrator
+            self.set_affinity(
+                self.orchestrator["compute"],
+                aggregator["datastore"],
+                self.OPERATION_READ,
+                True,
+            )  # OK to read the partial aggregations from the regional aggregator
+
+            if self.checkpoint_store is not None:
+                self.set_affinity(
+                    aggregator["compute"],
+                    self.checkpoint_store,
+                    self.OPERATION_READ,
+                    True,
+                    data_type=AssetTypes.URI_FOLDER,
+                )
+
         return self.affinity_map
 
     def set_affinity(
@@ -469,6 +732,17 @@ class FederatedLearningPipelineFactory:
                 "You have the orchestrator and silos using the same compute, please fix your config."
             )
 
+        # check if regional aggregators overlap with the silos
+        for region, aggregator in self.regional_aggregators.items():
+            if aggregator["datastore"] in silo_datastore_names:
+                soft_validation_report.append(
+                    f"You have the regional aggregator of {region} and silos using the same datastore, please fix your config."
+                )
+            if aggregator["compute"] in silo_computes_names:
+                soft_validation_report.append(
+                    f"You have the regional aggregator of {region} and silos using the same compute, please fix your config."
+                )
+
         # loop on all the jobs
         for job_key in pipeline_job.jobs:
             job = pipeline_job.jobs[job_key]
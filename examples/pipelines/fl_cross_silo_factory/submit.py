@@ -49,6 +49,7 @@ from dataclasses import dataclass
 import itertools
 
 # local imports
+from aggregate_component import load_aggregate_component
 from fl_factory import FederatedLearningPipelineFactory
 
 ###############################
@@ -117,6 +118,16 @@ args = parser.parse_args()
 # load the config from a local yaml file
 YAML_CONFIG = OmegaConf.load(args.config)
 
+# secure aggregation needs the surviving silos to reveal their seeds between the
+# training and the aggregation, this pipeline has no such step (see the round
+# protocol in components/MNIST/traininsilo/secure_aggregation.py)
+if YAML_CONFIG.federated_learning.get("secure_aggregation", None) or any(
+    key.startswith("secagg_") for key in YAML_CONFIG.training_parameters
+):
+    raise ValueError(
+        "Secure aggregation is not supported by this pipeline, run its rounds by hand (see the round protocol in components/MNIST/traininsilo/secure_aggregation.py)"
+    )
+
 # CONNECT TO AZURE ML
 
 try:
@@ -164,10 +175,9 @@ training_component = load_component(
     path=os.path.join(COMPONENTS_FOLDER, "traininsilo", "traininsilo.yaml")
 )
 
-aggregate_component = load_component(
-    path=os.path.join(
-        COMPONENTS_FOLDER, "aggregatemodelweights", "aggregatemodelweights.yaml"
-    )
+
+aggregate_component = load_aggregate_component(
+    COMPONENTS_FOLDER, len(YAML_CONFIG.federated_learning.silos)
 )
 
 
@@ -211,9 +221,15 @@ def silo_training(
     train_data: Input = None,  # output from silo_preprocessing()
     test_data: Input = None,  # output from silo_preprocessing()
     running_checkpoint: Input = None,  # output from orchestrator_aggregation()
+    previous_residual: Input = None,  # output from the previous silo_training() in this silo
     lr: int = 0.01,  # custom param given to factory build_basic_fl_pipeline()
     batch_size: int = 64,  # custom param given to factory build_basic_fl_pipeline()
     epochs: int = 1,  # custom param given to factory build_basic_fl_pipeline()
+    max_train_seconds: float = None,  # custom param given to factory build_basic_fl_pipeline()
+    failure_mode: str = None,  # custom param given to factory build_basic_fl_pipeline()
+    num_workers: int = None,  # custom param given to factory build_basic_fl_pipeline()
+    checkpoint_format: str = None,  # custom param given to factory build_basic_fl_pipeline()
+    chunk_store: Input = None,  # custom param given to factory build_basic_fl_pipeline()
 ):
     """Create steps for running FL training in the silo.
 
@@ -221,9 +237,15 @@ def silo_training(
         train_data (Input): preprocessed data (see outputs of silo_preprocessing())
         test_data (Input): preprocessed data (see outputs of silo_preprocessing())
         running_checkpoint (Input): if not None, the checkpoint obtained from previous iteration (see orchestrator_aggregation())
+        previous_residual (Input): if not None, the update residual of the previous iteration in this silo
         lr (int): learning rate for training component
         batch_size (int): batch size for training component
         epochs (int): epochs for training component
+        max_train_seconds (float): if not None, soft deadline of the training component
+        failure_mode (str): if not None, raise or skip (let the aggregation skip this silo on failure)
+        num_workers (int): if not None, number of data loading worker processes of the training component
+        checkpoint_format (str): if not None, format of the checkpoint sent to the orchestrator
+        chunk_store (Input): if not None, the chunk store shared by all the steps (see checkpoint_format=chunked)
 
     Returns:
         PipelineStep: the training step of the FL pipeline
@@ -245,27 +267,58 @@ def silo_training(
         batch_size=batch_size,
     )
 
-    return silo_training_step, {
+    # the error feedback residual of the previous iteration, kept in the silo
+    if (
+        previous_residual is not None
+        and "previous_residual" in training_component.inputs
+    ):
+        silo_training_step.inputs.previous_residual = previous_residual
+
+    # a straggler or failing silo should not hold up the whole federation
+    if (
+        max_train_seconds is not None
+        and "max_train_seconds" in training_component.inputs
+    ):
+        silo_training_step.inputs.max_train_seconds = max_train_seconds
+    if failure_mode is not None and "failure_mode" in training_component.inputs:
+        silo_training_step.inputs.failure_mode = failure_mode
+
+    # load the batches in parallel of the training
+    if num_workers is not None and "num_workers" in training_component.inputs:
+        silo_training_step.inputs.num_workers = num_workers
+
+    # unchanged chunks of the chunked checkpoints are not written or read again
+    if (
+        checkpoint_format is not None
+        and "checkpoint_format" in training_component.inputs
+    ):
+        silo_training_step.inputs.checkpoint_format = checkpoint_format
+    if chunk_store is not None and "chunk_store" in training_component.inputs:
+        silo_training_step.inputs.chunk_store = chunk_store
+
+    training_outputs = {
         # IMPORTANT: use a key that is consistent with kwargs of orchestrator_aggregation()
         "weights": silo_training_step.outputs.model
     }
+    if "residual" in training_component.outputs:
+        # not aggregated, fed back to the next silo_training() (see silo_state_keys)
+        training_outputs["residual"] = silo_training_step.outputs.residual
 
+    return silo_training_step, training_outputs
 
-def orchestrator_aggregation(weights=[]):
-    """Create steps for running FL training in the silo.
+
+def get_aggregation_inputs(weights=None, running_checkpoint=None, min_silos=None):
+    """Map the outputs of the silos to the inputs of the aggregation component.
 
     Args:
-        train_data (Input): preprocessed data (see silo_training())
-        test_data (Input): preprocessed data (see silo_training())
+        weights (List[Input]): the outputs of every silo (see silo_training())
         running_checkpoint (Input): if not None, the checkpoint obtained from previous iteration (see orchestrator_aggregation())
-        lr (int): learning rate for training component
-        batch_size (int): batch size for training component
-        epochs (int): epochs for training component
+        min_silos (int): if not None, aggregate as soon as this number of silos produced a valid output
 
     Returns:
-        PipelineStep: the training step of the FL pipeline
-        Dict[str, Input]: a map of the inputs expected as kwargs by orchestrator_aggregation()
+        Dict[str, Input]: the kwargs of aggregate_component()
     """
+    weights = weights or []
     # create some custom map from silo_outputs_map to expected inputs
     aggregation_inputs = dict(
         [
@@ -274,8 +327,82 @@ def orchestrator_aggregation(weights=[]):
         ]
     )
 
+    # the checkpoint the silos started from, to apply updates sent instead of models
+    if (
+        running_checkpoint is not None
+        and "base_checkpoint" in aggregate_component.inputs
+    ):
+        aggregation_inputs["base_checkpoint"] = running_checkpoint
+
+    # skip the silos that failed or produced an invalid checkpoint
+    if min_silos is not None and "min_silos" in aggregate_component.inputs:
+        aggregation_inputs["min_silos"] = min_silos
+
+    # the aggregated checkpoint has the same format as the silo checkpoints
+    checkpoint_format = YAML_CONFIG.training_parameters.get("checkpoint_format", None)
+    if (
+        checkpoint_format is not None
+        and "checkpoint_format" in aggregate_component.inputs
+    ):
+        aggregation_inputs["checkpoint_format"] = checkpoint_format
+    chunk_store = builder.checkpoint_store_input()
+    if chunk_store is not None and "chunk_store" in aggregate_component.inputs:
+        aggregation_inputs["chunk_store"] = chunk_store
+
+    return aggregation_inputs
+
+
+def intermediate_aggregation(weights=None, running_checkpoint=None):
+    """Create steps for aggregating a group of silos in an aggregation tree.
+
+    Args:
+        weights (List[Input]): the outputs of a group of silos (see silo_training()) or of intermediate aggregations
+        running_checkpoint (Input): if not None, the checkpoint obtained from previous iteration (see orchestrator_aggregation())
+
+    Returns:
+        PipelineStep: the intermediate aggregation step of the FL pipeline
+        Dict[str, Input]: a map of the outputs, with the same keys as silo_training()
+    """
+    weights = weights or []
+    # the partial mean of this group, weighted by the group total weight when aggregated again
+    # with a quorum, every group passes on its valid silos (none at all if they were all
+    # skipped, an empty output skipped by the next aggregation), the quorum is checked
+    # at the root over all the silos
+    partial_aggregation_step = aggregate_component(
+        aggregation_output="partial",
+        **get_aggregation_inputs(
+            weights,
+            running_checkpoint,
+            min_silos=0 if YAML_CONFIG.federated_learning.get("min_silos") else None,
+        ),
+    )
+
+    return partial_aggregation_step, {
+        # IMPORTANT: use the same keys as silo_training()
+        "weights": partial_aggregation_step.outputs.aggregated_output
+    }
+
+
+def orchestrator_aggregation(weights=None, running_checkpoint=None):
+    """Create steps for running FL aggregation in the orchestrator.
+
+    Args:
+        weights (List[Input]): the outputs of every silo (see silo_training()) or of intermediate aggregations
+        running_checkpoint (Input): if not None, the checkpoint obtained from previous iteration (see orchestrator_aggregation())
+
+    Returns:
+        PipelineStep: the aggregation step of the FL pipeline
+        Dict[str, Input]: a map of the inputs expected as kwargs by silo_training()
+    """
+    weights = weights or []
     # aggregate all silo models into one
-    aggregate_weights_step = aggregate_component(**aggregation_inputs)
+    aggregate_weights_step = aggregate_component(
+        **get_aggregation_inputs(
+            weights,
+            running_checkpoint,
+            min_silos=YAML_CONFIG.federated_learning.get("min_silos", None),
+        )
+    )
 
     return aggregate_weights_step, {
         # IMPORTANT: use a key that is consistent with kwargs of silo_training()
@@ -306,6 +433,8 @@ for silo_config in YAML_CONFIG.federated_learning.silos:
         # provide settings for this silo
         silo_config.compute,
         silo_config.datastore,
+        # optional region, to group silos in an aggregation tree
+        region=silo_config.get("region", None),
         # any additional custom kwarg will be sent to silo_preprocessing() as is
         raw_train_data=Input(
             type=silo_config.training_data.type,
@@ -319,6 +448,18 @@ for silo_config in YAML_CONFIG.federated_learning.silos:
         ),
     )
 
+# optional chunk store, shared by the steps exchanging chunked checkpoints
+if YAML_CONFIG.federated_learning.get("checkpoint_store", None):
+    builder.set_checkpoint_store(YAML_CONFIG.federated_learning.checkpoint_store)
+
+# optional regional aggregators, running the intermediate aggregations of their region
+for aggregator_config in YAML_CONFIG.federated_learning.get("regional_aggregators", []):
+    builder.set_regional_aggregator(
+        aggregator_config.region,
+        aggregator_config.compute,
+        aggregator_config.datastore,
+    )
+
 # 3. use a pipeline factory method
 
 pipeline_job = builder.build_basic_fl_pipeline(
@@ -328,10 +469,26 @@ pipeline_job = builder.build_basic_fl_pipeline(
     orchestrator_aggregation,
     # RESERVED: this kwarg is for building iterations
     iterations=YAML_CONFIG.training_parameters.num_of_iterations,
+    # the outputs of silo_training() that stay in the silo from one iteration to the next
+    silo_state_keys=["residual"],
+    # optional aggregation tree, each aggregation step takes at most this number of inputs
+    intermediate_aggregation=intermediate_aggregation,
+    aggregation_tree_arity=YAML_CONFIG.federated_learning.get(
+        "aggregation_tree_arity", None
+    ),
+    # optional hard timeout of the training steps (in seconds)
+    silo_training_timeout=YAML_CONFIG.training_parameters.get(
+        "silo_training_timeout", None
+    ),
     # any additional custom kwarg will be sent to silo_training() as is
     lr=YAML_CONFIG.training_parameters.lr,
     batch_size=YAML_CONFIG.training_parameters.batch_size,
     epochs=YAML_CONFIG.training_parameters.epochs,
+    max_train_seconds=YAML_CONFIG.training_parameters.get("max_train_seconds", None),
+    failure_mode=YAML_CONFIG.training_parameters.get("failure_mode", None),
+    num_workers=YAML_CONFIG.training_parameters.get("num_workers", None),
+    checkpoint_format=YAML_CONFIG.training_parameters.get("checkpoint_format", None),
+    chunk_store=builder.checkpoint_store_input(),
 )
 
 # 4. Validate the pipeline using soft rules
@@ -26,6 +26,15 @@ from azure.ai.ml import load_component
 # to handle yaml config easily
 from omegaconf import OmegaConf
 
+# the aggregation component loader is shared with the factory pipeline
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "fl_cross_silo_factory"
+    ),
+)
+from aggregate_component import load_aggregate_component  # noqa: E402
+
 
 ############################
 ### CONFIGURE THE SCRIPT ###
@@ -87,6 +96,16 @@ args = parser.parse_args()
 # load the config from a local yaml file
 YAML_CONFIG = OmegaConf.load(args.config)
 
+# secure aggregation needs the surviving silos to reveal their seeds between the
+# training and the aggregation, this pipeline has no such step (see the round
+# protocol in components/MNIST/traininsilo/secure_aggregation.py)
+if YAML_CONFIG.federated_learning.get("secure_aggregation", None) or any(
+    key.startswith("secagg_") for key in YAML_CONFIG.training_parameters
+):
+    raise ValueError(
+        "Secure aggregation is not supported by this pipeline, run its rounds by hand (see the round protocol in components/MNIST/traininsilo/secure_aggregation.py)"
+    )
+
 # path to the components
 COMPONENTS_FOLDER = os.path.join(
     os.path.dirname(__file__), "..", "..", "components", args.example
@@ -137,10 +156,9 @@ training_component = load_component(
     path=os.path.join(COMPONENTS_FOLDER, "traininsilo", "traininsilo.yaml")
 )
 
-aggregate_component = load_component(
-    path=os.path.join(
-        COMPONENTS_FOLDER, "aggregatemodelweights", "aggregatemodelweights.yaml"
-    )
+
+aggregate_component = load_aggregate_component(
+    COMPONENTS_FOLDER, len(YAML_CONFIG.federated_learning.silos)
 )
 
 